@@ -0,0 +1,96 @@
+# bench_codec.py
+"""Confronto tra la serializzazione JSON precedente e ``jsoncodec``.
+
+Misura, su record e righe del registro invii sintetici:
+- salvataggio su disco: ``json.dumps(indent=2)`` contro il formato compatto;
+- lettura: ``json.loads`` contro ``jsoncodec.loads``;
+- risposta API: ``jsonable_encoder`` + ``JSONResponse`` contro ``FastJSONResponse``.
+
+Esempi:
+    python bench_codec.py
+    python bench_codec.py --records 50000 --repeat 5
+"""
+import argparse, json, random, time, uuid
+from datetime import date, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import jsoncodec
+from jsonresponse import FastJSONResponse
+
+
+def _records(n: int) -> list[dict]:
+    rnd = random.Random(1)
+    nomi = ["Mario", "Giulia", "Luca", "Anna", "Niccolò", "Chiara", "Francesco", "Sofia"]
+    cognomi = ["Rossi", "Bianchi", "Esposito", "Romano", "Colombo", "Ricci", "Marino", "Greco"]
+    out = []
+    for i in range(n):
+        d = date(2015, 1, 1) + timedelta(days=rnd.randint(0, 3500))
+        out.append({
+            "id": uuid.UUID(int=rnd.getrandbits(128)).hex,
+            "nome": rnd.choice(nomi), "cognome": rnd.choice(cognomi),
+            "telefono_prefisso": "+39", "telefono_numero": f"3{rnd.randint(100000000, 999999999)}",
+            "email": f"utente{i}@example.it",
+            "def_nome": rnd.choice(nomi), "def_cognome": rnd.choice(cognomi),
+            "def_data": d.isoformat(), "prossima_ricorrenza": (d + timedelta(days=365)).isoformat(),
+            "giorni_prima": rnd.choice([0, 1, 3, 7]),
+            "oggetto": None, "corpo": "Un pensiero per {{DEF_NOME}} {{DEF_COGNOME}} nel giorno del ricordo.",
+            "sospendi_invio": i % 17 == 0,
+            "created_at": "2024-05-01T10:00:00.000000+00:00", "updated_at": "2024-05-02T08:30:00.000000+00:00",
+        })
+    return out
+
+
+def _sent_rows(recs: list[dict]) -> list[dict]:
+    return [{
+        "record_id": r["id"], "to": [r["email"]], "subject": "In memoria",
+        "body_usato": r["corpo"], "nome": r["nome"], "cognome": r["cognome"],
+        "def_nome": r["def_nome"], "def_cognome": r["def_cognome"],
+        "scheduled_for": r["prossima_ricorrenza"], "due_date": r["prossima_ricorrenza"],
+        "sent_at": "2025-05-01T07:00:01.123456+00:00", "stato": "ok", "errore": None,
+    } for r in recs]
+
+
+def _best(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def run(n: int, repeat: int) -> list[tuple]:
+    recs = _records(n)
+    rows = _sent_rows(recs)
+    old_text = json.dumps(recs, ensure_ascii=False, indent=2)
+    new_text = jsoncodec.dumps(recs)
+    cases = [
+        ("salvataggio record", lambda: json.dumps(recs, ensure_ascii=False, indent=2), lambda: jsoncodec.dumps(recs)),
+        ("lettura record", lambda: json.loads(old_text), lambda: jsoncodec.loads(new_text)),
+        ("GET /records", lambda: JSONResponse(jsonable_encoder(recs)).body, lambda: FastJSONResponse(recs).body),
+        ("GET /emails/sent", lambda: JSONResponse(jsonable_encoder({"emails": rows})).body,
+         lambda: FastJSONResponse({"emails": rows}).body),
+    ]
+    out = [(name, _best(old, repeat), _best(new, repeat)) for name, old, new in cases]
+    out.append(("dimensione su disco (KB)", len(old_text.encode()) / 1024, len(new_text.encode()) / 1024))
+    return out
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark della serializzazione JSON")
+    ap.add_argument("--records", type=int, default=10000)
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args(argv)
+
+    print(f"codec: {jsoncodec.BACKEND}, {args.records} record, migliore di {args.repeat} prove")
+    print(f"{'':28}{'prima':>12}{'jsoncodec':>12}{'rapporto':>10}")
+    for name, old, new in run(args.records, args.repeat):
+        unit = "" if name.startswith("dimensione") else " s"
+        fmt = "{:>10.1f}" if unit == "" else "{:>10.4f}"
+        print(f"{name:28}{fmt.format(old)}{unit:2}{fmt.format(new)}{unit:2}{old / new:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
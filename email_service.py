@@ -1,9 +1,11 @@
 # email_service.py
-import os, smtplib
+import os, smtplib, threading, time, logging, asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.utils import formataddr
-from jinja2 import Template  # templating per soggetto/corpo
+from template_engine import render_jinja  # templating per soggetto/corpo (template compilati in cache)
 
 SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
@@ -11,10 +13,20 @@ SMTP_USER = os.getenv("SMTP_USER")           # es. fxedge.tools@gmail.com
 SMTP_PASS = os.getenv("SMTP_PASS")           # App Password di Gmail (non la password normale)
 SMTP_FROM = os.getenv("SMTP_FROM", SMTP_USER or "")
 SMTP_REPLY_TO = os.getenv("SMTP_REPLY_TO")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1").strip().lower() not in ("0", "false", "no")
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))                      # connessioni aperte al massimo
+SMTP_MAX_MESSAGES_PER_CONN = int(os.getenv("SMTP_MAX_MESSAGES_PER_CONN", "100"))
+SMTP_IDLE_CHECK_SECONDS = float(os.getenv("SMTP_IDLE_CHECK_SECONDS", "30"))  # oltre, NOOP prima del riuso
+SMTP_CONCURRENCY = int(os.getenv("SMTP_CONCURRENCY", str(SMTP_POOL_SIZE)))   # invii in parallelo (bulk)
+SMTP_RATE_PER_SEC = float(os.getenv("SMTP_RATE_PER_SEC", "0"))              # quota del provider per processo, 0 = nessun limite
+SMTP_RATE_BURST = int(os.getenv("SMTP_RATE_BURST", "5"))
+
+log = logging.getLogger("email_service")
 
 def render_template(template_str: str, context: dict) -> str:
     """Rende una stringa con placeholder Jinja2."""
-    return Template(template_str or "").render(**(context or {}))
+    return render_jinja(template_str or "", context or {})
 
 def _build_message(to_email: str, subject: str, html: str, plain_fallback: str | None = None):
     msg = MIMEMultipart("alternative")
@@ -39,14 +51,244 @@ def _build_message(to_email: str, subject: str, html: str, plain_fallback: str |
     msg.attach(MIMEText(html or "", "html", "utf-8"))
     return msg, from_addr
 
+# =========================
+#  POOL CONNESSIONI SMTP
+# =========================
+
+class _Conn:
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+
+def _is_reconnectable(e: Exception) -> bool:
+    """Errori per cui ha senso riprovare su una connessione nuova."""
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code == 421:
+        return True
+    return isinstance(e, (ConnectionError, TimeoutError))
+
+
+class SmtpPool:
+    """Sessioni SMTP autenticate riutilizzate tra un messaggio e l'altro.
+
+    - al massimo ``size`` connessioni aperte (le richieste in più attendono);
+    - una connessione ferma da più di ``idle_check`` secondi viene verificata
+      con NOOP prima del riuso;
+    - dopo ``max_messages`` invii la connessione viene chiusa e riaperta;
+    - su disconnessione / 421 il messaggio viene ritentato una volta su una
+      connessione nuova.
+    Senza ``user`` non viene fatto LOGIN (utile con un server SMTP locale di test).
+    """
+
+    def __init__(self, host: str, port: int, user: str | None = None, password: str | None = None,
+                 starttls: bool = True, size: int = 4, max_messages: int = 100,
+                 idle_check: float = 30.0, timeout: float = 30.0):
+        self.host, self.port = host, port
+        self.user, self.password = user, password
+        self.starttls = starttls
+        self.max_messages = max_messages
+        self.idle_check = idle_check
+        self.timeout = timeout
+        self._idle: list[_Conn] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, size))
+
+    def _open(self) -> _Conn:
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.starttls()
+            if self.user:
+                smtp.login(self.user, self.password or "")
+        except Exception:
+            self._close(smtp)
+            raise
+        return _Conn(smtp)
+
+    @staticmethod
+    def _close(smtp: smtplib.SMTP):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def _healthy(self, conn: _Conn) -> bool:
+        if time.monotonic() - conn.last_used < self.idle_check:
+            return True
+        try:
+            return conn.smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _acquire(self) -> _Conn:
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    return self._open()
+                if self._healthy(conn):
+                    return conn
+                self._close(conn.smtp)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, conn: _Conn, broken: bool = False):
+        try:
+            if broken or conn.sent >= self.max_messages:
+                self._close(conn.smtp)
+            else:
+                conn.last_used = time.monotonic()
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def sendmail(self, from_addr: str, to_addrs: list[str], msg: str):
+        for attempt in (1, 2):
+            conn = self._acquire()
+            try:
+                conn.smtp.sendmail(from_addr, to_addrs, msg)
+            except Exception as e:
+                retry = _is_reconnectable(e)
+                self._release(conn, broken=retry)
+                if retry and attempt == 1:
+                    log.warning("connessione SMTP persa (%s), nuovo tentativo", e)
+                    continue
+                raise
+            conn.sent += 1
+            self._release(conn)
+            return
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn.smtp)
+
+
+_POOL: SmtpPool | None = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> SmtpPool:
+    """Pool condiviso configurato dalle env vars SMTP_*."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = SmtpPool(
+                SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASS,
+                starttls=SMTP_STARTTLS, size=SMTP_POOL_SIZE, max_messages=SMTP_MAX_MESSAGES_PER_CONN,
+                idle_check=SMTP_IDLE_CHECK_SECONDS, timeout=SMTP_TIMEOUT,
+            )
+        return _POOL
+
+
+def close_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.close()
+            _POOL = None
+
+
+class TokenBucket:
+    """Limite di throughput: ``rate`` messaggi/secondo con raffiche fino a ``burst``.
+
+    Condiviso tra thread: ``acquire`` prenota un gettone sotto lock e attende
+    fuori dal lock il tempo necessario, così le attese si mettono in fila.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+# un solo limite per processo: bulk, outbox, invii manuali e di test passano tutti da send_email
+_RATE_LIMIT = TokenBucket(SMTP_RATE_PER_SEC, SMTP_RATE_BURST)
+
+
 def send_email(to_email: str, subject: str, html_body: str, plain_fallback: str | None = None):
-    """Invio reale via SMTP (Gmail o altro)."""
+    """Invio reale via SMTP (Gmail o altro), su una connessione del pool, entro SMTP_RATE_PER_SEC."""
     if not (SMTP_USER and SMTP_PASS):
         raise RuntimeError("SMTP non configurato: imposta SMTP_USER e SMTP_PASS nelle env vars")
 
     msg, from_addr = _build_message(to_email, subject, html_body, plain_fallback)
+    _RATE_LIMIT.acquire()
+    get_pool().sendmail(from_addr, [to_email], msg.as_string())
+
+
+
+# =========================
+#  INVIO BULK (asyncio)
+# =========================
+
+async def send_bulk(messages: list[dict], concurrency: int | None = None,
+                    sender: Callable | None = None) -> dict:
+    """Invia più messaggi in parallelo su ``concurrency`` sessioni SMTP.
+
+    ``messages``: dict con ``to``, ``subject``, ``html`` e opzionale ``plain``.
+    Ritorna ``{"sent": [to, ...], "failed": [{"to", "error"}, ...]}`` nell'ordine
+    dei messaggi, più ``errors``: l'errore di ogni messaggio (None se inviato),
+    allineato a ``messages``. ``sender`` (default ``send_email``) è la funzione bloccante
+    usata per il singolo invio, eseguita in un thread dedicato; il limite di
+    quota è quello condiviso di ``send_email``.
+    """
+    concurrency = max(1, concurrency or SMTP_CONCURRENCY)
+    send = sender or send_email
+    results: list = [None] * len(messages)
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(len(messages)):
+        queue.put_nowait(i)
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="smtp-bulk") as executor:
+        async def worker():
+            while True:
+                try:
+                    i = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                m = messages[i]
+                try:
+                    await loop.run_in_executor(executor, send, m["to"], m["subject"], m["html"], m.get("plain"))
+                    results[i] = None
+                except Exception as e:
+                    results[i] = str(e)
+
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(messages)) or 1)))
+
+    sent, failed = [], []
+    for m, err in zip(messages, results):
+        if err is None:
+            sent.append(m["to"])
+        else:
+            failed.append({"to": m["to"], "error": err})
+    return {"sent": sent, "failed": failed, "errors": results}
+
 
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-        server.starttls()
-        server.login(SMTP_USER, SMTP_PASS)
-        server.sendmail(from_addr, [to_email], msg.as_string())
+def send_bulk_sync(messages: list[dict], **kwargs) -> dict:
+    """Versione bloccante di send_bulk, per codice che non gira in un event loop."""
+    return asyncio.run(send_bulk(messages, **kwargs))
@@ -0,0 +1,120 @@
+# filelock.py
+"""Lock lettori/scrittore tra processi (più worker uvicorn) e tra thread.
+
+Tra processi si usa ``fcntl.flock`` su un file ``.lock`` dedicato: condiviso
+per le letture, esclusivo per le scritture. Tra i thread dello stesso processo
+un ``RLock`` serializza l'accesso (flock non distingue i thread). Dove fcntl
+non esiste (Windows) resta solo il lock tra thread.
+"""
+import os, threading
+from contextlib import contextmanager
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - piattaforme senza fcntl
+    fcntl = None
+
+
+class FileLock:
+    """``with lock.shared():`` per leggere, ``with lock.exclusive():`` per scrivere.
+
+    Rientrante nello stesso thread; un ``exclusive`` dentro uno ``shared``
+    promuove il lock (flock lo rilascia e lo riprende: chi scrive deve
+    ricontrollare se i dati sono cambiati, come fa ``RecordStore``).
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path   # None: solo lock tra thread
+        self._rlock = threading.RLock()
+        self._fd = None
+        self._held: list[str] = []   # modi annidati del thread che possiede _rlock
+
+    def _flock(self, op):
+        if fcntl is None or self.path is None:
+            return
+        if self._fd is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, op)
+
+    @contextmanager
+    def _hold(self, mode: str):
+        with self._rlock:
+            prev = self._held[-1] if self._held else None
+            want = "ex" if "ex" in (mode, prev) else "sh"
+            if want != prev and fcntl is not None:
+                self._flock(fcntl.LOCK_EX if want == "ex" else fcntl.LOCK_SH)
+            self._held.append(want)
+            try:
+                yield
+            finally:
+                self._held.pop()
+                if want != prev and fcntl is not None:
+                    self._flock(fcntl.LOCK_UN if prev is None else fcntl.LOCK_SH)
+
+    def shared(self):
+        return self._hold("sh")
+
+    def exclusive(self):
+        return self._hold("ex")
+
+    def close(self):
+        with self._rlock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+class TryLock:
+    """Lock esclusivo non bloccante tra processi, per segnalare un'attività in corso.
+
+    ``acquire()`` ritorna False se lo tiene qualcun altro; ``busy()`` dice se
+    qualcuno (anche questo processo) lo sta tenendo. Il kernel rilascia il
+    flock se il processo muore: un lock libero indica un'attività conclusa o
+    interrotta da un crash.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mutex = threading.Lock()
+        self._fd = None
+
+    def _open(self) -> int:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        return os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def acquire(self) -> bool:
+        with self._mutex:
+            if self._fd is not None:
+                return False
+            fd = self._open()
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    return False
+            self._fd = fd
+            return True
+
+    def release(self):
+        with self._mutex:
+            if self._fd is not None:
+                os.close(self._fd)   # chiudere il descrittore rilascia il flock
+                self._fd = None
+
+    def busy(self) -> bool:
+        with self._mutex:
+            if self._fd is not None:
+                return True
+            if fcntl is None:
+                return False
+            fd = self._open()
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return False
+            except BlockingIOError:
+                return True
+            finally:
+                os.close(fd)
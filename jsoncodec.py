@@ -0,0 +1,45 @@
+# jsoncodec.py
+"""Serializzazione JSON per lo storage e le risposte API.
+
+Con ``orjson`` installato si usa quello (scritto in C, produce direttamente
+bytes UTF-8); altrimenti il modulo ``json`` della libreria standard con lo
+stesso output compatto. Su disco il formato è compatto: ``JSON_PRETTY=1``
+riattiva l'indentazione dei file letti o modificati a mano (documenti,
+records.json, snapshot del journal); registro NDJSON, journal e SQLite
+restano a una riga per elemento.
+"""
+import os, json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dipendenza opzionale
+    orjson = None
+
+JSON_PRETTY = os.environ.get("JSON_PRETTY", "0").strip().lower() in ("1", "true", "yes")
+BACKEND = "orjson" if orjson is not None else "json"
+
+if orjson is not None:
+    _OPTS = orjson.OPT_NON_STR_KEYS   # chiavi non stringa convertite come fa json
+
+    def dumps_bytes(obj: Any, pretty: bool = False) -> bytes:
+        return orjson.dumps(obj, option=_OPTS | orjson.OPT_INDENT_2 if pretty else _OPTS)
+
+    def dumps(obj: Any, pretty: bool = False) -> str:
+        return dumps_bytes(obj, pretty).decode("utf-8")
+
+    loads = orjson.loads
+else:
+    def dumps(obj: Any, pretty: bool = False) -> str:
+        if pretty:
+            return json.dumps(obj, ensure_ascii=False, indent=2)
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    def dumps_bytes(obj: Any, pretty: bool = False) -> bytes:
+        return dumps(obj, pretty).encode("utf-8")
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+dumps.__doc__ = "JSON compatto (``pretty``: indentato di 2 spazi) come stringa."
+dumps_bytes.__doc__ = "Come ``dumps`` ma in bytes UTF-8, pronti per il file o la risposta HTTP."
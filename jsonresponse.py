@@ -0,0 +1,16 @@
+# jsonresponse.py
+"""Risposta FastAPI codificata con ``jsoncodec`` (orjson se installato)."""
+from fastapi.responses import JSONResponse
+
+from jsoncodec import dumps_bytes
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON codificato con ``jsoncodec`` (orjson se installato).
+
+    Gli endpoint con elenchi lunghi la restituiscono direttamente: così si
+    salta ``jsonable_encoder``, che altrimenti visita ogni dict della lista.
+    """
+
+    def render(self, content) -> bytes:
+        return dumps_bytes(content)
@@ -1,58 +1,91 @@
-from fastapi import FastAPI, HTTPException, Query, Header
+from fastapi import FastAPI, HTTPException, Query, Header, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from pydantic import BaseModel, EmailStr, ValidationError
+from typing import Optional, List, Callable
 from datetime import datetime, timezone, date, timedelta
 from zoneinfo import ZoneInfo
-import os, json, uuid, hashlib, re, shutil
+import os, json, uuid, hashlib, re, shutil, base64, csv, io, codecs, time, queue, threading
+from email.utils import format_datetime
 
 # servizi email
-from email_service import send_email, render_template  # render_template non usato ma ok importarlo
+from email_service import send_email, send_bulk, send_bulk_sync, close_pool
 # scheduler utils
-from utils_scheduler import load_last_run_date, save_last_run_now, _now_date
+from utils_scheduler import (load_last_run_date, save_last_run_date, CatchupCoordinator, CatchupBusy,
+                             EmbeddedScheduler, SCHEDULER_ENABLED)
+# archivio record in memoria
+from storage import (Backend, RecordStore, SentLog, HashIndex, SortedIndex, open_backend, RETRY_STATES,
+                     SENT_DIR, CachedDocStore, JsonDocStore)
+# coda di invio persistente
+from outbox import Outbox, OutboxWorkers
+from template_engine import render as render_template_text
+# lock tra processi (più worker uvicorn)
+from filelock import FileLock
+from jsoncodec import dumps, loads
+from jsonresponse import FastJSONResponse
+# retention del registro invii
+from retention import SENT_RETENTION, parse_policy, cutoffs, CompactionTimer
 
 APP_VERSION = "1.1.0"
-app = FastAPI(title="Damiano API", version=APP_VERSION)
+
+# hook di avvio/arresto registrati dalle varie sezioni (worker, scheduler...)
+_STARTUP_HOOKS, _SHUTDOWN_HOOKS = [], []
+
+@asynccontextmanager
+async def _lifespan(app):
+    for fn in _STARTUP_HOOKS:
+        fn()
+    yield
+    for fn in reversed(_SHUTDOWN_HOOKS):
+        fn()
+
+app = FastAPI(title="Damiano API", version=APP_VERSION, lifespan=_lifespan)
 
 # =========================
 #  STORAGE / CONFIG  (OK)
 # =========================
 
-def _load_json(path: str, default):
-    if not os.path.exists(path):
-        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(default, f, ensure_ascii=False, indent=2)
-        return default
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def _save_json(path: str, data):
-    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+JOURNAL_COMPACT_OPS = int(os.environ.get("JOURNAL_COMPACT_OPS", "1000"))
+# cache configurazione: ogni quanti secondi al massimo si controlla se il file è cambiato su disco
+CONFIG_CHECK_SECONDS = float(os.environ.get("CONFIG_CHECK_SECONDS", "1"))
 
 # file settings per ricordare la cartella scelta
 SETTINGS_PATH = os.environ.get("SETTINGS_PATH", "app_settings.json")
+_SETTINGS_DOCS = CachedDocStore(JsonDocStore(os.path.dirname(os.path.abspath(SETTINGS_PATH)),
+                                             paths={"app_settings": SETTINGS_PATH}), CONFIG_CHECK_SECONDS,
+                                lock=FileLock(SETTINGS_PATH + ".lock"))
 
 def _load_settings():
-    return _load_json(SETTINGS_PATH, {})
+    return _SETTINGS_DOCS.load("app_settings", {})
+
+def _save_settings(data: dict):
+    _SETTINGS_DOCS.save("app_settings", data)
 
 def get_data_dir() -> str:
     """Priorità: setting salvato -> ENV DATA_DIR -> 'data'"""
     s = _load_settings()
     return s.get("data_dir") or os.environ.get("DATA_DIR", "data")
 
+def get_storage_mode() -> str:
+    """json (file riscritto per intero a ogni modifica) | journal (log append-only + snapshot) | sqlite.
+    Priorità: setting salvato -> ENV STORAGE_MODE -> 'json'"""
+    s = _load_settings()
+    return (s.get("storage_mode") or os.environ.get("STORAGE_MODE", "json")).strip().lower()
+
 def _recompute_paths():
     """(Ri)calcola tutte le path quando cambia la cartella dati."""
-    global DATA_DIR, RECORDS_PATH, AUTH_PATH, EMAILS_PATH, EMAIL_SETTINGS_PATH, EMAIL_TEMPLATES_PATH
+    global DATA_DIR, STORAGE_MODE, RECORDS_PATH, AUTH_PATH, EMAILS_PATH, EMAIL_SETTINGS_PATH, EMAIL_TEMPLATES_PATH, _BACKEND
     DATA_DIR = get_data_dir()
+    STORAGE_MODE = get_storage_mode()
     os.makedirs(DATA_DIR, exist_ok=True)
     RECORDS_PATH = os.path.join(DATA_DIR, "records.json")
     AUTH_PATH = os.path.join(DATA_DIR, "auth.json")
     EMAILS_PATH = os.path.join(DATA_DIR, "sent_emails.json")
     EMAIL_SETTINGS_PATH = os.path.join(DATA_DIR, "email_settings.json")
     EMAIL_TEMPLATES_PATH = os.path.join(DATA_DIR, "email_templates.json")
+    _BACKEND = None  # verrà riaperto sulla nuova cartella
 
 # inizializza subito i percorsi
 _recompute_paths()
@@ -62,6 +95,14 @@ _recompute_paths()
 # =========================
 
 SCHEDULER_SECRET = os.environ.get("SCHEDULER_SECRET", "demo")
+# "inline": invio durante la richiesta | "queue": accodamento nell'outbox, invio dai worker
+MAIL_DELIVERY = os.environ.get("MAIL_DELIVERY", "inline").strip().lower()
+# catch-up: un invio fallito viene ritentato dai run successivi per questi giorni dal primo errore, poi si rinuncia
+CATCHUP_RETRY_DAYS = int(os.environ.get("CATCHUP_RETRY_DAYS", "3"))
+# catch-up a checkpoint: salvataggio ogni N invii (oltre che a fine giorno) e durata massima di un run (0 = nessuna)
+CATCHUP_CHECKPOINT_MESSAGES = int(os.environ.get("CATCHUP_CHECKPOINT_MESSAGES", "200"))
+CATCHUP_MAX_SECONDS = float(os.environ.get("CATCHUP_MAX_SECONDS", "0"))
+CATCHUP_STREAM_PING_SECONDS = float(os.environ.get("CATCHUP_STREAM_PING_SECONDS", "15"))   # keep-alive per i proxy
 TZ_ROME = ZoneInfo("Europe/Rome")
 
 def _now_iso():
@@ -73,23 +114,76 @@ def _sha(s: str) -> str:
 def _norm(s: Optional[str]) -> str:
     return (s or "").strip().lower()
 
+# ordinamenti di GET /records: chiave (valore, id) dell'indice, unica per record
+_RECORD_SORTS = {
+    "created_at": lambda r: (r.get("created_at") or "", r["id"]),
+    "nome": lambda r: (_norm(r.get("nome")), r["id"]),
+    "cognome": lambda r: (_norm(r.get("cognome")), r["id"]),
+    "prossima_ricorrenza": lambda r: (r.get("prossima_ricorrenza") or "", r["id"]),
+}
+# ordine del feed delle modifiche (GET /records/changes)
+_change_key = lambda r: (r.get("updated_at") or r.get("created_at") or "", r["id"])
+# campi che identificano un contatto: due record con gli stessi valori normalizzati sono duplicati
+_IDENTITY_FIELDS = ("nome", "cognome", "email", "telefono_numero", "def_nome", "def_cognome")
+# stessa persona e stesso defunto, recapiti eventualmente diversi: possibile duplicato
+_PERSON_FIELDS = ("nome", "cognome", "def_nome", "def_cognome")
+
+def _identity_key(r: dict, fields: tuple = _IDENTITY_FIELDS) -> str:
+    return hashlib.sha1("\x1f".join(_norm(r.get(f)) for f in fields).encode("utf-8")).hexdigest()
+
+RECORDS_PAGE_DEFAULT = int(os.environ.get("RECORDS_PAGE_DEFAULT", "100"))
+RECORDS_PAGE_MAX = int(os.environ.get("RECORDS_PAGE_MAX", "1000"))
+RECORDS_BULK_MAX = int(os.environ.get("RECORDS_BULK_MAX", "100000"))   # righe per import
+RECORDS_TOMBSTONE_DAYS = int(os.environ.get("RECORDS_TOMBSTONE_DAYS", "30"))   # record eliminati visibili nel feed
+FORECAST_MAX_DAYS = int(os.environ.get("FORECAST_MAX_DAYS", "1830"))   # orizzonte massimo della previsione invii
+
 # =========================
 #  INIT FILES  (OK)
 # =========================
 
+def get_backend() -> Backend:
+    """Backend di storage della cartella dati corrente (aperto al primo uso)."""
+    global _BACKEND
+    if _BACKEND is None:
+        # lambda: _normalize_record è definita più sotto (sezione record)
+        _BACKEND = open_backend(STORAGE_MODE, DATA_DIR, normalize=lambda r: _normalize_record(r),
+                                compact_every=JOURNAL_COMPACT_OPS, doc_check_every=CONFIG_CHECK_SECONDS)
+        # data di invio (prossima_ricorrenza - giorni_prima) -> id, per il catch-up
+        _BACKEND.records.add_index("send_date", SortedIndex(lambda r: _send_date_key(r)))
+        # controllo duplicati e ricerca dei possibili duplicati
+        _BACKEND.records.add_index("identity", HashIndex(lambda r: _identity_key(r)))
+        _BACKEND.records.add_index("person", HashIndex(lambda r: _identity_key(r, _PERSON_FIELDS)))
+        # paginazione/filtri di GET /records
+        for name, key in _RECORD_SORTS.items():
+            _BACKEND.records.add_index("sort_" + name, SortedIndex(key))
+        _BACKEND.records.add_index("sospendi", SortedIndex(
+            lambda r: (r.get("sospendi_invio") is True, r.get("created_at") or "", r["id"])))
+        _BACKEND.records.add_index("changes", SortedIndex(_change_key))
+        # previsione invii: (data di invio, ricorrenza) dei record attivi, o il motivo dell'esclusione
+        _BACKEND.records.add_index("forecast", SortedIndex(lambda r: _forecast_key(r)))
+    return _BACKEND
+
+def _close_backend():
+    global _BACKEND
+    if _BACKEND is not None:
+        _BACKEND.close()
+        _BACKEND = None
+
 def _ensure_auth():
-    data = _load_json(AUTH_PATH, {"password_sha": _sha("demo")})
+    docs = get_backend().docs
+    data = docs.load("auth", {"password_sha": _sha("demo")})
     if "password_sha" not in data:
         data["password_sha"] = _sha("demo")
-        _save_json(AUTH_PATH, data)
+        docs.save("auth", data)
     return data
 
 def _ensure_email_files():
-    _load_json(EMAIL_SETTINGS_PATH, {
+    docs = get_backend().docs
+    docs.load("email_settings", {
         "subject": "In memoria di {{NOME}} {{COGNOME}}",
         "body": "Gentile {{NOME}} {{COGNOME}},\nTi ricordiamo con affetto in questa ricorrenza."
     })
-    _load_json(EMAIL_TEMPLATES_PATH, {"subject": [], "body": []})
+    docs.load("email_templates", {"subject": [], "body": []})
 
 _ensure_auth()
 _ensure_email_files()
@@ -123,16 +217,21 @@ def _compute_first_ricorrenza(def_d: Optional[str]) -> Optional[str]:
         return None
     return _add_years_safe(gd, 1).isoformat()
 
-def _due_today(rec: dict, day: date) -> bool:
+def _send_date(rec: dict) -> Optional[date]:
+    """Giorno di invio: prossima_ricorrenza - giorni_prima (None se non calcolabile)."""
     pr = _parse_yyyy_mm_dd(rec.get("prossima_ricorrenza"))
     gp = rec.get("giorni_prima")
     if not pr or gp is None:
-        return False
+        return None
     try:
-        gp = int(gp)
-    except Exception:
-        return False
-    return (pr - timedelta(days=gp)) == day
+        return pr - timedelta(days=int(gp))
+    except (ValueError, TypeError, OverflowError):
+        # giorni_prima non numerico o fuori dal calendario (es. 1000000): nessuna data di invio
+        return None
+
+def _send_date_key(rec: dict) -> Optional[str]:
+    d = _send_date(rec)
+    return d.isoformat() if d else None
 
 def _parse_recipients(raw: Optional[str]) -> list[str]:
     if not raw:
@@ -148,23 +247,17 @@ def _parse_recipients(raw: Optional[str]) -> list[str]:
     return out
 
 def _fill_placeholders(text: str, rec: dict) -> str:
-    rep = {
-        "{{NOME}}": rec.get("nome") or "",
-        "{{COGNOME}}": rec.get("cognome") or "",
-        "{{DEF_NOME}}": rec.get("def_nome") or "",
-        "{{DEF_COGNOME}}": rec.get("def_cognome") or "",
-        "{{DATA_DEF}}": rec.get("def_data") or "",
-        "{{DATA_RIC}}": rec.get("prossima_ricorrenza") or "",
-    }
-    for k, v in rep.items():
-        text = (text or "").replace(k, v)
-    return text
+    # template compilato una volta e tenuto in cache (template_engine)
+    return render_template_text(text, rec)
 
-def _load_sent() -> list:
-    return _load_json(EMAILS_PATH, [])
+def get_sent_log() -> SentLog:
+    return get_backend().sent
+
+def _html_body(text: str) -> str:
+    return f"<div style='font-family:system-ui; white-space:pre-wrap'>{text}</div>"
 
-def _save_sent(rows: list):
-    _save_json(EMAILS_PATH, rows)
+def _load_sent() -> list:
+    return get_sent_log().rows()
 
 # =========================
 #  MODELS  (OK)
@@ -253,21 +346,21 @@ def send_test_email(to: str, x_secret: Optional[str] = Header(None)):
 
 # --- invio generico ---
 @app.post("/send-email")
-def send_email_generic(body: SendEmailIn, x_secret: Optional[str] = Header(None)):
+async def send_email_generic(body: SendEmailIn, x_secret: Optional[str] = Header(None)):
     if x_secret != SCHEDULER_SECRET:
         raise HTTPException(status_code=401, detail="Unauthorized")
     recipients = _parse_recipients(body.to)
     if not recipients:
         raise HTTPException(status_code=400, detail="Nessun indirizzo email valido in 'to'.")
-    sent, failed = [], []
-    for addr in recipients:
-        try:
-            html = f"<div style='font-family:system-ui; white-space:pre-wrap'>{body.message}</div>"
-            send_email(addr, body.subject, html, plain_fallback=body.message)
-            sent.append(addr)
-        except Exception as e:
-            failed.append({"to": addr, "error": str(e)})
-    return {"ok": len(failed) == 0, "sent": sent, "failed": failed}
+    html = _html_body(body.message)
+    messages = [{"to": addr, "subject": body.subject, "html": html, "plain": body.message} for addr in recipients]
+    if MAIL_DELIVERY == "queue":
+        # enqueue scrive su disco sotto lock: fuori dall'event loop
+        job_id = await run_in_threadpool(get_outbox().enqueue, messages)
+        return {"ok": True, "queued": recipients, "job_id": job_id}
+    # invio parallelo (SMTP_CONCURRENCY sessioni) con limite di quota SMTP_RATE_PER_SEC
+    res = await send_bulk(messages)
+    return {"ok": len(res["failed"]) == 0, "sent": res["sent"], "failed": res["failed"]}
 
 # --- invio immediato record (test=True non avanza) ---
 @app.post("/admin/send-now/{rid}")
@@ -279,8 +372,8 @@ def admin_send_now(
     if x_secret != SCHEDULER_SECRET:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    records = load_records()
-    rec = next((r for r in records if r.get("id") == rid), None)
+    store = get_records_store()
+    rec = store.get(rid)
     if not rec:
         raise HTTPException(status_code=404, detail="Record non trovato")
 
@@ -288,21 +381,34 @@ def admin_send_now(
     if not to_list:
         raise HTTPException(status_code=400, detail="Record senza email valida")
 
+    today = _today_rome_date().isoformat()
+    sent_log = get_sent_log()
+    state = sent_log.state(rid, today)
+    if not test and state is not None and state not in RETRY_STATES and state != "test":
+        # invio idempotente: per oggi questo record è già stato spedito (o è in coda)
+        return {"ok": True, "record_id": rid, "test": test, "already_sent": True}
+
     settings = load_email_settings()
     subject_raw = rec.get("oggetto") or (settings.get("subject") or "In memoria")
     body_raw    = rec.get("corpo")   or (settings.get("Body")    or settings.get("body") or "Un pensiero in questa ricorrenza.")
     subject = _fill_placeholders(subject_raw, rec)
     body    = _fill_placeholders(body_raw, rec)
 
-    try:
-        html = f"<div style='font-family:system-ui; white-space:pre-wrap'>{body}</div>"
-        send_email(to_list[0], subject, html, plain_fallback=body)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore invio: {e}")
+    job_id = None
+    if MAIL_DELIVERY == "queue":
+        job_id = get_outbox().enqueue([{
+            "to": to_list[0], "subject": subject, "html": _html_body(body), "plain": body,
+            "sent_ref": {"record_id": rid, "due_date": today}, "final_state": "test" if test else "ok",
+        }])
+        stato = "test" if test else "in_coda"
+    else:
+        try:
+            send_email(to_list[0], subject, _html_body(body), plain_fallback=body)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Errore invio: {e}")
+        stato = "test" if test else "ok"
 
-    sent_rows = _load_sent()
-    today = _today_rome_date().isoformat()
-    sent_rows.append({
+    sent_log.append([{
         "record_id": rid,
         "to": to_list,
         "subject": subject,
@@ -310,38 +416,72 @@ def admin_send_now(
         "scheduled_for": today,
         "due_date": today,
         "sent_at": _now_iso(),
-        "stato": "test" if test else "ok",
+        "stato": stato,
         "errore": None,
-    })
-    _save_sent(sent_rows)
+    }])
 
     if not test:
         pr = _parse_yyyy_mm_dd(rec.get("prossima_ricorrenza"))
         if pr:
-            rec["prossima_ricorrenza"] = _add_years_safe(pr, 1).isoformat()
-            save_records(records)
+            _advance_records([(rid, rec.get("prossima_ricorrenza"), _add_years_safe(pr, 1).isoformat())])
+
+    out = {"ok": True, "record_id": rid, "test": test}
+    if job_id:
+        out["job_id"] = job_id
+    return out
 
-    return {"ok": True, "record_id": rid, "test": test}
+def _advance_records(moves: list) -> int:
+    """Avanza ``prossima_ricorrenza`` per (id, valore letto, nuovo valore) in un'unica scrittura.
+
+    Confronta col valore attuale sotto lock: se nel frattempo un altro worker
+    (o un invio manuale) ha già avanzato o modificato il record, non lo tocca.
+    """
+    with get_records_store().transaction() as store:
+        recs = []
+        for rid, expected, new in moves:
+            cur = store.get(rid)
+            if cur is not None and cur.get("prossima_ricorrenza") == expected:
+                cur["prossima_ricorrenza"] = new
+                recs.append(cur)
+        if recs:
+            stamp = _change_stamp(store)
+            for cur in recs:
+                cur["updated_at"] = stamp
+        store.put_many(recs)
+        return len(recs)
 
 # --- catch-up ---
-def _already_sent(sent_log: list, record_id: Optional[str], due_date_iso: str) -> bool:
-    if not record_id:
-        return False
-    for e in sent_log:
-        if e.get("record_id") == record_id and e.get("due_date") == due_date_iso:
-            return True
-    return False
-
-def _date_range(d0: date, d1: date):
-    cur = d0
-    while cur <= d1:
-        yield cur
-        cur = cur + timedelta(days=1)
-
-def send_emails_catchup():
+def _first_failure(sent_log, rid: str, day_iso: str) -> Optional[str]:
+    """Giorno del primo tentativo fallito per (record, giorno dovuto), None se non registrato."""
+    rows, _ = sent_log.query(record_id=rid, stati=RETRY_STATES, day_from=day_iso, day_to=day_iso)
+    days = [r["failed_at"][:10] for r in rows if r.get("failed_at")]
+    return min(days) if days else None
+
+def send_emails_catchup(max_seconds: Optional[float] = None, progress: Optional[Callable[[dict], None]] = None):
+    """Invia le email dovute da last_run+1 a oggi, un giorno alla volta.
+
+    1. raccolta: dall'indice send_date si leggono i record del primo giorno dovuto;
+    2. invio: i messaggi del giorno insieme, in parallelo (send_bulk) oppure in outbox;
+    3. checkpoint: righe del registro, poi avanzamento delle ricorrenze (ognuno in
+       un'unica scrittura), poi il watermark (last_run) passa al giorno completato.
+    Il giorno successivo si rilegge dall'indice, che include i record appena
+    avanzati e ancora dovuti (fermi da più di un anno).
+    Un giorno con più di CATCHUP_CHECKPOINT_MESSAGES invii viene salvato a blocchi.
+    Se il run si interrompe (crash, timeout, limite ``max_seconds``) il successivo
+    riparte dal primo giorno non completato senza ripetere gli invii registrati.
+    Un invio fallito lascia il record fermo alla ricorrenza non spedita e il
+    watermark al giorno prima, per CATCHUP_RETRY_DAYS giorni dal primo errore
+    registrato (``failed_at`` delle righe "errore" del registro).
+
+    Con ``progress`` ogni esito (``item``) e ogni giorno completato (``day``)
+    viene passato alla callback invece di essere accumulato nel risultato, che
+    contiene allora solo i conteggi: la memoria non cresce con l'arretrato.
+    """
+    t0 = time.monotonic()
+    budget = CATCHUP_MAX_SECONDS if max_seconds is None else max_seconds
     today = _today_rome_date()
-    records = load_records()
-    sent_rows = _load_sent()
+    store = get_records_store()
+    sent_log = get_sent_log()
 
     settings = load_email_settings()
     default_subject = settings.get("subject") or "In memoria"
@@ -349,24 +489,106 @@ def send_emails_catchup():
 
     last_run_day = load_last_run_date()
     start_day = last_run_day + timedelta(days=1)
-
-    processed, skipped, errors = [], [], []
-
-    for day in _date_range(start_day, today):
-        day_iso = day.isoformat()
-        for r in records:
+    retry_from = (today - timedelta(days=CATCHUP_RETRY_DAYS)).isoformat()
+    start_iso, today_iso = start_day.isoformat(), today.isoformat()
+
+    counts = {"processed": 0, "skipped": 0, "errors": 0}
+    results = {"processed": [], "skipped": [], "errors": []}
+    hold = {}  # rid -> (ricorrenza da ritentare, giorno): primo invio fallito ancora nella finestra
+    # blocco corrente, svuotato a ogni checkpoint
+    records, orig_pr, pending = {}, {}, []
+    job_id = uuid.uuid4().hex if MAIL_DELIVERY == "queue" else None
+    queued = False
+
+    def report(kind: str, item: dict):
+        counts[kind] += 1
+        if progress is None:
+            results[kind].append(item)
+        else:
+            progress({"event": "item", "result": kind, **item})
+
+    def advance(r: dict):
+        pr = _parse_yyyy_mm_dd(r.get("prossima_ricorrenza"))
+        if not pr:
+            return
+        orig_pr.setdefault(r["id"], r.get("prossima_ricorrenza"))
+        r["prossima_ricorrenza"] = _add_years_safe(pr, 1).isoformat()
+        records[r["id"]] = r
+
+    def checkpoint(completed_day: Optional[str]):
+        """Invia il blocco corrente, lo salva e, a giorno completato, sposta il watermark."""
+        nonlocal queued
+        outcome = []
+        if pending:
+            if MAIL_DELIVERY == "queue":
+                get_outbox().enqueue([p["msg"] for p in pending], job_id=job_id)
+                queued = True
+                outcome = [None] * len(pending)
+            else:
+                outcome = send_bulk_sync([p["msg"] for p in pending])["errors"]
+
+            sent_at = _now_iso()
+            for p, err in zip(pending, outcome):
+                row = p["row"]
+                if err is None:
+                    row["stato"] = "in_coda" if MAIL_DELIVERY == "queue" else "ok"
+                    row["sent_at"] = sent_at
+                else:
+                    row["stato"] = "errore"
+                    row["errore"] = err
+                    row["failed_at"] = sent_at
+                    if (p["first_failed"] or today_iso) >= retry_from and p["id"] not in hold:
+                        hold[p["id"]] = (p["pr_before"], p["day"])
+                        records[p["id"]]["prossima_ricorrenza"] = p["pr_before"]
+
+            # prima il registro: dopo un crash tra le due scritture il run successivo trova
+            # l'invio registrato e riallinea la ricorrenza, senza rispedire né perdere l'invio
+            sent_log.append([p["row"] for p in pending])
+        if records:
+            # avanzamenti degli invii appena fatti e dei riallineamenti (anche senza nuovi invii)
+            _advance_records([(rid, orig_pr[rid], r["prossima_ricorrenza"])
+                              for rid, r in records.items() if r.get("prossima_ricorrenza") != orig_pr.get(rid)])
+        for p, err in zip(pending, outcome):
+            if err is None:
+                report("processed", {"id": p["id"], "to": p["to"], "due_date": p["day"]})
+            else:
+                report("errors", {"id": p["id"], "due_date": p["day"], "error": err})
+        records.clear()
+        orig_pr.clear()
+        pending.clear()
+        if completed_day is not None:
+            mark = date.fromisoformat(completed_day)
+            if hold:
+                mark = min(mark, date.fromisoformat(min(day for _, day in hold.values())) - timedelta(days=1))
+            save_last_run_date(mark)
+
+    complete = True
+    day_iso = None
+    while True:
+        # primo giorno dovuto dopo quello appena completato (l'indice è già aggiornato dal checkpoint)
+        nxt = store.range("send_date", start_iso, today_iso, limit=1, after=day_iso)
+        if not nxt:
+            break
+        day_iso = nxt[0][0]
+        done = set()
+        for _, r in store.range("send_date", day_iso, day_iso):
             try:
                 if r.get("sospendi_invio") is True:
                     continue
-                if not _due_today(r, day):
-                    continue
                 rid = r.get("id")
-                if _already_sent(sent_rows, rid, day_iso):
+                if rid in done or rid in hold:
+                    continue
+                state = sent_log.state(rid, day_iso)
+                first_failed = _first_failure(sent_log, rid, day_iso) if state in RETRY_STATES else None
+                if state is not None and state not in RETRY_STATES:
+                    # già spedito ma ricorrenza non avanzata (run precedente interrotto o con errori): si riallinea
+                    if state != "test":
+                        advance(r)
                     continue
 
                 to_list = _parse_recipients(r.get("email"))
                 if not to_list:
-                    skipped.append({"id": rid, "reason": "no_email", "due_date": day_iso})
+                    report("skipped", {"id": rid, "reason": "no_email", "due_date": day_iso})
                     continue
 
                 subject_raw = r.get("oggetto") or default_subject
@@ -374,8 +596,7 @@ def send_emails_catchup():
                 subject = _fill_placeholders(subject_raw, r)
                 body    = _fill_placeholders(body_raw, r)
 
-                # (qui potresti usare send_email per invio reale)
-                sent_rows.append({
+                row = {
                     "record_id": rid,
                     "to": to_list,
                     "subject": subject,
@@ -386,36 +607,226 @@ def send_emails_catchup():
                     "def_cognome": r.get("def_cognome"),
                     "scheduled_for": day_iso,
                     "due_date": day_iso,
-                    "sent_at": _now_iso(),
-                    "stato": "ok",
+                    "sent_at": None,
+                    "stato": None,
                     "errore": None,
-                })
-                processed.append({"id": rid, "to": to_list, "due_date": day_iso})
-
-                pr = _parse_yyyy_mm_dd(r.get("prossima_ricorrenza"))
-                if pr:
-                    r["prossima_ricorrenza"] = _add_years_safe(pr, 1).isoformat()
+                }
+                msg = {"to": to_list[0], "subject": subject, "html": _html_body(body), "plain": body,
+                       "sent_ref": {"record_id": rid, "due_date": day_iso}}
+                pending.append({"id": rid, "to": to_list, "day": day_iso, "first_failed": first_failed,
+                                "pr_before": r.get("prossima_ricorrenza"), "row": row, "msg": msg})
+                done.add(rid)
+                advance(r)
 
             except Exception as e:
-                errors.append({"id": r.get("id"), "due_date": day_iso, "error": str(e)})
+                report("errors", {"id": r.get("id"), "due_date": day_iso, "error": str(e)})
 
-    save_records(records)
-    _save_sent(sent_rows)
-    save_last_run_now()
+            if len(pending) >= CATCHUP_CHECKPOINT_MESSAGES:
+                checkpoint(None)
 
-    return {
-        "processed_range": [start_day.isoformat(), today.isoformat()],
-        "counts": {"processed": len(processed), "skipped": len(skipped), "errors": len(errors)},
-        "processed": processed,
-        "skipped": skipped,
-        "errors": errors,
+        checkpoint(day_iso)
+        if progress is not None:
+            progress({"event": "day", "day": day_iso, "counts": dict(counts)})
+        if budget and time.monotonic() - t0 >= budget and store.range("send_date", start_iso, today_iso, limit=1, after=day_iso):
+            complete = False
+            break
+
+    if complete:
+        checkpoint(today_iso)
+
+    out = {
+        "processed_range": [start_iso, today_iso],
+        "complete": complete,
+        "counts": counts,
     }
+    if progress is None:
+        out.update(results)
+    if not complete:
+        out["resume_from"] = (load_last_run_date() + timedelta(days=1)).isoformat()
+    if queued:
+        out["job_id"] = job_id
+    return out
+
+# un solo catch-up alla volta (cron + trigger manuale, più worker): gli altri si agganciano
+_CATCHUP = CatchupCoordinator()
+
+def _catchup_stream(fmt: str):
+    """Esegue il catch-up in un thread e ne restituisce gli eventi man mano (NDJSON o SSE).
+
+    Gli eventi passano da una coda limitata: se il client legge lentamente il
+    catch-up attende, se si disconnette il run prosegue e gli eventi si scartano.
+    """
+    events: queue.Queue = queue.Queue(maxsize=1000)
+    closed = threading.Event()
+    end = object()
+
+    def emit(ev):
+        while not closed.is_set():
+            try:
+                events.put(ev, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def run():
+        try:
+            res = _CATCHUP.run(lambda: send_emails_catchup(progress=emit))
+            emit({"event": "summary", **res})
+        except CatchupBusy as e:
+            emit({"event": "error", "status": 409,
+                  "detail": f"Catch-up già in corso ({e.lease.get('owner')}), riprova più tardi"})
+        except Exception as e:
+            emit({"event": "error", "status": 500, "detail": str(e)})
+        finally:
+            emit(end)
+
+    def encode(ev: dict) -> str:
+        if fmt == "sse":
+            return f"event: {ev['event']}\ndata: {dumps(ev)}\n\n"
+        return dumps(ev) + "\n"
+
+    def gen():
+        try:
+            while True:
+                try:
+                    ev = events.get(timeout=CATCHUP_STREAM_PING_SECONDS)
+                except queue.Empty:
+                    yield ": ping\n\n" if fmt == "sse" else encode({"event": "ping"})
+                    continue
+                if ev is end:
+                    return
+                yield encode(ev)
+        finally:
+            closed.set()
+
+    threading.Thread(target=run, name="catchup-stream", daemon=True).start()
+    media = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+    return StreamingResponse(gen(), media_type=media,
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.post("/admin/catchup")
-def run_catchup(x_secret: Optional[str] = Header(None)):
+def run_catchup(x_secret: Optional[str] = Header(None), stream: Optional[str] = Query(None)):
+    """Catch-up degli invii. ``stream=ndjson|sse``: avanzamento in diretta.
+
+    In streaming arrivano un evento ``item`` per ogni esito (processed /
+    skipped / errors), un ``day`` per ogni giorno completato e alla fine
+    ``summary`` con i conteggi (o ``error``).
+    """
+    if x_secret != SCHEDULER_SECRET:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if stream is not None:
+        if stream not in ("ndjson", "sse"):
+            raise HTTPException(status_code=400, detail="Formato non supportato (ndjson | sse)")
+        return _catchup_stream(stream)
+    try:
+        return _CATCHUP.run(send_emails_catchup)
+    except CatchupBusy as e:
+        raise HTTPException(status_code=409, detail=f"Catch-up già in corso ({e.lease.get('owner')}), riprova più tardi")
+
+# --- SCHEDULER INTERNO (opzionale, SCHEDULER_ENABLED=1) ---
+def _next_due_day(day: date) -> Optional[date]:
+    """Primo giorno >= day con almeno un invio dovuto (record non sospesi)."""
+    hit = get_records_store().range("send_date", day.isoformat(), limit=1,
+                                    where=lambda r: r.get("sospendi_invio") is not True)
+    return date.fromisoformat(hit[0][0]) if hit else None
+
+_SCHEDULER = EmbeddedScheduler(lambda: _CATCHUP.run(send_emails_catchup), _next_due_day)
+if SCHEDULER_ENABLED:
+    _STARTUP_HOOKS.append(_SCHEDULER.start)
+    _SHUTDOWN_HOOKS.append(_SCHEDULER.stop)
+
+@app.get("/admin/scheduler")
+def admin_scheduler(x_secret: Optional[str] = Header(None)):
+    """Prossimo run pianificato, durata ed esito dell'ultimo, lease del catch-up in corso."""
+    if x_secret != SCHEDULER_SECRET:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    out = {"enabled": SCHEDULER_ENABLED, **_SCHEDULER.status(), "lease": _CATCHUP.lease()}
+    if not SCHEDULER_ENABLED:
+        # anche senza thread: quando partirebbe
+        nxt = _SCHEDULER.plan()
+        out["next_run"] = nxt.isoformat() if nxt else None
+    return out
+
+# --- OUTBOX (coda di invio) ---
+_OUTBOX = None
+
+def get_outbox() -> Outbox:
+    global _OUTBOX
+    store = get_backend().outbox
+    if _OUTBOX is None or _OUTBOX.store is not store:
+        _OUTBOX = Outbox(store)
+    return _OUTBOX
+
+def _on_outbox_result(msg: dict, stato: str, errore: Optional[str]):
+    """Riporta l'esito finale di un messaggio in coda sulla riga del registro invii."""
+    ref = msg.get("sent_ref")
+    if not ref:
+        return
+    fields = {"stato": stato, "errore": errore}
+    fields["failed_at" if stato == "errore" else "sent_at"] = _now_iso()
+    get_sent_log().update(ref["record_id"], ref["due_date"], fields)
+
+_OUTBOX_WORKERS = OutboxWorkers(get_outbox, lambda to, subj, html, plain: send_email(to, subj, html, plain_fallback=plain),
+                                on_result=_on_outbox_result)
+
+if MAIL_DELIVERY == "queue":
+    _STARTUP_HOOKS.append(_OUTBOX_WORKERS.start)
+    _SHUTDOWN_HOOKS.append(_OUTBOX_WORKERS.stop)
+_SHUTDOWN_HOOKS.append(close_pool)
+
+@app.get("/emails/jobs/{job_id}")
+def email_job_status(job_id: str, x_secret: Optional[str] = Header(None)):
+    if x_secret != SCHEDULER_SECRET:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    items = get_outbox().job(job_id)
+    if not items:
+        raise HTTPException(status_code=404, detail="Job non trovato")
+    counts = {}
+    for m in items:
+        counts[m["status"]] = counts.get(m["status"], 0) + 1
+    return {
+        "job_id": job_id,
+        "done": all(m["status"] in ("ok", "errore") for m in items),
+        "counts": counts,
+        "items": [{k: m.get(k) for k in ("id", "to", "status", "attempts", "last_error", "next_attempt_at", "updated_at")}
+                  for m in items],
+    }
+
+@app.get("/admin/outbox")
+def admin_outbox(x_secret: Optional[str] = Header(None)):
+    if x_secret != SCHEDULER_SECRET:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return {"delivery": MAIL_DELIVERY, "counts": get_outbox().counts()}
+
+# --- RETENTION REGISTRO INVII ---
+SENT_RETENTION_POLICY = parse_policy(SENT_RETENTION)
+
+def compact_sent_log() -> dict:
+    """Archivia (gzip) le righe del registro oltre la retention del loro stato."""
+    res = get_sent_log().compact(cutoffs(SENT_RETENTION_POLICY, _today_rome_date()))
+    res["policy_days"] = SENT_RETENTION_POLICY
+    return res
+
+_SENT_COMPACTION = CompactionTimer(compact_sent_log)
+if SENT_RETENTION_POLICY:   # senza SENT_RETENTION il registro si conserva per intero
+    _STARTUP_HOOKS.append(_SENT_COMPACTION.start)
+    _SHUTDOWN_HOOKS.append(_SENT_COMPACTION.stop)
+
+@app.get("/admin/sent-log")
+def admin_sent_log_stats(x_secret: Optional[str] = Header(None)):
+    if x_secret != SCHEDULER_SECRET:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return {"policy_days": SENT_RETENTION_POLICY, "sizes": get_sent_log().sizes(),
+            "last_compaction": _SENT_COMPACTION.last_result}
+
+@app.post("/admin/sent-log/compact")
+def admin_compact_sent_log(x_secret: Optional[str] = Header(None)):
+    """Compattazione immediata; riporta le dimensioni prima e dopo."""
     if x_secret != SCHEDULER_SECRET:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    return send_emails_catchup()
+    res = compact_sent_log()
+    _SENT_COMPACTION.last_result = res
+    return res
 
 # --- ADMIN STORAGE (nuovo) ---
 @app.get("/admin/storage")
@@ -443,8 +854,12 @@ def admin_set_storage(body: StorageIn, x_secret: Optional[str] = Header(None)):
         raise HTTPException(status_code=400, detail=f"Impossibile creare cartella: {e}")
 
     old_dir = DATA_DIR
+    _close_backend()  # chiude log/connessioni (checkpoint SQLite) prima della copia
     if os.path.isdir(old_dir) and os.path.abspath(old_dir) != new_dir:
-        for name in ["records.json", "auth.json", "sent_emails.json", "email_settings.json", "email_templates.json"]:
+        for name in ["records.json", "auth.json", "sent_emails.json", "email_settings.json", "email_templates.json",
+                     "records.snapshot.json", "records.wal", "sent_emails.snapshot.json", "sent_emails.wal", "sent_emails.keys",
+                     "outbox.json", "outbox.snapshot.json", "outbox.wal",
+                     "record_tombstones.json", "damiano.sqlite3"]:
             src = os.path.join(old_dir, name)
             dst = os.path.join(new_dir, name)
             if os.path.exists(src) and not os.path.exists(dst):
@@ -452,10 +867,18 @@ def admin_set_storage(body: StorageIn, x_secret: Optional[str] = Header(None)):
                     shutil.copy2(src, dst)
                 except Exception:
                     pass
+        # segmenti mensili del registro invii
+        src, dst = os.path.join(old_dir, SENT_DIR), os.path.join(new_dir, SENT_DIR)
+        if os.path.isdir(src) and not os.path.exists(dst):
+            try:
+                shutil.copytree(src, dst)
+            except Exception:
+                pass
 
-    s = _load_settings()
-    s["data_dir"] = new_dir
-    _save_json(SETTINGS_PATH, s)
+    with _SETTINGS_DOCS.locked():
+        s = _load_settings()
+        s["data_dir"] = new_dir
+        _save_settings(s)
 
     _recompute_paths()
     _ensure_email_files()
@@ -465,27 +888,47 @@ def admin_set_storage(body: StorageIn, x_secret: Optional[str] = Header(None)):
 #  HELPERS RECORDS & CRUD
 # =========================
 
-def load_records() -> List[dict]:
-    data = _load_json(RECORDS_PATH, [])
+def _normalize_record(r: dict) -> bool:
+    """Completa i campi mancanti di un record letto da disco; True se modificato."""
     changed = False
-    for r in data:
-        if not r.get("id"):
-            r["id"] = uuid.uuid4().hex; changed = True
-        if not r.get("created_at"):
-            r["created_at"] = _now_iso(); changed = True
-        if not r.get("updated_at"):
-            r["updated_at"] = r["created_at"]; changed = True
-        if not r.get("prossima_ricorrenza") and r.get("def_data"):
-            pr = _compute_first_ricorrenza(r.get("def_data"))
-            if pr:
-                r["prossima_ricorrenza"] = pr
-                changed = True
-    if changed:
-        _save_json(RECORDS_PATH, data)
-    return data
+    if not r.get("id"):
+        r["id"] = uuid.uuid4().hex; changed = True
+    if not r.get("created_at"):
+        r["created_at"] = _now_iso(); changed = True
+    if not r.get("updated_at"):
+        r["updated_at"] = r["created_at"]; changed = True
+    if not r.get("prossima_ricorrenza") and r.get("def_data"):
+        pr = _compute_first_ricorrenza(r.get("def_data"))
+        if pr:
+            r["prossima_ricorrenza"] = pr
+            changed = True
+    return changed
+
+def get_records_store() -> RecordStore:
+    """Store residente dei record; i dati vengono letti (e migrati) una volta sola."""
+    return get_backend().records
+
+def load_records() -> List[dict]:
+    return get_records_store().all()
+
+# --- feed delle modifiche ---
+_TOMBSTONES_DOC = "record_tombstones"   # {"pruned_before": ts, "items": [{"id", "deleted_at"}]}
+
+def _load_tombstones() -> dict:
+    return get_backend().docs.load(_TOMBSTONES_DOC, {"pruned_before": None, "items": []})
+
+def _change_stamp(store: RecordStore) -> str:
+    """``updated_at`` di una modifica: l'ora UTC, ma sempre dopo l'ultima modifica registrata.
 
-def save_records(data: List[dict]):
-    _save_json(RECORDS_PATH, data)
+    Da chiamare dentro ``store.transaction()``: il cursore del feed resta
+    monotono anche se gli orologi dei worker non sono allineati.
+    """
+    now = datetime.now(timezone.utc).isoformat(timespec="microseconds")
+    tomb = _load_tombstones()["items"]
+    last = max((store.last_key("changes") or ("",))[0], tomb[-1]["deleted_at"] if tomb else "")
+    if now > last:
+        return now
+    return (datetime.fromisoformat(last) + timedelta(microseconds=1)).isoformat(timespec="microseconds")
 
 # --- AUTH ---
 @app.post("/auth/login", response_model=LoginResponse)
@@ -497,82 +940,596 @@ def login(body: LoginRequest):
 
 @app.post("/auth/change-password")
 def change_password(body: ChangePassword):
-    auth = _ensure_auth()
-    if _sha(body.old_password) != auth.get("password_sha"):
-        raise HTTPException(status_code=401, detail="Password attuale errata")
-    if not re.match(r"^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[^A-Za-z0-9])\S{8,}$", body.new_password):
-        raise HTTPException(status_code=400, detail="Password non conforme alla policy")
-    auth["password_sha"] = _sha(body.new_password)
-    _save_json(AUTH_PATH, auth)
-    return {"ok": True}
+    with get_backend().docs.locked():
+        auth = _ensure_auth()
+        if _sha(body.old_password) != auth.get("password_sha"):
+            raise HTTPException(status_code=401, detail="Password attuale errata")
+        if not re.match(r"^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[^A-Za-z0-9])\S{8,}$", body.new_password):
+            raise HTTPException(status_code=400, detail="Password non conforme alla policy")
+        auth["password_sha"] = _sha(body.new_password)
+        get_backend().docs.save("auth", auth)
+        return {"ok": True}
 
 # --- RECORDS CRUD ---
+def _encode_cursor(index: str, key: tuple) -> str:
+    raw = json.dumps({"i": index, "k": list(key)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str, index: str) -> tuple:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if data["i"] != index:
+            raise ValueError(data["i"])
+        return tuple(data["k"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursore non valido")
+
+# --- risposte JSON veloci (FastJSONResponse, vedi jsonresponse.py) ---
+_CACHE_HEADERS = ("etag", "last-modified", "cache-control")
+
+def _fast_json(content, response: Optional[Response] = None) -> FastJSONResponse:
+    """Risposta già codificata; riporta gli header di cache impostati da ``_not_modified``."""
+    headers = {k: v for k, v in response.headers.items() if k in _CACHE_HEADERS} if response is not None else None
+    return FastJSONResponse(content, headers=headers)
+
+# --- GET condizionali (ETag / 304) ---
+_VERSION_SEEN: dict[str, tuple] = {}   # collezione -> (versione, prima volta vista da questo processo)
+
+def _not_modified(request: Request, response: Response, name: str, version) -> Optional[Response]:
+    """ETag e Last-Modified dalla versione della collezione; 304 se il client ha già questa versione.
+
+    La versione viene dallo storage (firma dei file o contatore SQLite) e si
+    legge prima dei dati: con ``If-None-Match`` uguale non si carica né si
+    serializza nulla. L'ETag tiene conto anche di cartella, modalità e query.
+    """
+    raw = repr((STORAGE_MODE, DATA_DIR, name, version, request.url.query))
+    etag = '"' + hashlib.sha1(raw.encode("utf-8")).hexdigest()[:24] + '"'
+    seen = _VERSION_SEEN.get(name)
+    if seen is None or seen[0] != version:
+        seen = _VERSION_SEEN[name] = (version, datetime.now(timezone.utc))
+    headers = {"ETag": etag, "Last-Modified": format_datetime(seen[1], usegmt=True), "Cache-Control": "no-cache"}
+    inm = request.headers.get("if-none-match")
+    if inm and (inm.strip() == "*" or etag in (t.strip().removeprefix("W/") for t in inm.split(","))):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
 @app.get("/records")
-def list_records():
-    return load_records()
+def list_records(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=RECORDS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    offset: int = Query(0, ge=0),
+    sort: Optional[str] = None,
+    nome: Optional[str] = None,              # prefisso, senza distinzione maiuscole/minuscole
+    cognome: Optional[str] = None,           # idem
+    sospendi_invio: Optional[bool] = None,
+    ricorrenza_da: Optional[str] = None,     # YYYY-MM-DD, inclusa
+    ricorrenza_a: Optional[str] = None,      # YYYY-MM-DD, inclusa
+    fields: Optional[str] = None,            # es. "nome,cognome,prossima_ricorrenza" (id sempre incluso)
+):
+    """Elenco record.
+
+    Senza parametri ritorna tutti i record, come sempre. Con ``limit``, ``cursor``
+    o ``offset`` ritorna una pagina ``{"items", "next_cursor"}``: ``next_cursor``
+    va ripassato (con gli stessi filtri) per la pagina successiva.
+    Le pagine si leggono dagli indici ordinati dello store. Supporta ``If-None-Match``.
+    """
+    hit = _not_modified(request, response, "records", get_records_store().version())
+    if hit is not None:
+        return hit
+    paged = limit is not None or cursor is not None or offset > 0
+    if not paged and not sort and not fields and all(
+            v is None for v in (nome, cognome, sospendi_invio, ricorrenza_da, ricorrenza_a)):
+        return _fast_json(load_records(), response)
+
+    for d in (ricorrenza_da, ricorrenza_a):
+        if d is not None and not _parse_yyyy_mm_dd(d):
+            raise HTTPException(status_code=400, detail="Data non valida (usa YYYY-MM-DD)")
+    p_nome, p_cognome = _norm(nome), _norm(cognome)
+
+    def where(r: dict) -> bool:
+        if p_nome and not _norm(r.get("nome")).startswith(p_nome):
+            return False
+        if p_cognome and not _norm(r.get("cognome")).startswith(p_cognome):
+            return False
+        if sospendi_invio is not None and (r.get("sospendi_invio") is True) != sospendi_invio:
+            return False
+        if ricorrenza_da or ricorrenza_a:
+            pr = r.get("prossima_ricorrenza") or ""
+            if not pr or (ricorrenza_da and pr < ricorrenza_da) or (ricorrenza_a and pr > ricorrenza_a):
+                return False
+        return True
+
+    # indice da scorrere: quello dell'ordinamento, o in mancanza il filtro più selettivo
+    if sort is None:
+        sort = ("cognome" if p_cognome else "nome" if p_nome else
+                "prossima_ricorrenza" if (ricorrenza_da or ricorrenza_a) else None)
+    if sort is not None and sort not in _RECORD_SORTS:
+        raise HTTPException(status_code=400, detail="Ordinamento non valido")
+    lo = hi = None
+    if sort == "nome" and p_nome:
+        lo, hi = (p_nome,), (p_nome + "\uffff",)
+    elif sort == "cognome" and p_cognome:
+        lo, hi = (p_cognome,), (p_cognome + "\uffff",)
+    elif sort == "prossima_ricorrenza" and (ricorrenza_da or ricorrenza_a):
+        lo, hi = (ricorrenza_da or "0",), ((ricorrenza_a or "9") + "\uffff",)
+    if sort is None and sospendi_invio is not None:
+        index = "sospendi"
+        lo, hi = (sospendi_invio,), (sospendi_invio, "\uffff")
+    else:
+        index = "sort_" + (sort or "created_at")
+
+    after = _decode_cursor(cursor, index) if cursor else None
+    size = limit or (RECORDS_PAGE_DEFAULT if paged else None)
+    rows = get_records_store().range(index, lo, hi, after=after, where=where,
+                                     limit=None if size is None else offset + size + 1)
+    rows = rows[offset:]
+
+    keep = None
+    if fields:
+        keep = {f.strip() for f in fields.split(",") if f.strip()} | {"id"}
+    def project(r: dict) -> dict:
+        return r if keep is None else {k: v for k, v in r.items() if k in keep}
+
+    if not paged:
+        return _fast_json([project(r) for _, r in rows], response)
+    page = rows[:size]
+    next_cursor = _encode_cursor(index, page[-1][0]) if len(rows) > size else None
+    return _fast_json({"items": [project(r) for _, r in page], "next_cursor": next_cursor}, response)
+
+@app.get("/records/duplicates")
+def find_duplicate_records(by: str = Query("identita")):
+    """Gruppi di possibili duplicati, per la pulizia dei dati.
+
+    ``identita``: tutti i campi del controllo duplicati coincidono;
+    ``persona``: stessi nome/cognome e defunto, recapiti anche diversi.
+    """
+    index = {"identita": "identity", "persona": "person"}.get(by)
+    if index is None:
+        raise HTTPException(status_code=400, detail="Criterio non valido (identita | persona)")
+    groups = get_records_store().groups(index)
+    groups.sort(key=lambda g: (-len(g), _norm(g[0].get("cognome")), _norm(g[0].get("nome"))))
+    return _fast_json({"by": by, "count": len(groups), "groups": groups})
+
+# --- IMPORT / EXPORT ---
+_TRUE = ("1", "true", "si", "sì", "yes", "x")
+
+async def _bulk_rows(request: Request, fmt: str):
+    """Righe (n, dict) lette dal corpo in streaming: NDJSON o CSV con intestazione."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buf, pending, header, n = "", "", None, 0
+
+    def parse(text: str):
+        nonlocal header, n
+        if fmt == "ndjson":
+            if not text.strip():
+                return None
+            n += 1
+            try:
+                row = loads(text)
+            except ValueError as e:
+                return n, ValueError(f"JSON non valido: {e}")
+            return n, row if isinstance(row, dict) else ValueError("la riga non è un oggetto JSON")
+        values = next(csv.reader([text]), [])
+        if header is None:
+            header = [h.strip() for h in values]
+            return None
+        if not any(v.strip() for v in values):
+            return None
+        n += 1
+        return n, dict(zip(header, values))
+
+    async def lines():
+        nonlocal buf
+        async for chunk in request.stream():
+            buf += decoder.decode(chunk)
+            *complete, buf = buf.split("\n")
+            for line in complete:
+                yield line + "\n"
+        buf += decoder.decode(b"", final=True)
+        if buf:
+            yield buf
+
+    async for line in lines():
+        if fmt == "csv":
+            # un record CSV può andare a capo dentro un campo tra virgolette
+            pending += line
+            if pending.count('"') % 2:
+                continue
+            line, pending = pending, ""
+        item = parse(line.rstrip("\r\n") if fmt == "ndjson" else line)
+        if item is not None:
+            yield item
+    if pending:
+        item = parse(pending)
+        if item is not None:
+            yield item
+
+def _csv_to_record_fields(row: dict) -> dict:
+    """Valori CSV (stringhe) -> campi di Record: vuoto = assente."""
+    out = {}
+    for k, v in row.items():
+        if k not in Record.model_fields or v is None:
+            continue
+        v = v.strip()
+        if v == "":
+            continue
+        out[k] = v.lower() in _TRUE if k == "sospendi_invio" else v
+    return out
+
+def _commit_bulk(objs: list) -> tuple[list, list]:
+    """Scarta duplicati e id già presenti (anche tra righe dello stesso file), poi scrive tutto in un'unica operazione."""
+    inserted, errors, seen, seen_ids = [], [], set(), set()
+    with get_records_store().transaction() as store:
+        for n, obj in objs:
+            key = _identity_key(obj)
+            if key in seen or store.lookup("identity", key):
+                errors.append({"row": n, "error": "Contatto duplicato"})
+                continue
+            if obj["id"] in seen_ids:
+                errors.append({"row": n, "error": "id ripetuto nel file"})
+                continue
+            if store.get(obj["id"]) is not None:
+                errors.append({"row": n, "error": "id già esistente"})
+                continue
+            seen.add(key)
+            seen_ids.add(obj["id"])
+            inserted.append(obj)
+        if inserted:
+            stamp = _change_stamp(store)
+            for obj in inserted:
+                obj["updated_at"] = stamp
+        store.put_many(inserted)
+    return inserted, errors
+
+@app.post("/records/bulk")
+async def bulk_import_records(request: Request, format: Optional[str] = Query(None)):
+    """Import massivo da NDJSON (un record JSON per riga) o CSV con intestazione.
+
+    Ogni riga è validata con ``Record`` e confrontata con i contatti esistenti;
+    le righe valide vengono scritte insieme, per le altre si riporta l'errore.
+    Il formato si deduce dal Content-Type se ``format`` non è indicato.
+    """
+    fmt = (format or "").lower()
+    if not fmt:
+        ctype = request.headers.get("content-type", "")
+        fmt = "csv" if "csv" in ctype else "ndjson"
+    if fmt not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Formato non supportato (ndjson | csv)")
+
+    now = _now_iso()
+    objs, errors, received = [], [], 0
+    async for n, row in _bulk_rows(request, fmt):
+        received = n
+        if received > RECORDS_BULK_MAX:
+            raise HTTPException(status_code=413, detail=f"Troppe righe (massimo {RECORDS_BULK_MAX})")
+        if isinstance(row, Exception):
+            errors.append({"row": n, "error": str(row)})
+            continue
+        try:
+            rec = Record(**(_csv_to_record_fields(row) if fmt == "csv" else row))
+        except (ValidationError, TypeError) as e:
+            msg = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()) \
+                if isinstance(e, ValidationError) else str(e)
+            errors.append({"row": n, "error": msg})
+            continue
+        obj = rec.model_dump()
+        obj["id"] = obj.get("id") or uuid.uuid4().hex
+        obj["created_at"] = obj.get("created_at") or now
+        obj["updated_at"] = now
+        if not obj.get("prossima_ricorrenza"):
+            obj["prossima_ricorrenza"] = _compute_first_ricorrenza(obj.get("def_data"))
+        objs.append((n, obj))
+
+    inserted, dup_errors = await run_in_threadpool(_commit_bulk, objs)
+    if inserted:
+        _SCHEDULER.notify()
+    errors = sorted(errors + dup_errors, key=lambda e: e["row"])
+    return {"received": received, "inserted": len(inserted), "errors": errors}
+
+def _export_chunks(chunk: int = 500):
+    """Record in ordine di creazione, letti dall'indice a blocchi di ``chunk``."""
+    store, after = get_records_store(), None
+    while True:
+        rows = store.range("sort_created_at", after=after, limit=chunk)
+        if not rows:
+            return
+        yield [r for _, r in rows]
+        after = rows[-1][0]
+
+@app.get("/records/export")
+def export_records(format: str = Query("ndjson")):
+    """Esporta tutti i record in streaming (NDJSON o CSV), senza costruire l'elenco completo."""
+    fmt = format.lower()
+    if fmt == "ndjson":
+        def gen():
+            for recs in _export_chunks():
+                yield "".join(dumps(r) + "\n" for r in recs)
+        media = "application/x-ndjson"
+    elif fmt == "csv":
+        columns = list(Record.model_fields)
+        def gen():
+            out = io.StringIO()
+            w = csv.DictWriter(out, fieldnames=columns, extrasaction="ignore")
+            w.writeheader()
+            for recs in _export_chunks():
+                w.writerows(recs)
+                yield out.getvalue()
+                out.seek(0)
+                out.truncate()
+            yield out.getvalue()
+        media = "text/csv; charset=utf-8"
+    else:
+        raise HTTPException(status_code=400, detail="Formato non supportato (ndjson | csv)")
+    return StreamingResponse(gen(), media_type=media,
+                             headers={"Content-Disposition": f'attachment; filename="records.{fmt}"'})
+
+@app.get("/records/changes")
+def records_changes(
+    since: Optional[str] = None,
+    limit: int = Query(RECORDS_PAGE_DEFAULT, ge=1, le=RECORDS_PAGE_MAX),
+):
+    """Record creati, modificati o eliminati dopo il cursore ``since``, in ordine di modifica.
+
+    Senza ``since`` si parte dall'inizio (sincronizzazione completa). Ritorna
+    ``items`` (record attuali), ``deleted`` (id eliminati), ``next_cursor`` per
+    la chiamata successiva e ``has_more``. Un cursore più vecchio delle
+    tombstone conservate (RECORDS_TOMBSTONE_DAYS) riceve 410: il client deve
+    ricaricare l'elenco completo.
+    """
+    after = _decode_cursor(since, "changes") if since else None
+    store = get_records_store()
+    with store.snapshot():
+        # tombstone e record letti sotto lo stesso lock: le eliminazioni li scrivono insieme
+        get_backend().docs.invalidate(_TOMBSTONES_DOC)
+        tomb = _load_tombstones()
+        changed = store.range("changes", after=after, limit=limit + 1)
+    # un cursore fermo proprio sull'ultima tombstone scartata non ha perso nulla
+    if after is not None and tomb["pruned_before"] and after[0] < tomb["pruned_before"]:
+        raise HTTPException(status_code=410, detail="Cursore scaduto, ricaricare l'elenco completo")
+
+    merged = [(k, r, None) for k, r in changed]
+    if after is not None:
+        merged += [((t["deleted_at"], t["id"]), None, t["id"]) for t in tomb["items"]
+                   if (t["deleted_at"], t["id"]) > after]
+    merged.sort(key=lambda m: m[0])
+    page = merged[:limit]
+    return _fast_json({
+        "items": [r for _, r, _ in page if r is not None],
+        "deleted": [rid for _, _, rid in page if rid is not None],
+        "next_cursor": _encode_cursor("changes", page[-1][0]) if page else since,
+        "has_more": len(merged) > limit,
+    })
 
 @app.get("/records/{rid}")
 def read_record(rid: str):
-    data = load_records()
-    for r in data:
-        if r["id"] == rid:
-            return r
-    raise HTTPException(status_code=404, detail="Not found")
+    r = get_records_store().get(rid)
+    if r is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    return r
 
 @app.post("/records")
 def create_record(rec: Record):
-    data = load_records()
     now = _now_iso()
-
-    for r in data:
-        if (_norm(r.get("nome")) == _norm(rec.nome) and
-            _norm(r.get("cognome")) == _norm(rec.cognome) and
-            _norm(r.get("email")) == _norm(rec.email) and
-            _norm(r.get("telefono_numero")) == _norm(rec.telefono_numero) and
-            _norm(r.get("def_nome")) == _norm(rec.def_nome) and
-            _norm(r.get("def_cognome")) == _norm(rec.def_cognome)):
-            raise HTTPException(status_code=409, detail="Contatto duplicato")
-
     obj = rec.model_dump()
     obj["id"] = uuid.uuid4().hex
     obj["created_at"] = now
     obj["updated_at"] = now
     if not obj.get("prossima_ricorrenza"):
         obj["prossima_ricorrenza"] = _compute_first_ricorrenza(obj.get("def_data"))
-    data.append(obj)
-    save_records(data)
-    return obj
+
+    with get_records_store().transaction() as store:
+        if store.lookup("identity", _identity_key(obj)):
+            raise HTTPException(status_code=409, detail="Contatto duplicato")
+        obj["updated_at"] = _change_stamp(store)
+        out = store.put(obj)
+    _SCHEDULER.notify()
+    return out
 
 @app.put("/records/{rid}")
 def update_record(rid: str, rec: Record):
-    data = load_records()
-    for i, r in enumerate(data):
-        if r["id"] == rid:
-            updated = r.copy()
-            incoming = rec.model_dump()
-            incoming["id"] = rid
-            updated.update(incoming)
-            if incoming.get("def_data") != r.get("def_data"):
-                updated["prossima_ricorrenza"] = _compute_first_ricorrenza(incoming.get("def_data"))
-            updated["updated_at"] = _now_iso()
-            data[i] = updated
-            save_records(data)
-            return updated
-    raise HTTPException(status_code=404, detail="Not found")
-
-# --- EMAILS (demo) ---
+    with get_records_store().transaction() as store:
+        r = store.get(rid)
+        if r is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        updated = r.copy()
+        incoming = rec.model_dump()
+        incoming["id"] = rid
+        updated.update(incoming)
+        if incoming.get("def_data") != r.get("def_data"):
+            updated["prossima_ricorrenza"] = _compute_first_ricorrenza(incoming.get("def_data"))
+        if any(d["id"] != rid for d in store.lookup("identity", _identity_key(updated))):
+            raise HTTPException(status_code=409, detail="Contatto duplicato")
+        updated["updated_at"] = _change_stamp(store)
+        out = store.put(updated)
+    _SCHEDULER.notify()
+    return out
+
+@app.delete("/records/{rid}")
+def delete_record(rid: str):
+    """Elimina il record; una tombstone lo segnala al feed delle modifiche."""
+    docs = get_backend().docs
+    with get_records_store().transaction() as store:
+        if store.get(rid) is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        with docs.locked():
+            tomb = _load_tombstones()
+            horizon = (datetime.now(timezone.utc) - timedelta(days=RECORDS_TOMBSTONE_DAYS)).isoformat(timespec="microseconds")
+            old = [t for t in tomb["items"] if t["deleted_at"] < horizon]
+            if old:
+                tomb["pruned_before"] = old[-1]["deleted_at"]
+                tomb["items"] = tomb["items"][len(old):]
+            tomb["items"].append({"id": rid, "deleted_at": _change_stamp(store)})
+            docs.save(_TOMBSTONES_DOC, tomb)
+            store.delete_many([rid])
+    _SCHEDULER.notify()
+    return {"ok": True, "id": rid}
+
+# --- EMAILS ---
 @app.get("/emails/sent")
-def emails_sent():
-    sample = _load_json(EMAILS_PATH, [
-        {"to":"luca.rossi@example.com","subject":"Benvenuto","sent_at":"2025-08-01T10:00:00Z","status":"ok"},
-        {"to":"sara.bianchi@example.com","subject":"Aggiornamento","sent_at":"2025-08-05T15:30:00Z","status":"ok"},
-    ])
-    return {"emails": sample}
+def emails_sent(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=RECORDS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    record_id: Optional[str] = None,
+    stato: Optional[str] = None,             # uno o più stati separati da virgola
+    data_da: Optional[str] = None,           # YYYY-MM-DD (giorno dovuto), incluso
+    data_a: Optional[str] = None,            # YYYY-MM-DD, incluso
+    include_body: bool = True,
+):
+    """Storico invii, dal più recente.
+
+    Senza parametri ritorna tutto lo storico come sempre. Con ``limit``/``cursor``
+    ritorna una pagina e ``next_cursor``. Con un intervallo di date vengono letti
+    solo i segmenti mensili interessati. ``include_body=false`` omette ``body_usato``.
+    Supporta ``If-None-Match``.
+    """
+    hit = _not_modified(request, response, "sent", get_sent_log().version())
+    if hit is not None:
+        return hit
+    for d in (data_da, data_a):
+        if d is not None and not _parse_yyyy_mm_dd(d):
+            raise HTTPException(status_code=400, detail="Data non valida (usa YYYY-MM-DD)")
+    paged = limit is not None or cursor is not None
+    if not paged and include_body and not any((record_id, stato, data_da, data_a)):
+        return _fast_json({"emails": _load_sent()}, response)
+
+    stati = [x.strip() for x in stato.split(",") if x.strip()] if stato else None
+    try:
+        rows, next_cursor = get_sent_log().query(
+            record_id=record_id, stati=stati, day_from=data_da, day_to=data_a, cursor=cursor,
+            limit=(limit or RECORDS_PAGE_DEFAULT) if paged else None)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursore non valido")
+    if not include_body:
+        for r in rows:
+            r.pop("body_usato", None)
+    if not paged:
+        return _fast_json({"emails": rows}, response)
+    return _fast_json({"emails": rows, "next_cursor": next_cursor}, response)
+
+# --- PREVISIONE INVII ---
+_FORECAST_MAX_KEY = "\uffff"   # chiude gli intervalli dell'indice "forecast" sull'ultimo giorno incluso
+
+def _forecast_key(r: dict) -> tuple:
+    """Chiave dell'indice "forecast": ("invio", data di invio, prossima_ricorrenza) per i
+    record che verranno spediti, altrimenti il motivo dell'esclusione."""
+    if r.get("sospendi_invio") is True:
+        return ("sospeso",)
+    s0 = _send_date(r)
+    if s0 is None:
+        return ("senza_data",)
+    if not _parse_recipients(r.get("email")):
+        return ("senza_email",)
+    return ("invio", s0.isoformat(), _parse_yyyy_mm_dd(r.get("prossima_ricorrenza")).isoformat())
+
+def _forecast_schedule(start: date, end: date, today: date, with_ids: bool = False) -> dict:
+    """Invii previsti tra ``start`` ed ``end`` dall'indice "forecast", aggiornato a ogni scrittura.
+
+    I record con la stessa (data di invio, ricorrenza) hanno le stesse date
+    future: per ogni chiave si avanza la ricorrenza di un anno alla volta con
+    ``_add_years_safe`` (un 29/02 passa al 28/02 e lì resta, come nel catch-up)
+    fino a ``end``, senza leggere i singoli record. I record in ritardo (data di
+    invio passata) vanno in ``overdue``; le loro date future contano solo se il
+    prossimo catch-up li recupera (data dopo last_run).
+    """
+    store = get_records_store()
+    last_run = load_last_run_date()
+    lo = max(start, today).toordinal()
+    per_day, day_ids, overdue = {}, {}, []
+    with store.snapshot():
+        for (_, s0_iso, pr_iso), ids in store.key_ids(
+                "forecast", ("invio",), ("invio", end.isoformat(), _FORECAST_MAX_KEY)):
+            s0, pr = date.fromisoformat(s0_iso), date.fromisoformat(pr_iso)
+            if s0 < today:
+                overdue.append((s0, ids, s0 > last_run))
+                if s0 <= last_run:
+                    continue   # fuori dalla finestra del catch-up: non verrà più spedito
+            lag = (pr - s0).days
+            day = s0.toordinal()
+            while day <= end.toordinal():
+                if day >= lo:
+                    per_day[day] = per_day.get(day, 0) + len(ids)
+                    if with_ids:
+                        day_ids.setdefault(day, []).extend(ids)
+                pr = _add_years_safe(pr, 1)
+                day = pr.toordinal() - lag
+        esclusi = {name: sum(len(ids) for _, ids in store.key_ids("forecast", (k,), (k,)))
+                   for name, k in (("sospesi", "sospeso"), ("senza_data", "senza_data"), ("senza_email", "senza_email"))}
+    return {"per_day": per_day, "ids": day_ids, "overdue": overdue, "esclusi": esclusi}
+
+@app.get("/emails/forecast")
+def emails_forecast(
+    giorni: int = Query(7, ge=1),                # orizzonte, a partire da ``da``
+    da: Optional[str] = None,                    # YYYY-MM-DD, default oggi (non prima di oggi)
+    dettaglio: bool = False,                     # elenca i record per giorno
+):
+    """Previsione degli invii: quante email partono ogni giorno nell'orizzonte richiesto.
+
+    Esclude i record sospesi e quelli senza data o destinatario (riportati a
+    parte). I record con data di invio già passata sono in ``overdue``:
+    ``recuperabili`` partiranno al prossimo catch-up (in ``per_day`` contano le
+    loro date da oggi in poi), gli altri non verranno spediti finché non si
+    corregge la ricorrenza.
+    """
+    today = _today_rome_date()
+    start = _parse_yyyy_mm_dd(da) if da else today
+    if start is None:
+        raise HTTPException(status_code=400, detail="Data non valida (usa YYYY-MM-DD)")
+    if start < today:
+        raise HTTPException(status_code=400, detail="La previsione parte da oggi o da una data futura")
+    end = start + timedelta(days=giorni - 1)
+    if (end - today).days >= FORECAST_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Orizzonte massimo: {FORECAST_MAX_DAYS} giorni da oggi")
+
+    sched = _forecast_schedule(start, end, today, with_ids=dettaglio)
+    per_day = [{"date": date.fromordinal(d).isoformat(), "count": n} for d, n in sorted(sched["per_day"].items())]
+    overdue = sched["overdue"]
+    info = {}
+    if dettaglio:
+        wanted = {rid for ids in sched["ids"].values() for rid in ids} | {rid for _, ids, _ in overdue for rid in ids}
+        store = get_records_store()
+        with store.snapshot():
+            for rid in wanted:
+                r = store.get(rid)
+                if r is not None:
+                    info[rid] = {k: r.get(k) for k in ("id", "nome", "cognome", "email", "def_nome", "def_cognome",
+                                                       "prossima_ricorrenza")}
+        for item in per_day:
+            ids = sched["ids"][date.fromisoformat(item["date"]).toordinal()]
+            item["records"] = [info[rid] for rid in sorted(ids) if rid in info]
+
+    out = {
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "total": sum(sched["per_day"].values()),
+        "per_day": per_day,
+        "peak": max(per_day, key=lambda x: x["count"], default=None),
+        "overdue": {"count": sum(len(ids) for _, ids, _ in overdue),
+                    "recuperabili": sum(len(ids) for _, ids, ok in overdue if ok)},
+        "esclusi": sched["esclusi"],
+    }
+    if out["peak"] is not None:
+        out["peak"] = {"date": out["peak"]["date"], "count": out["peak"]["count"]}
+    if dettaglio:
+        out["overdue"]["items"] = sorted(
+            ({**info[rid], "send_date": s0.isoformat(), "recuperabile": ok}
+             for s0, ids, ok in overdue for rid in ids if rid in info),
+            key=lambda x: (x["send_date"], x["id"]))
+    return _fast_json(out)
 
 # --- EMAIL SETTINGS/TEMPLATES ---
 @app.get("/api/email/settings")
-def get_email_settings():
-    s = _ensure_email_files() or load_email_settings()
+def get_email_settings(request: Request, response: Response):
+    # un documento mancante viene creato (valori di default) prima di leggerne la versione;
+    # i dati si rileggono dopo, così non sono mai più vecchi dell'ETag
+    load_email_settings()
+    hit = _not_modified(request, response, "email_settings", get_backend().docs.version("email_settings"))
+    if hit is not None:
+        return hit
     s = load_email_settings()
     return {
         "subject": s.get("subject", ""),
@@ -583,32 +1540,37 @@ def get_email_settings():
     }
 
 def load_email_settings():
-    return _load_json(EMAIL_SETTINGS_PATH, {"subject": "", "body": ""})
+    return get_backend().docs.load("email_settings", {"subject": "", "body": ""})
 
 def save_email_settings(data: dict):
-    _save_json(EMAIL_SETTINGS_PATH, data)
+    get_backend().docs.save("email_settings", data)
 
 def load_email_templates():
-    return _load_json(EMAIL_TEMPLATES_PATH, {"subject": [], "body": []})
+    return get_backend().docs.load("email_templates", {"subject": [], "body": []})
 
 def save_email_templates(data: dict):
-    _save_json(EMAIL_TEMPLATES_PATH, data)
+    get_backend().docs.save("email_templates", data)
 
 @app.put("/api/email/settings")
 def update_email_settings(body: EmailSettingsIn):
-    s = load_email_settings()
-    if body.subject is not None: s["subject"] = body.subject
-    if body.body is not None: s["body"] = body.body
-    if body.subject_template_id is not None: s["subject_template_id"] = body.subject_template_id
-    if body.body_template_id is not None: s["body_template_id"] = body.body_template_id
-    s["updated_at"] = _now_iso()
-    save_email_settings(s)
-    return {"ok": True}
+    with get_backend().docs.locked():
+        s = load_email_settings()
+        if body.subject is not None: s["subject"] = body.subject
+        if body.body is not None: s["body"] = body.body
+        if body.subject_template_id is not None: s["subject_template_id"] = body.subject_template_id
+        if body.body_template_id is not None: s["body_template_id"] = body.body_template_id
+        s["updated_at"] = _now_iso()
+        save_email_settings(s)
+        return {"ok": True}
 
 @app.get("/api/email/templates")
-def list_email_templates(type: str):
+def list_email_templates(request: Request, response: Response, type: str):
     if type not in ("subject", "body"):
         raise HTTPException(status_code=400, detail="type deve essere 'subject' o 'body'")
+    load_email_templates()   # crea il documento se manca (vedi get_email_settings)
+    hit = _not_modified(request, response, "email_templates", get_backend().docs.version("email_templates"))
+    if hit is not None:
+        return hit
     alltpl = load_email_templates()
     return alltpl.get(type, [])
 
@@ -617,40 +1579,43 @@ def create_email_template(tpl: EmailTemplateIn):
     t = tpl.type
     if t not in ("subject", "body"):
         raise HTTPException(status_code=400, detail="type deve essere 'subject' o 'body'")
-    alltpl = load_email_templates()
-    new_item = {"id": uuid.uuid4().hex, "name": tpl.name, "content": tpl.content, "created_at": _now_iso()}
-    alltpl.setdefault(t, [])
-    alltpl[t].insert(0, new_item)
-    save_email_templates(alltpl)
-    s = load_email_settings()
-    if t == "subject":
-        s["subject"] = tpl.content
-        s["subject_template_id"] = new_item["id"]
-    else:
-        s["body"] = tpl.content
-        s["body_template_id"] = new_item["id"]
-    s["updated_at"] = _now_iso()
-    save_email_settings(s)
-    return {"id": new_item["id"], "ok": True}
+    with get_backend().docs.locked():
+        alltpl = load_email_templates()
+        new_item = {"id": uuid.uuid4().hex, "name": tpl.name, "content": tpl.content, "created_at": _now_iso()}
+        alltpl.setdefault(t, [])
+        alltpl[t].insert(0, new_item)
+        save_email_templates(alltpl)
+        s = load_email_settings()
+        if t == "subject":
+            s["subject"] = tpl.content
+            s["subject_template_id"] = new_item["id"]
+        else:
+            s["body"] = tpl.content
+            s["body_template_id"] = new_item["id"]
+        s["updated_at"] = _now_iso()
+        save_email_settings(s)
+        return {"id": new_item["id"], "ok": True}
 
 @app.delete("/api/email/templates/{tid}")
 def delete_email_template(tid: str, type: str = Query(...)):
     if type not in ("subject", "body"):
         raise HTTPException(status_code=400, detail="type deve essere 'subject' o 'body'")
-    tpls = load_email_templates()
-    arr = tpls.get(type, [])
-    new_arr = [x for x in arr if x.get("id") != tid]
-    if len(new_arr) == len(arr):
-        raise HTTPException(status_code=404, detail="Template non trovato")
-    tpls[type] = new_arr
-    save_email_templates(tpls)
-    s = load_email_settings()
-    if type == "subject" and s.get("subject_template_id") == tid:
-        s["subject_template_id"] = None
-    if type == "body" and s.get("body_template_id") == tid:
-        s["body_template_id"] = None
-    save_email_settings(s)
-    return {"ok": True, "deleted_id": tid, "type": type}
+    with get_backend().docs.locked():
+        tpls = load_email_templates()
+        arr = tpls.get(type, [])
+        new_arr = [x for x in arr if x.get("id") != tid]
+        if len(new_arr) == len(arr):
+            raise HTTPException(status_code=404, detail="Template non trovato")
+        tpls[type] = new_arr
+        save_email_templates(tpls)
+        s = load_email_settings()
+        if type == "subject" and s.get("subject_template_id") == tid:
+            s["subject_template_id"] = None
+        if type == "body" and s.get("body_template_id") == tid:
+            s["body_template_id"] = None
+        save_email_settings(s)
+        return {"ok": True, "deleted_id": tid, "type": type}
+
 
 
 
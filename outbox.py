@@ -0,0 +1,228 @@
+# outbox.py
+"""Coda persistente dei messaggi in uscita (outbox) e worker di invio.
+
+Ogni messaggio è un elemento dello store ``outbox`` del backend:
+``in_coda`` -> ``in_invio`` -> ``ok`` | di nuovo ``in_coda`` (con backoff
+esponenziale) | ``errore`` (dead-letter dopo ``max_attempts`` tentativi).
+Più messaggi accodati dalla stessa richiesta condividono un ``job_id``.
+"""
+import os, threading, time, uuid, logging
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+from storage import RecordStore, HashIndex, SortedIndex
+
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_BACKOFF_SECONDS = float(os.environ.get("OUTBOX_BACKOFF_SECONDS", "30"))     # 30s, 60s, 120s...
+OUTBOX_BACKOFF_MAX_SECONDS = float(os.environ.get("OUTBOX_BACKOFF_MAX_SECONDS", "3600"))
+OUTBOX_POLL_SECONDS = float(os.environ.get("OUTBOX_POLL_SECONDS", "30"))
+OUTBOX_KEEP_DONE_DAYS = float(os.environ.get("OUTBOX_KEEP_DONE_DAYS", "7"))   # poi i messaggi consegnati si eliminano
+# un messaggio ``in_invio`` da più di tanto è di un worker morto a metà invio e torna in coda
+OUTBOX_CLAIM_TIMEOUT_SECONDS = float(os.environ.get("OUTBOX_CLAIM_TIMEOUT_SECONDS", "600"))
+
+log = logging.getLogger("outbox")
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class Outbox:
+    """Accodamento e consultazione dei messaggi; lo stato vive nello store."""
+
+    def __init__(self, store: RecordStore, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.store = store
+        self.max_attempts = max_attempts
+        self.wakeup = threading.Condition()
+        store.add_index("job", HashIndex(lambda m: m.get("job_id")))
+        store.add_index("status", HashIndex(lambda m: m.get("status")))
+        # solo i messaggi in attesa, ordinati per prossimo tentativo
+        store.add_index("due", SortedIndex(
+            lambda m: m.get("next_attempt_at") if m.get("status") == "in_coda" else None))
+
+    def enqueue(self, messages: list[dict], job_id: Optional[str] = None) -> str:
+        """Accoda i messaggi (to, subject, html, plain, opz. sent_ref/final_state) e ritorna il job_id."""
+        job_id = job_id or uuid.uuid4().hex
+        now = _now().isoformat()
+        items = []
+        for m in messages:
+            items.append({
+                "id": uuid.uuid4().hex,
+                "job_id": job_id,
+                "to": m["to"],
+                "subject": m["subject"],
+                "html": m["html"],
+                "plain": m.get("plain"),
+                "sent_ref": m.get("sent_ref"),        # {"record_id", "due_date"} della riga del registro invii
+                "final_state": m.get("final_state") or "ok",
+                "status": "in_coda",
+                "attempts": 0,
+                "max_attempts": self.max_attempts,
+                "next_attempt_at": now,
+                "last_error": None,
+                "created_at": now,
+                "updated_at": now,
+            })
+        self.store.put_many(items)
+        with self.wakeup:
+            self.wakeup.notify_all()
+        return job_id
+
+    def job(self, job_id: str) -> list[dict]:
+        items = self.store.lookup("job", job_id)
+        items.sort(key=lambda m: m["created_at"])
+        return items
+
+    def counts(self) -> dict:
+        return {st: len(self.store.lookup("status", st)) for st in ("in_coda", "in_invio", "ok", "errore")}
+
+    # --- usati dai worker ---
+    def claim(self) -> Optional[dict]:
+        """Prende il primo messaggio scaduto e lo marca ``in_invio``."""
+        now = _now().isoformat()
+        with self.store.transaction() as st:
+            due = st.range("due", None, now, limit=1)
+            if not due:
+                return None
+            msg = due[0][1]
+            msg["status"] = "in_invio"
+            msg["attempts"] = int(msg.get("attempts") or 0) + 1
+            msg["updated_at"] = now
+            return st.put(msg)
+
+    def next_wakeup(self) -> Optional[float]:
+        """Secondi al prossimo tentativo programmato (None se la coda è vuota)."""
+        due = self.store.range("due", limit=1)
+        if not due:
+            return None
+        nxt = datetime.fromisoformat(due[0][0])
+        return max(0.0, (nxt - _now()).total_seconds())
+
+    def done(self, msg: dict):
+        msg.update(status="ok", last_error=None, updated_at=_now().isoformat())
+        self.store.put(msg)
+
+    def failed(self, msg: dict, error: str) -> bool:
+        """Registra il fallimento; True se il messaggio è finito in dead-letter."""
+        now = _now()
+        msg["last_error"] = error
+        msg["updated_at"] = now.isoformat()
+        if msg["attempts"] >= int(msg.get("max_attempts") or self.max_attempts):
+            msg["status"] = "errore"
+        else:
+            delay = min(OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_BACKOFF_SECONDS * 2 ** (msg["attempts"] - 1))
+            msg["status"] = "in_coda"
+            msg["next_attempt_at"] = (now + timedelta(seconds=delay)).isoformat()
+        self.store.put(msg)
+        return msg["status"] == "errore"
+
+    def purge_done(self, older_than_days: float = OUTBOX_KEEP_DONE_DAYS) -> int:
+        """Elimina i messaggi consegnati più vecchi di N giorni (i dead-letter restano)."""
+        limit = (_now() - timedelta(days=older_than_days)).isoformat()
+        with self.store.transaction() as st:
+            old = [m["id"] for m in st.lookup("status", "ok") if (m.get("updated_at") or "") < limit]
+            st.delete_many(old)
+        return len(old)
+
+    def requeue_interrupted(self, older_than_seconds: float = OUTBOX_CLAIM_TIMEOUT_SECONDS) -> int:
+        """I messaggi ``in_invio`` fermi da più di N secondi (crash a metà invio) tornano in coda.
+
+        Quelli più recenti sono di un worker ancora vivo (anche di un altro processo): restano suoi.
+        """
+        limit = (_now() - timedelta(seconds=older_than_seconds)).isoformat()
+        with self.store.transaction() as st:
+            stuck = [m for m in st.lookup("status", "in_invio") if (m.get("updated_at") or "") < limit]
+            for m in stuck:
+                m["status"] = "in_coda"
+            st.put_many(stuck)
+        return len(stuck)
+
+
+class OutboxWorkers:
+    """Thread che svuotano l'outbox.
+
+    ``get_outbox()`` ritorna l'outbox corrente (cambia se cambia la cartella dati);
+    ``send(to, subject, html, plain)`` fa l'invio vero; ``on_result(msg, stato, errore)``
+    viene chiamata a invio riuscito o a dead-letter (per aggiornare il registro invii).
+    """
+
+    def __init__(self, get_outbox: Callable[[], Outbox], send: Callable, on_result: Optional[Callable] = None,
+                 workers: int = OUTBOX_WORKERS):
+        self.get_outbox = get_outbox
+        self.send = send
+        self.on_result = on_result
+        self.n = max(1, workers)
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._next_sweep = 0.0
+
+    @property
+    def outbox(self) -> Outbox:
+        return self.get_outbox()
+
+    def _sweep(self) -> int:
+        """Manutenzione periodica: rimette in coda i messaggi rimasti ``in_invio`` oltre
+        OUTBOX_CLAIM_TIMEOUT_SECONDS e scarta i consegnati più vecchi di OUTBOX_KEEP_DONE_DAYS.
+
+        Ritorna quanti messaggi sono tornati in coda.
+        """
+        self._next_sweep = time.monotonic() + OUTBOX_CLAIM_TIMEOUT_SECONDS
+        n = self.outbox.requeue_interrupted()
+        if n:
+            log.warning("outbox: %s messaggi interrotti rimessi in coda", n)
+        purged = self.outbox.purge_done()
+        if purged:
+            log.info("outbox: %s messaggi consegnati eliminati", purged)
+        return n
+
+    def start(self):
+        self._sweep()
+        self._stop.clear()
+        for i in range(self.n):
+            t = threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        with self.outbox.wakeup:
+            self.outbox.wakeup.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            outbox = self.outbox
+            # claim e attesa sotto la condition: un enqueue concorrente non va perso
+            with outbox.wakeup:
+                try:
+                    msg = outbox.claim()
+                    wait = outbox.next_wakeup() if msg is None else 0
+                except Exception:
+                    log.exception("outbox: lettura coda fallita")
+                    msg, wait = None, None
+                if msg is None:
+                    if time.monotonic() >= self._next_sweep:
+                        try:
+                            if self._sweep():
+                                continue
+                        except Exception:
+                            log.exception("outbox: manutenzione della coda fallita")
+                    outbox.wakeup.wait(OUTBOX_POLL_SECONDS if wait is None else min(wait, OUTBOX_POLL_SECONDS))
+                    continue
+            self._deliver(outbox, msg)
+
+    def _deliver(self, outbox: Outbox, msg: dict):
+        try:
+            self.send(msg["to"], msg["subject"], msg["html"], msg.get("plain"))
+        except Exception as e:
+            dead = outbox.failed(msg, str(e))
+            log.warning("outbox: invio a %s fallito (tentativo %s): %s", msg["to"], msg["attempts"], e)
+            if dead and self.on_result:
+                self.on_result(msg, "errore", str(e))
+            return
+        outbox.done(msg)
+        if self.on_result:
+            self.on_result(msg, msg.get("final_state") or "ok", None)
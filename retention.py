@@ -0,0 +1,67 @@
+# retention.py
+"""Retention del registro invii: politica per stato e compattazione periodica.
+
+``SENT_RETENTION`` indica per quanti giorni ogni stato resta nel registro
+"caldo", es. ``ok=730,test=90,errore=365,*=730`` (``*`` = tutti gli altri
+stati, assente = si conserva per sempre). Le righe più vecchie vengono spostate
+in segmenti gzip (vedi ``SentLog.compact``); l'indice anti-duplicati le conserva.
+Di default è vuota: nessuna archiviazione e nessuna compattazione periodica.
+"""
+import os, threading, logging
+from datetime import date, timedelta
+from typing import Callable, Optional
+
+SENT_RETENTION = os.environ.get("SENT_RETENTION", "")   # vuota = si conserva tutto
+SENT_COMPACT_HOURS = float(os.environ.get("SENT_COMPACT_HOURS", "24"))   # 0 = solo dall'endpoint admin
+
+log = logging.getLogger("retention")
+
+
+def parse_policy(spec: str) -> dict[str, int]:
+    """``"ok=730,test=90"`` -> ``{"ok": 730, "test": 90}``."""
+    policy = {}
+    for part in (spec or "").split(","):
+        if not part.strip():
+            continue
+        stato, sep, days = part.partition("=")
+        if not sep or not stato.strip():
+            raise ValueError(f"retention non valida: {part!r} (usa stato=giorni)")
+        policy[stato.strip()] = int(days)
+    return policy
+
+
+def cutoffs(policy: dict[str, int], today: date) -> dict[str, str]:
+    """Giorno limite per stato: le righe con giorno anteriore vanno in archivio."""
+    return {stato: (today - timedelta(days=days)).isoformat() for stato, days in policy.items()}
+
+
+class CompactionTimer:
+    """Thread che esegue ``run()`` ogni ``every_hours`` ore (il primo giro dopo un intervallo)."""
+
+    def __init__(self, run: Callable[[], dict], every_hours: float = SENT_COMPACT_HOURS):
+        self.run = run
+        self.every = every_hours * 3600
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_result: Optional[dict] = None
+
+    def start(self):
+        if self.every <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="sent-compaction", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.every):
+            try:
+                self.last_result = self.run()
+                log.info("compattazione registro invii: %s righe archiviate", self.last_result.get("archived"))
+            except Exception:
+                log.exception("compattazione registro invii fallita")
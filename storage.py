@@ -0,0 +1,1436 @@
+# storage.py
+"""Archivio record residente in memoria.
+
+I record vengono letti una volta sola da disco e tenuti in un indice
+id -> record; la persistenza riserializza solo i record modificati, ma in
+modalità "json" ogni scrittura riscrive comunque l'intero file.
+In modalità "journal" ogni modifica è invece una riga appesa a un log
+(write-ahead), compattato periodicamente in uno snapshot.
+"""
+import os, threading, logging, bisect, re, shutil, gzip, time, copy
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Iterable, Optional
+
+from filelock import FileLock, TryLock
+from jsoncodec import dumps, loads, JSON_PRETTY
+
+
+def _atomic_write(path: str, text: str, replace_if: Optional[Callable[[], bool]] = None) -> bool:
+    """Scrive su file temporaneo e rinomina: il file non resta mai troncato.
+
+    Il temporaneo ha un nome per processo/thread: due scritture concorrenti
+    non si sovrascrivono il file a metà (vince l'ultima rinomina).
+    ``replace_if``: controllo fatto subito prima della rinomina; se falso il
+    file resta com'è e si ritorna False.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    if replace_if is not None and not replace_if():
+        os.remove(tmp)
+        return False
+    os.replace(tmp, path)
+    return True
+
+
+def _file_stamp(path: str):
+    """Firma di un file (mtime, dimensione, inode), None se non esiste.
+
+    Ogni riscrittura (anche da un altro processo) la cambia: serve alle cache
+    in memoria per accorgersi che i dati su disco sono più recenti.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def _encode(rec: dict) -> str:
+    return dumps(rec)
+
+
+def _encode_item(rec: dict) -> str:
+    """Elemento di records.json o di uno snapshot: compatto, o indentato con JSON_PRETTY.
+
+    NDJSON, journal e righe SQLite restano sempre su una riga (``_encode``).
+    """
+    if not JSON_PRETTY:
+        return dumps(rec)
+    return "  " + dumps(rec, pretty=True).replace("\n", "\n  ")
+
+
+def _json_lines_array(frags: list[str]) -> str:
+    body = ",\n".join(frags)
+    return f"[\n{body}\n]\n" if frags else "[]\n"
+
+
+log = logging.getLogger("storage")
+
+
+# =========================
+#  PERSISTENZA JSON
+# =========================
+
+class JsonRecordFile:
+    """records.json come array JSON con un record per riga (indentato con JSON_PRETTY).
+
+    Il formato resta un normale array JSON (compatibile con il vecchio file
+    indentato, che viene migrato alla prima scrittura). Ogni record ha il suo
+    frammento serializzato in cache: una scrittura ricodifica solo i record
+    toccati e concatena gli altri così come sono.
+
+    La cache evita la serializzazione, non l'I/O: ogni scrittura, anche di un
+    solo record, riscrive e sincronizza l'intero file, quindi costa O(totale
+    dei record). Con molti record o scritture frequenti usare la modalità
+    "journal" (costo proporzionale ai soli record modificati) o "sqlite".
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._frag: dict[str, str] = {}
+        self._seen = None   # firma del file all'ultima lettura/scrittura
+
+    def load(self) -> list[dict]:
+        self._frag = {}
+        self._seen = _file_stamp(self.path)
+        if self._seen is None:
+            return []
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = loads(f.read())
+        return data if isinstance(data, list) else []
+
+    def is_stale(self) -> bool:
+        """True se il file è stato riscritto da un altro processo."""
+        return _file_stamp(self.path) != self._seen
+
+    def version(self):
+        """Versione dei dati su disco (la firma del file cambia a ogni scrittura)."""
+        return _file_stamp(self.path)
+
+    def write(self, order: list[str], by_id: dict[str, dict], dirty: Iterable[str], deleted: Iterable[str] = ()):
+        for rid in dirty:
+            if rid in by_id:
+                self._frag[rid] = _encode_item(by_id[rid])
+        frags = []
+        for rid in order:
+            frag = self._frag.get(rid)
+            if frag is None:
+                frag = self._frag[rid] = _encode_item(by_id[rid])
+            frags.append(frag)
+        for rid in list(self._frag):
+            if rid not in by_id:
+                del self._frag[rid]
+        _atomic_write(self.path, _json_lines_array(frags))
+        self._seen = _file_stamp(self.path)
+
+
+class JsonListFile:
+    """Lista JSON in un file unico: il vecchio sent_emails.json, letto solo per la
+    migrazione verso i segmenti mensili."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = loads(f.read())
+        return data if isinstance(data, list) else []
+
+
+# =========================
+#  JOURNAL (write-ahead log)
+# =========================
+
+def _truncate_torn_tail(path: str):
+    """Elimina un'eventuale ultima riga incompleta (crash a metà scrittura)."""
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        f.seek(0)
+        data = f.read()
+        f.truncate(data.rfind(b"\n") + 1)
+
+
+class Journal:
+    """Log append-only: una riga JSON per operazione, con numero di sequenza.
+
+    ``append`` scrive tutto il batch e fa un solo fsync. Durante la
+    compattazione il log corrente viene ruotato in ``<path>.old``: le nuove
+    operazioni finiscono in un log nuovo, mentre lo snapshot viene scritto
+    in background; a snapshot completato il vecchio log si cancella.
+    Finché la compattazione è in corso il suo processo tiene ``<path>.compacting``
+    (``TryLock``): un ``.old`` senza quel lock è di una compattazione interrotta.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.old_path = f"{path}.old"
+        self.compacting = TryLock(f"{path}.compacting")
+        self.seq = 0
+        self._f = None
+
+    def replay(self, after_seq: int):
+        """Operazioni con seq > after_seq, dal log ruotato e da quello corrente."""
+        self.close()
+        self.seq = after_seq
+        for p in (self.old_path, self.path):
+            if not os.path.exists(p):
+                continue
+            _truncate_torn_tail(p)
+            with open(p, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        op = loads(line)
+                    except ValueError:
+                        continue
+                    seq = op.get("seq", 0)
+                    if seq > after_seq:
+                        self.seq = max(self.seq, seq)
+                        yield op
+
+    def append(self, ops: list[dict]):
+        if not ops:
+            return
+        if self._f is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._f = open(self.path, "a", encoding="utf-8")
+        lines = []
+        for op in ops:
+            self.seq += 1
+            op["seq"] = self.seq
+            lines.append(_encode(op))
+        self._f.write("\n".join(lines) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def rotate(self) -> bool:
+        """Sposta il log corrente in .old; False se una compattazione è già in corso."""
+        if os.path.exists(self.old_path):
+            return False
+        self.close()
+        if os.path.exists(self.path):
+            os.replace(self.path, self.old_path)
+        return True
+
+    def drop_old(self):
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+
+    def reset(self):
+        """Da chiamare dopo uno snapshot completo e sincrono: svuota entrambi i log."""
+        self.close()
+        self.drop_old()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+def _read_snapshot(path: str, key: str):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        obj = loads(f.read())
+    return int(obj.get("seq", 0)), obj.get(key) or []
+
+
+_SNAPSHOT_SEQ_RE = re.compile(rb'^\{"seq":\s*(\d+)')
+
+
+def _snapshot_seq(path: str) -> int:
+    """Seq dello snapshot su disco (-1 se non esiste), letto dalla sola intestazione."""
+    try:
+        with open(path, "rb") as f:
+            m = _SNAPSHOT_SEQ_RE.match(f.read(64))
+    except FileNotFoundError:
+        return -1
+    if m:
+        return int(m.group(1))
+    snap = _read_snapshot(path, "")
+    return snap[0] if snap else -1
+
+
+def _write_snapshot(path: str, seq: int, key: str, frags: list[str], only_newer: bool = False) -> bool:
+    """Scrive lo snapshot; con ``only_newer`` solo se quello su disco ha un seq più basso."""
+    body = ",\n".join(frags)
+    text = f'{{"seq": {seq}, "{key}": [\n{body}\n]}}\n' if frags else f'{{"seq": {seq}, "{key}": []}}\n'
+    return _atomic_write(path, text, (lambda: seq > _snapshot_seq(path)) if only_newer else None)
+
+
+class _Journaled:
+    """Logica comune snapshot + journal + compattazione in background."""
+
+    key = "items"
+
+    def __init__(self, snapshot_path: str, wal_path: str, legacy_path: Optional[str] = None,
+                 compact_every: int = 1000):
+        self.snapshot_path = snapshot_path
+        self.legacy_path = legacy_path
+        self.journal = Journal(wal_path)
+        self.compact_every = compact_every
+        self._pending = 0
+        self._compacting: Optional[threading.Thread] = None
+        self.lock: Optional[FileLock] = None   # lock dello store (impostato da open_backend)
+        self._seen = None
+
+    def _stamp(self):
+        j = self.journal
+        return tuple(_file_stamp(p) for p in (self.snapshot_path, j.path, j.old_path))
+
+    def _load_base(self) -> tuple[int, list]:
+        snap = _read_snapshot(self.snapshot_path, self.key)
+        if snap is not None:
+            return snap
+        # migrazione: primo avvio in modalità journal, si parte dal file JSON classico
+        if self.legacy_path and os.path.exists(self.legacy_path):
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                data = loads(f.read())
+            return 0, data if isinstance(data, list) else []
+        return 0, []
+
+    def _after_load(self, items: list, stamp):
+        """Consolida subito un log ruotato rimasto da una compattazione interrotta
+        (o il file JSON classico al primo avvio). ``stamp``: firma dei file prima
+        della lettura di ``items``."""
+        self._pending = 0
+        j = self.journal
+        if (os.path.exists(j.old_path) or not os.path.exists(self.snapshot_path)) and not j.compacting.busy():
+            # si legge anche sotto lock condiviso: il log si può svuotare solo con quello esclusivo
+            with self.lock.exclusive() if self.lock else nullcontext():
+                # la promozione del lock può aver lasciato scrivere o compattare un altro processo
+                if self._stamp() == stamp and j.compacting.acquire():
+                    try:
+                        _write_snapshot(self.snapshot_path, j.seq, self.key, [_encode_item(x) for x in items])
+                        j.reset()
+                    finally:
+                        j.compacting.release()
+        self._seen = self._stamp()
+
+    def _log(self, ops: list[dict], snapshot_items: Callable[[], list]):
+        self.journal.append(ops)
+        self._pending += len(ops)
+        if self._pending >= self.compact_every:
+            self._compact(snapshot_items)
+        self._seen = self._stamp()
+
+    def _compact(self, snapshot_items: Callable[[], list]):
+        """Chiamata sotto il lock esclusivo dello store, con i dati in memoria aggiornati."""
+        if self._compacting is not None and self._compacting.is_alive():
+            return
+        j = self.journal
+        if not j.compacting.acquire():
+            return   # compattazione in corso in un altro processo
+        seq = j.seq
+        items = snapshot_items()  # copia superficiale presa sotto il lock dello store
+        self._pending = 0
+        if not j.rotate():
+            # .old orfano (compattazione interrotta): uno snapshot sincrono copre già tutto
+            try:
+                _write_snapshot(self.snapshot_path, seq, self.key, [_encode_item(x) for x in items])
+                j.reset()
+            finally:
+                j.compacting.release()
+            return
+
+        def run():
+            try:
+                # uno snapshot più recente su disco non va mai sostituito con uno più vecchio
+                _write_snapshot(self.snapshot_path, seq, self.key, [_encode_item(x) for x in items], only_newer=True)
+                # chi sta rileggendo snapshot + log (anche da un altro processo) non deve perdere il .old
+                with self.lock.exclusive() if self.lock else nullcontext():
+                    j.drop_old()
+            except Exception:
+                # il log .old resta su disco e verrà consolidato alla prossima lettura
+                log.exception("compattazione journal fallita: %s", self.snapshot_path)
+            finally:
+                j.compacting.release()
+
+        self._compacting = threading.Thread(target=run, name="journal-compact", daemon=True)
+        self._compacting.start()
+
+    def flush(self):
+        """Attende la fine di un'eventuale compattazione in corso."""
+        if self._compacting is not None:
+            self._compacting.join()
+
+    def is_stale(self) -> bool:
+        """True se snapshot o log sono cambiati dall'ultima lettura/scrittura di questo processo
+        (scritture di altri worker, o la compattazione in background)."""
+        return self._stamp() != self._seen
+
+    def version(self):
+        return self._stamp()
+
+    def close(self):
+        self.flush()
+        self.journal.close()
+
+
+class JournaledRecordFile(_Journaled):
+    """Record in snapshot (records.snapshot.json) + journal (records.wal).
+
+    Operazioni: ``{"op": "put", "rec": {...}}`` e ``{"op": "del", "id": ...}``.
+    Al primo avvio i dati vengono presi da records.json.
+    """
+
+    key = "records"
+
+    def load(self) -> list[dict]:
+        stamp = self._stamp()
+        seq0, base = self._load_base()
+        # i record legacy senza id ricevono una chiave provvisoria (l'id lo assegna lo store)
+        by_id = {r.get("id") or f"\0{i}": r for i, r in enumerate(base)}
+        for op in self.journal.replay(seq0):
+            if op.get("op") == "put":
+                rec = op["rec"]
+                by_id[rec["id"]] = rec
+            elif op.get("op") == "del":
+                by_id.pop(op.get("id"), None)
+        items = list(by_id.values())
+        self._after_load(items, stamp)
+        return items
+
+    def write(self, order: list[str], by_id: dict[str, dict], dirty: Iterable[str], deleted: Iterable[str] = ()):
+        ops = [{"op": "put", "rec": by_id[rid]} for rid in dirty if rid in by_id]
+        ops += [{"op": "del", "id": rid} for rid in deleted]
+        self._log(ops, lambda: [by_id[rid] for rid in order])
+
+
+class JournaledListFile(_Journaled):
+    """Lista append-only in snapshot + journal (vecchio formato del registro invii, letto in migrazione)."""
+
+    key = "rows"
+
+    def load(self) -> list:
+        stamp = self._stamp()
+        seq0, base = self._load_base()
+        rows = list(base)
+        for op in self.journal.replay(seq0):
+            if op.get("op") == "add":
+                rows.append(op["row"])
+            elif op.get("op") == "set" and 0 <= op.get("i", -1) < len(rows):
+                rows[op["i"]] = op["row"]
+            elif op.get("op") == "replace":
+                rows = list(op.get("rows") or [])
+        self._after_load(rows, stamp)
+        return rows
+
+
+# =========================
+#  REGISTRO INVII A SEGMENTI MENSILI
+# =========================
+
+UNDATED_SEGMENT = "0000-00"   # righe senza data (vecchi invii): il segmento più vecchio
+ARCHIVE_DIR = "archive"       # sottocartella dei segmenti archiviati (gzip)
+_SEGMENT_RE = re.compile(r"^(\d{4}-\d{2})\.ndjson$")
+
+
+def sent_day(row: dict) -> str:
+    """Giorno di riferimento di una riga del registro: due_date, altrimenti il giorno di sent_at."""
+    return row.get("due_date") or (row.get("sent_at") or "")[:10]
+
+
+def _segment_of(row: dict) -> str:
+    day = sent_day(row)
+    return day[:7] if re.match(r"\d{4}-\d{2}", day) else UNDATED_SEGMENT
+
+
+def archive_predicate(cutoffs: dict[str, str]) -> Callable[[dict], bool]:
+    """``cutoffs``: stato -> giorno limite (ISO), ``"*"`` per gli altri stati.
+
+    Una riga va in archivio se il suo giorno è anteriore al limite del suo stato
+    (le righe senza data sono considerate le più vecchie).
+    """
+    default = cutoffs.get("*")
+
+    def select(row: dict) -> bool:
+        cutoff = cutoffs.get(row.get("stato"), default)
+        return cutoff is not None and sent_day(row) < cutoff
+
+    return select
+
+
+def append_gz(path: str, rows: list):
+    """Aggiunge righe NDJSON a un file gzip (un nuovo membro gzip per chiamata)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="ab") as gz:
+            gz.write("".join(_encode(r) + "\n" for r in rows).encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+
+
+def read_gz(path: str) -> list:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [loads(line) for line in f if line.strip()]
+
+
+def _dir_size(path: str) -> tuple[int, int]:
+    """(numero di file, byte) di una cartella, senza sottocartelle."""
+    if not os.path.isdir(path):
+        return 0, 0
+    files = [e for e in os.scandir(path) if e.is_file()]
+    return len(files), sum(e.stat().st_size for e in files)
+
+
+class SegmentedListFile:
+    """Registro invii diviso per mese: ``<dir>/AAAA-MM.ndjson``, una riga JSON per invio.
+
+    Il mese è quello di ``due_date`` (o di ``sent_at``). Le nuove righe si
+    appendono al segmento del loro mese; un aggiornamento riscrive solo quel
+    segmento; le letture filtrate per data aprono solo i mesi dell'intervallo.
+    Se la cartella non esiste viene creata dalle righe di ``legacy()``
+    (migrazione dal vecchio file unico), sotto ``lock`` in esclusiva.
+    """
+
+    def __init__(self, dir_path: str, legacy: Optional[Callable[[], list]] = None, cache_segments: int = 4,
+                 lock: Optional[FileLock] = None):
+        self.dir = dir_path
+        self._legacy = legacy
+        self._cache: OrderedDict = OrderedDict()   # segmento -> ((mtime, size), righe)
+        self._cache_size = cache_segments
+        self.lock = lock or FileLock()
+
+    # --- file ---
+    def _ensure_dir(self):
+        if os.path.isdir(self.dir):
+            return
+        # le letture arrivano qui con il lock condiviso: la migrazione lo promuove
+        # e ricontrolla, perché un altro processo può averla già fatta nel frattempo
+        with self.lock.exclusive():
+            if os.path.isdir(self.dir):
+                return
+            rows = self._legacy() if self._legacy else []
+            tmp = f"{self.dir}.tmp"
+            shutil.rmtree(tmp, ignore_errors=True)
+            self._write_all(tmp, rows)
+            os.replace(tmp, self.dir)
+        if rows:
+            log.info("registro invii migrato in %s (%d righe)", self.dir, len(rows))
+
+    @staticmethod
+    def _write_all(dir_path: str, rows: list):
+        os.makedirs(dir_path, exist_ok=True)
+        by_seg: dict[str, list] = {}
+        for r in rows:
+            by_seg.setdefault(_segment_of(r), []).append(r)
+        for seg, seg_rows in by_seg.items():
+            _atomic_write(os.path.join(dir_path, f"{seg}.ndjson"), "".join(_encode(r) + "\n" for r in seg_rows))
+
+    def _path(self, seg: str) -> str:
+        return os.path.join(self.dir, f"{seg}.ndjson")
+
+    def segments(self) -> list[str]:
+        """Mesi presenti, dal più vecchio."""
+        self._ensure_dir()
+        return sorted(m.group(1) for m in map(_SEGMENT_RE.match, os.listdir(self.dir)) if m)
+
+    def version(self) -> tuple:
+        """Firma dei segmenti "caldi": cambia a ogni aggiunta, modifica o archiviazione."""
+        return tuple((seg, _file_stamp(self._path(seg))) for seg in self.segments())
+
+    def segment_sizes(self) -> dict[str, int]:
+        return {seg: os.path.getsize(self._path(seg)) for seg in self.segments()}
+
+    def read_segment(self, seg: str) -> list:
+        """Righe di un mese (cache per mtime/dimensione: le pagine successive non rileggono)."""
+        path = self._path(seg)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return []
+        stamp = (st.st_mtime_ns, st.st_size)
+        hit = self._cache.get(seg)
+        if hit is not None and hit[0] == stamp:
+            self._cache.move_to_end(seg)
+            return hit[1]
+        rows = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(loads(line))
+                except ValueError:
+                    continue  # riga troncata da un crash
+        self._cache[seg] = (stamp, rows)
+        self._cache.move_to_end(seg)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return rows
+
+    def _write_segment(self, seg: str, rows: list):
+        self._cache.pop(seg, None)
+        if rows:
+            _atomic_write(self._path(seg), "".join(_encode(r) + "\n" for r in rows))
+        elif os.path.exists(self._path(seg)):
+            os.remove(self._path(seg))
+
+    # --- interfaccia del registro ---
+    def load(self) -> list:
+        out = []
+        for seg in self.segments():
+            out.extend(self.read_segment(seg))
+        return out
+
+    def is_stale(self) -> bool:
+        return False
+
+    def add(self, new_rows: list):
+        self._ensure_dir()
+        by_seg: dict[str, list] = {}
+        for r in new_rows:
+            by_seg.setdefault(_segment_of(r), []).append(r)
+        for seg, rows in by_seg.items():
+            path = self._path(seg)
+            if os.path.exists(path):
+                _truncate_torn_tail(path)
+            self._cache.pop(seg, None)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("".join(_encode(r) + "\n" for r in rows))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def update_last(self, record_id: str, due_date: str, fields: dict) -> Optional[dict]:
+        self._ensure_dir()
+        seg = _segment_of({"due_date": due_date})
+        rows = list(self.read_segment(seg))
+        for i in range(len(rows) - 1, -1, -1):
+            row = rows[i]
+            if row.get("record_id") == record_id and row.get("due_date") == due_date:
+                rows[i] = row = {**row, **fields}
+                self._write_segment(seg, rows)
+                return row
+        return None
+
+    def replace(self, rows: list):
+        """Sostituisce le righe "calde"; l'archivio compresso resta com'è."""
+        tmp = f"{self.dir}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        self._write_all(tmp, rows)
+        old = f"{self.dir}.old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.isdir(self.dir):
+            if os.path.isdir(self.archive_dir):
+                os.replace(self.archive_dir, os.path.join(tmp, ARCHIVE_DIR))
+            os.replace(self.dir, old)
+        os.replace(tmp, self.dir)
+        shutil.rmtree(old, ignore_errors=True)
+        self._cache.clear()
+
+    # --- archivio (retention) ---
+    @property
+    def archive_dir(self) -> str:
+        return os.path.join(self.dir, ARCHIVE_DIR)
+
+    def archive(self, cutoffs: dict[str, str]) -> int:
+        """Sposta nell'archivio gzip (``archive/AAAA-MM.ndjson.gz``) le righe oltre la retention.
+
+        Si scrive prima l'archivio e poi il segmento ridotto: un crash nel mezzo
+        lascia al più delle righe duplicate in archivio, mai perse.
+        """
+        select = archive_predicate(cutoffs)
+        moved = 0
+        for seg in self.segments():
+            rows = self.read_segment(seg)
+            old = [r for r in rows if select(r)]
+            if not old:
+                continue
+            append_gz(os.path.join(self.archive_dir, f"{seg}.ndjson.gz"), old)
+            self._write_segment(seg, [r for r in rows if not select(r)])
+            moved += len(old)
+        return moved
+
+    def archived_rows(self) -> list:
+        if not os.path.isdir(self.archive_dir):
+            return []
+        out = []
+        for name in sorted(os.listdir(self.archive_dir)):
+            if name.endswith(".ndjson.gz"):
+                out.extend(read_gz(os.path.join(self.archive_dir, name)))
+        return out
+
+    def sizes(self) -> dict:
+        self._ensure_dir()
+        hot_n, hot_b = _dir_size(self.dir)
+        arc_n, arc_b = _dir_size(self.archive_dir)
+        return {"hot_segments": hot_n, "hot_bytes": hot_b, "archive_segments": arc_n, "archive_bytes": arc_b}
+
+    def query(self, where: Callable[[dict], bool], day_from: Optional[str] = None, day_to: Optional[str] = None,
+              cursor: Optional[str] = None, limit: Optional[int] = None, **_filters) -> tuple[list, Optional[str]]:
+        """Righe dalla più recente, filtrate con ``where``; apre solo i mesi nell'intervallo di date.
+
+        Il cursore ``AAAA-MM:i`` indica l'ultima riga restituita.
+        """
+        if cursor and not re.match(r"^\d{4}-\d{2}:\d+$", cursor):
+            raise ValueError("cursore non valido")
+        segs = self.segments()
+        if day_from or day_to:
+            segs = [s for s in segs if s != UNDATED_SEGMENT
+                    and (not day_from or s >= day_from[:7]) and (not day_to or s <= day_to[:7])]
+        start_seg, start_i = None, None
+        if cursor:
+            start_seg, _, i = cursor.partition(":")
+            start_i = int(i)
+            segs = [s for s in segs if s <= start_seg]
+        out = []
+        for seg in reversed(segs):
+            rows = self.read_segment(seg)
+            top = start_i if seg == start_seg else len(rows)
+            for i in range(top - 1, -1, -1):
+                if where(rows[i]):
+                    if limit is not None and len(out) >= limit:
+                        return out, f"{seg}:{i + 1}"
+                    out.append(dict(rows[i]))
+        return out, None
+
+    def close(self):
+        self._cache.clear()
+
+
+# =========================
+#  INDICI SECONDARI
+# =========================
+
+class HashIndex:
+    """Indice chiave -> insieme di id. ``key(rec)`` None = record non indicizzato."""
+
+    def __init__(self, key: Callable[[dict], Optional[str]]):
+        self.key = key
+        self._ids: dict[str, set] = {}
+        self._key_of: dict[str, str] = {}
+
+    def clear(self):
+        self._ids, self._key_of = {}, {}
+
+    def add(self, rid: str, rec: dict):
+        self.add_key(rid, self.key(rec))
+
+    def add_key(self, rid: str, k):
+        """Come ``add``, con la chiave già calcolata."""
+        if k is None:
+            return
+        ids = self._ids.get(k)
+        if ids is None:
+            ids = self._ids[k] = set()
+            self._new_key(k)
+        ids.add(rid)
+        self._key_of[rid] = k
+
+    def build(self, items: Iterable[tuple[str, dict]]):
+        """Ricostruisce l'indice da zero su (id, record)."""
+        self.clear()
+        ids_of, key_of = self._ids, self._key_of
+        for rid, rec in items:
+            k = self.key(rec)
+            if k is None:
+                continue
+            ids = ids_of.get(k)
+            if ids is None:
+                ids = ids_of[k] = set()
+            ids.add(rid)
+            key_of[rid] = k
+
+    def remove(self, rid: str):
+        k = self._key_of.pop(rid, None)
+        if k is None:
+            return
+        ids = self._ids[k]
+        ids.discard(rid)
+        if not ids:
+            del self._ids[k]
+            self._drop_key(k)
+
+    def _new_key(self, k):
+        pass
+
+    def _drop_key(self, k):
+        pass
+
+    def get(self, k) -> set:
+        return self._ids.get(k, set())
+
+    def items(self):
+        return self._ids.items()
+
+
+class SortedIndex(HashIndex):
+    """HashIndex con le chiavi tenute ordinate, per le ricerche per intervallo."""
+
+    def __init__(self, key: Callable[[dict], Optional[str]]):
+        super().__init__(key)
+        self._keys: list = []
+
+    def clear(self):
+        super().clear()
+        self._keys = []
+
+    def build(self, items: Iterable[tuple[str, dict]]):
+        super().build(items)
+        self._keys = sorted(self._ids)   # un solo ordinamento invece di un insort per chiave
+
+    def _new_key(self, k):
+        bisect.insort(self._keys, k)
+
+    def _drop_key(self, k):
+        i = bisect.bisect_left(self._keys, k)
+        if i < len(self._keys) and self._keys[i] == k:
+            del self._keys[i]
+
+    def range(self, lo=None, hi=None, after=None):
+        """(chiave, ids) con lo <= chiave <= hi (e chiave > after), in ordine di chiave."""
+        i = 0 if lo is None else bisect.bisect_left(self._keys, lo)
+        if after is not None:
+            i = max(i, bisect.bisect_right(self._keys, after))
+        j = len(self._keys) if hi is None else bisect.bisect_right(self._keys, hi)
+        for k in self._keys[i:j]:
+            yield k, self._ids[k]
+
+    def last(self):
+        """Chiave più alta (None se l'indice è vuoto)."""
+        return self._keys[-1] if self._keys else None
+
+
+# =========================
+#  STORE
+# =========================
+
+class RecordStore:
+    """Record in memoria con indice per id; thread-safe.
+
+    Se la persistenza segnala modifiche fatte da altri processi
+    (``is_stale``) i dati vengono ricaricati al primo accesso.
+
+    ``normalize(rec) -> bool`` viene applicata a ogni record al caricamento
+    (id mancanti, timestamp, prima ricorrenza...): se modifica qualcosa il
+    file viene riscritto subito, così la migrazione avviene una volta sola.
+    I metodi restituiscono copie: l'indice si aggiorna solo tramite put/delete.
+    Gli indici secondari registrati con ``add_index`` vengono mantenuti
+    a ogni modifica e ricostruiti a ogni (ri)caricamento.
+    Con più processi sulla stessa cartella ``lock`` è un ``FileLock``: le
+    letture lo prendono condiviso, le scritture esclusivo e ricaricano prima
+    i dati se un altro processo li ha cambiati.
+    """
+
+    def __init__(self, persist, normalize: Optional[Callable[[dict], bool]] = None,
+                 lock: Optional[FileLock] = None):
+        self.persist = persist
+        self._normalize = normalize
+        self._lock = lock or FileLock()
+        self._by_id: dict[str, dict] = {}
+        self._order: list[str] = []
+        self._indexes: dict[str, HashIndex] = {}
+        self._loaded = False
+
+    # --- indici ---
+    def add_index(self, name: str, index: HashIndex):
+        with self._lock.exclusive():
+            self._indexes[name] = index
+            if self._loaded:
+                index.build((rid, self._by_id[rid]) for rid in self._order)
+
+    def _reindex(self, rid: str):
+        rec = self._by_id.get(rid)
+        for index in self._indexes.values():
+            index.remove(rid)
+            if rec is not None:
+                index.add(rid, rec)
+
+    def _rebuild_indexes(self):
+        by_id = self._by_id
+        for index in self._indexes.values():
+            index.build((rid, by_id[rid]) for rid in self._order)
+
+    def lookup(self, name: str, key) -> list[dict]:
+        """Record con la chiave data nell'indice ``name``."""
+        with self._lock.shared():
+            self._ensure_loaded()
+            return [dict(self._by_id[rid]) for rid in self._indexes[name].get(key)]
+
+    def last_key(self, name: str):
+        """Chiave più alta dell'indice ordinato ``name``."""
+        with self._lock.shared():
+            self._ensure_loaded()
+            return self._indexes[name].last()
+
+    def groups(self, name: str, min_size: int = 2) -> list[list[dict]]:
+        """Gruppi di record con la stessa chiave nell'indice ``name`` (almeno ``min_size``)."""
+        with self._lock.shared():
+            self._ensure_loaded()
+            return [[dict(self._by_id[rid]) for rid in sorted(ids)]
+                    for _, ids in self._indexes[name].items() if len(ids) >= min_size]
+
+    def range(self, name: str, lo=None, hi=None, limit: Optional[int] = None, after=None,
+              where: Optional[Callable[[dict], bool]] = None) -> list[tuple]:
+        """(chiave, record) con lo <= chiave <= hi dall'indice ordinato ``name``.
+
+        ``after``: riparte dalla chiave successiva (paginazione a cursore);
+        ``where(rec)``: filtro aggiuntivo, valutato prima della copia.
+        """
+        with self._lock.shared():
+            self._ensure_loaded()
+            out = []
+            for k, ids in self._indexes[name].range(lo, hi, after):
+                for rid in ids:
+                    if limit is not None and len(out) >= limit:
+                        return out
+                    rec = self._by_id[rid]
+                    if where is None or where(rec):
+                        out.append((k, dict(rec)))
+            return out
+
+    def key_ids(self, name: str, lo=None, hi=None) -> list[tuple]:
+        """(chiave, [id, ...]) con lo <= chiave <= hi dall'indice ordinato ``name``, senza copiare i record."""
+        with self._lock.shared():
+            self._ensure_loaded()
+            return [(k, list(ids)) for k, ids in self._indexes[name].range(lo, hi)]
+
+    # --- caricamento ---
+    def _ensure_loaded(self):
+        if self._loaded and not self.persist.is_stale():
+            return
+        data = self.persist.load()
+        changed = False
+        by_id, order = {}, []
+        for r in data:
+            if self._normalize and self._normalize(r):
+                changed = True
+            rid = r["id"]
+            if rid not in by_id:
+                order.append(rid)
+            by_id[rid] = r
+        self._by_id, self._order = by_id, order
+        self._rebuild_indexes()
+        self._loaded = True
+        if changed:
+            with self._lock.exclusive():
+                # la promozione del lock può lasciar passare un altro processo: in quel caso
+                # i suoi dati vincono e la normalizzazione si ripete alla prossima lettura
+                if not self.persist.is_stale():
+                    self.persist.write(self._order, self._by_id, self._order)
+
+    def version(self):
+        """Versione dei dati persistiti (per ETag e cache dei client).
+
+        Lo store residente viene prima caricato: il primo caricamento può
+        scrivere su disco (migrazione, snapshot iniziale) e cambiare la firma.
+        """
+        with self._lock.shared():
+            self._ensure_loaded()
+            return self.persist.version()
+
+    @contextmanager
+    def transaction(self):
+        """Blocca lo store per una sequenza lettura-modifica-scrittura atomica."""
+        with self._lock.exclusive():
+            self._ensure_loaded()
+            yield self
+
+    @contextmanager
+    def snapshot(self):
+        """Più letture coerenti tra loro: nessun altro processo scrive nel frattempo."""
+        with self._lock.shared():
+            self._ensure_loaded()
+            yield self
+
+    # --- letture ---
+    def __len__(self):
+        with self._lock.shared():
+            self._ensure_loaded()
+            return len(self._order)
+
+    def get(self, rid: str) -> Optional[dict]:
+        with self._lock.shared():
+            self._ensure_loaded()
+            r = self._by_id.get(rid)
+            return dict(r) if r is not None else None
+
+    def all(self) -> list[dict]:
+        with self._lock.shared():
+            self._ensure_loaded()
+            return [dict(self._by_id[rid]) for rid in self._order]
+
+    # --- scritture ---
+    def put(self, rec: dict) -> dict:
+        return self.put_many([rec])[0]
+
+    def put_many(self, recs: list[dict]) -> list[dict]:
+        """Inserisce/sostituisce i record (per id) e li persiste in un'unica scrittura."""
+        if not recs:
+            return []
+        with self._lock.exclusive():
+            self._ensure_loaded()
+            indexes = list(self._indexes.values())
+            # chiavi calcolate prima di toccare lo stato: se una fallisce nessun record resta a metà
+            keyed = [(rec, [index.key(rec) for index in indexes]) for rec in recs]
+            dirty = []
+            for rec, keys in keyed:
+                rid = rec["id"]
+                if rid not in self._by_id:
+                    self._order.append(rid)
+                self._by_id[rid] = dict(rec)
+                for index, k in zip(indexes, keys):
+                    index.remove(rid)
+                    index.add_key(rid, k)
+                dirty.append(rid)
+            self.persist.write(self._order, self._by_id, dirty)
+            return [dict(self._by_id[rid]) for rid in dirty]
+
+    def delete_many(self, ids: Iterable[str]) -> int:
+        """Elimina i record indicati (gli id assenti vengono ignorati)."""
+        with self._lock.exclusive():
+            self._ensure_loaded()
+            gone = [rid for rid in dict.fromkeys(ids) if rid in self._by_id]
+            if not gone:
+                return 0
+            for rid in gone:
+                del self._by_id[rid]
+                self._reindex(rid)
+            drop = set(gone)
+            self._order = [rid for rid in self._order if rid not in drop]
+            self.persist.write(self._order, self._by_id, (), gone)
+            return len(gone)
+
+    def replace_all(self, recs: list[dict]):
+        """Sostituisce l'intero contenuto (conversione tra backend, vedi storage_tool)."""
+        with self._lock.exclusive():
+            self._ensure_loaded()
+            old = self._by_id
+            by_id, order = {}, []
+            for rec in recs:
+                rid = rec["id"]
+                if rid not in by_id:
+                    order.append(rid)
+                by_id[rid] = dict(rec)
+            dirty = [rid for rid in order if old.get(rid) != by_id[rid]]
+            deleted = [rid for rid in old if rid not in by_id]
+            self._by_id, self._order = by_id, order
+            self._rebuild_indexes()
+            self.persist.write(self._order, self._by_id, dirty, deleted)
+
+
+# stati che NON contano come "già inviato" (l'invio va ritentato)
+RETRY_STATES = ("errore",)
+# stati definitivi di un invio riuscito
+SUCCESS_STATES = ("ok", "test")
+
+
+class SentKeyIndex:
+    """Indice (record_id, due_date) -> stato, su file sidecar append-only.
+
+    Una riga ``record_id<TAB>due_date<TAB>stato`` per invio. Il file viene
+    letto solo alla prima verifica (senza caricare il registro completo) e,
+    se manca, ricostruito dalle righe del registro. Le righe aggiunte da altri
+    processi si leggono in coda (dall'ultima posizione letta); se il file è
+    stato riscritto si rilegge tutto.
+    """
+
+    def __init__(self, path: str, rebuild: Callable[[], list]):
+        self.path = path
+        self._rebuild = rebuild
+        self._map: Optional[dict] = None
+        self._ino = None
+        self._offset = 0   # byte già letti
+
+    @staticmethod
+    def _merge(m: dict, key: tuple, stato):
+        # vale l'ultimo stato, ma un invio riuscito non viene "declassato"
+        # da un tentativo fallito successivo
+        if m.get(key) in SUCCESS_STATES and stato in RETRY_STATES:
+            return
+        m[key] = stato
+
+    def _read_from(self, offset: int):
+        with open(self.path, "rb") as f:
+            self._ino = os.fstat(f.fileno()).st_ino
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1   # una riga a metà (scrittura in corso) si rilegge dopo
+        for line in data[:end].decode("utf-8").splitlines():
+            parts = line.split("\t")
+            if len(parts) == 3:
+                self._merge(self._map, (parts[0], parts[1]), parts[2] or None)
+        self._offset = offset + end
+
+    def _ensure_loaded(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        if self._map is not None and st is not None and st.st_ino == self._ino and st.st_size >= self._offset:
+            if st.st_size > self._offset:
+                self._read_from(self._offset)   # righe appese da altri processi
+            return
+        if st is not None:
+            self._map = {}
+            self._read_from(0)
+        else:
+            self._map = {}
+            self.rewrite(self._rebuild())
+
+    @staticmethod
+    def _line(row: dict) -> Optional[str]:
+        if not row.get("record_id") or not row.get("due_date"):
+            return None
+        return f"{row['record_id']}\t{row['due_date']}\t{row.get('stato') or ''}\n"
+
+    def state(self, record_id: str, due_date: str) -> Optional[str]:
+        self._ensure_loaded()
+        return self._map.get((record_id, due_date))
+
+    def add(self, rows: list):
+        lines = [ln for ln in map(self._line, rows) if ln]
+        if not lines:
+            return
+        self._ensure_loaded()
+        for r in rows:
+            if self._line(r):
+                self._merge(self._map, (r["record_id"], r["due_date"]), r.get("stato"))
+        data = "".join(lines).encode("utf-8")
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            if os.fstat(f.fileno()).st_size == self._offset + len(data):
+                self._offset += len(data)   # nessun altro ha scritto nel frattempo
+
+    def rewrite(self, rows: list):
+        m = {}
+        for r in rows:
+            if self._line(r):
+                self._merge(m, (r["record_id"], r["due_date"]), r.get("stato"))
+        text = "".join(ln for ln in map(self._line, rows) if ln)
+        _atomic_write(self.path, text)
+        self._map = m
+        self._ino = os.stat(self.path).st_ino
+        self._offset = len(text.encode("utf-8"))
+
+
+class SentLog:
+    """Registro degli invii.
+
+    ``state`` usa l'indice (record_id, due_date): con ``keys_path`` è
+    un file sidecar, altrimenti lo fornisce la persistenza (``key_index``).
+    Le righe restano su disco (segmenti mensili o tabella SQLite): si leggono
+    con ``query`` solo le parti che servono.
+    """
+
+    def __init__(self, persist, keys_path: Optional[str] = None, lock: Optional[FileLock] = None):
+        self.persist = persist
+        self._lock = lock or FileLock()
+        # l'indice anti-duplicati copre anche le righe archiviate
+        self.keys = SentKeyIndex(keys_path, lambda: persist.archived_rows() + self.rows()) \
+            if keys_path else persist.key_index()
+        self.keys_path = keys_path
+
+    def state(self, record_id: Optional[str], due_date: str) -> Optional[str]:
+        """Stato dell'invio registrato per (record, giorno), None se assente."""
+        if not record_id:
+            return None
+        with self._lock.shared():
+            return self.keys.state(record_id, due_date)
+
+    def rows(self) -> list:
+        """Tutto il registro (export/conversione): legge ogni segmento."""
+        with self._lock.shared():
+            return self.persist.load()
+
+    def query(self, record_id: Optional[str] = None, stati: Optional[Iterable[str]] = None,
+              day_from: Optional[str] = None, day_to: Optional[str] = None,
+              cursor: Optional[str] = None, limit: Optional[int] = None) -> tuple[list, Optional[str]]:
+        """Righe dalla più recente con i filtri dati; ritorna (righe, cursore successivo)."""
+        stati = set(stati) if stati else None
+
+        def where(r: dict) -> bool:
+            if record_id and r.get("record_id") != record_id:
+                return False
+            if stati is not None and r.get("stato") not in stati:
+                return False
+            if day_from or day_to:
+                day = sent_day(r)
+                if not day or (day_from and day < day_from) or (day_to and day > day_to):
+                    return False
+            return True
+
+        with self._lock.shared():
+            return self.persist.query(where, day_from=day_from, day_to=day_to, cursor=cursor, limit=limit,
+                                      record_id=record_id, stati=stati)
+
+    def append(self, new_rows: list):
+        if not new_rows:
+            return
+        with self._lock.exclusive():
+            self.persist.add(new_rows)
+            self.keys.add(new_rows)
+
+    def update(self, record_id: str, due_date: str, fields: dict) -> Optional[dict]:
+        """Aggiorna l'ultima riga di (record, giorno), es. stato/errore dopo un invio in coda."""
+        with self._lock.exclusive():
+            row = self.persist.update_last(record_id, due_date, fields)
+            if row is not None:
+                self.keys.add([row])
+            return row
+
+    def replace(self, rows: list):
+        with self._lock.exclusive():
+            self.persist.replace(list(rows))
+            self.keys.rewrite(self.persist.archived_rows() + list(rows))
+
+    def version(self):
+        """Versione del registro su disco, senza leggerlo."""
+        return self.persist.version()
+
+    def sizes(self) -> dict:
+        """Occupazione su disco: righe "calde", archivio compresso e indice anti-duplicati."""
+        with self._lock.shared():
+            out = self.persist.sizes()
+        if self.keys_path and os.path.exists(self.keys_path):
+            out["keys_bytes"] = os.path.getsize(self.keys_path)
+        return out
+
+    def compact(self, cutoffs: dict[str, str]) -> dict:
+        """Archivia le righe oltre la retention (vedi ``archive_predicate``); ritorna le dimensioni prima/dopo.
+
+        Senza limiti (politica vuota) non tocca nulla.
+        """
+        if not cutoffs:
+            sizes = self.sizes()
+            return {"archived": 0, "before": sizes, "after": sizes}
+        with self._lock.exclusive():
+            before = self.sizes()
+            moved = self.persist.archive(cutoffs)
+            after = self.sizes()
+        return {"archived": moved, "before": before, "after": after}
+
+
+# =========================
+#  DOCUMENTI DI CONFIGURAZIONE
+# =========================
+
+DOC_NAMES = ("auth", "email_settings", "email_templates", "record_tombstones")
+
+
+class JsonDocStore:
+    """Documenti (auth, email_settings, email_templates, ...) come file <nome>.json.
+
+    ``paths`` permette di mappare un nome su un file diverso (es. app_settings).
+    """
+
+    def __init__(self, data_dir: str, paths: Optional[dict[str, str]] = None):
+        self.data_dir = data_dir
+        self.paths = paths or {}
+
+    def path(self, name: str) -> str:
+        return self.paths.get(name) or os.path.join(self.data_dir, f"{name}.json")
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def stamp(self, name: str):
+        """Firma del file (mtime, dimensione, inode): cambia a ogni riscrittura."""
+        try:
+            st = os.stat(self.path(name))
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def load(self, name: str, default):
+        """Se il documento non esiste viene creato con il valore di default."""
+        path = self.path(name)
+        if not os.path.exists(path):
+            self.save(name, default)
+            return default
+        with open(path, "r", encoding="utf-8") as f:
+            return loads(f.read())
+
+    def save(self, name: str, data):
+        _atomic_write(self.path(name), dumps(data, pretty=JSON_PRETTY))
+
+    def close(self):
+        pass
+
+
+class CachedDocStore:
+    """Cache in memoria davanti a un doc store (JSON o SQLite).
+
+    Le letture restituiscono una copia del valore in cache; ``save`` scrive e
+    aggiorna la cache (write-through). Le modifiche fatte da fuori (altro
+    processo, modifica a mano del file) si rilevano confrontando ``stamp(name)``
+    del doc store, al massimo una volta ogni ``check_every`` secondi: nel
+    frattempo le letture non toccano il disco.
+    """
+
+    def __init__(self, inner, check_every: float = 1.0, lock: Optional[FileLock] = None):
+        self.inner = inner
+        self.check_every = check_every
+        self._lock = threading.RLock()
+        self._cache: dict[str, tuple] = {}   # nome -> (stamp, verificato_alle, valore)
+        self.file_lock = lock or FileLock()
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def _fresh(self, name: str):
+        hit = self._cache.get(name)
+        if hit is None:
+            return None
+        stamp, checked, value = hit
+        now = time.monotonic()
+        if now - checked < self.check_every:
+            return hit
+        if self.inner.stamp(name) != stamp:
+            del self._cache[name]
+            return None
+        self._cache[name] = hit = (stamp, now, value)
+        return hit
+
+    def load(self, name: str, default):
+        with self._lock:
+            hit = self._fresh(name)
+            if hit is None:
+                stamp = self.inner.stamp(name)
+                value = self.inner.load(name, default)
+                if stamp is None:   # creato ora con il default
+                    stamp = self.inner.stamp(name)
+                hit = self._cache[name] = (stamp, time.monotonic(), value)
+            return copy.deepcopy(hit[2])
+
+    def exists(self, name: str) -> bool:
+        with self._lock:
+            return self._fresh(name) is not None or self.inner.exists(name)
+
+    def version(self, name: str):
+        """Versione del documento: la firma in cache finché è fresca, senza toccare il disco."""
+        with self._lock:
+            hit = self._fresh(name)
+            return hit[0] if hit is not None else self.inner.stamp(name)
+
+    def save(self, name: str, data):
+        with self.file_lock.exclusive(), self._lock:
+            self.inner.save(name, data)
+            self._cache[name] = (self.inner.stamp(name), time.monotonic(), copy.deepcopy(data))
+
+    @contextmanager
+    def locked(self):
+        """Lettura-modifica-scrittura tra processi: lock esclusivo e letture senza cache."""
+        with self.file_lock.exclusive():
+            self.invalidate()
+            yield self
+
+    def invalidate(self, name: Optional[str] = None):
+        with self._lock:
+            if name is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(name, None)
+
+    def close(self):
+        self.invalidate()
+        self.inner.close()
+
+
+# =========================
+#  BACKEND
+# =========================
+
+STORAGE_MODES = ("json", "journal", "sqlite")
+SENT_DIR = "sent"   # segmenti mensili del registro invii (modalità json e journal)
+
+
+def _legacy_journal_sent(data_dir: str) -> list:
+    """Registro invii del vecchio formato journal (snapshot + log), o in mancanza sent_emails.json."""
+    snap = os.path.join(data_dir, "sent_emails.snapshot.json")
+    wal = os.path.join(data_dir, "sent_emails.wal")
+    if os.path.exists(snap) or os.path.exists(wal):
+        return JournaledListFile(snap, wal).load()
+    return JsonListFile(os.path.join(data_dir, "sent_emails.json")).load()
+
+
+class Backend:
+    """Raggruppa record, registro invii e documenti di una cartella dati."""
+
+    def __init__(self, mode: str, data_dir: str, records: RecordStore, sent: SentLog, docs,
+                 outbox: RecordStore, locks: Optional[dict[str, FileLock]] = None):
+        self.mode = mode
+        self.data_dir = data_dir
+        self.records = records
+        self.sent = sent
+        self.docs = docs
+        self.outbox = outbox  # messaggi in coda di invio (vedi outbox.py)
+        self.locks = locks or {}
+
+    def close(self):
+        for part in (self.records.persist, self.sent.persist, self.outbox.persist, self.docs):
+            close = getattr(part, "close", None)
+            if close:
+                close()
+        for lock in self.locks.values():
+            lock.close()
+
+
+def open_backend(mode: str, data_dir: str, normalize: Optional[Callable[[dict], bool]] = None,
+                 compact_every: int = 1000, migrate: bool = True, doc_check_every: float = 1.0) -> Backend:
+    """Apre il backend scelto (json | journal | sqlite) sulla cartella dati.
+
+    Con ``migrate`` i backend journal/sqlite, al primo avvio, importano i file
+    JSON classici presenti nella cartella. I documenti di configurazione sono
+    serviti da una cache (vedi ``CachedDocStore``).
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    # un file .lock per store: coordina più processi (worker) sulla stessa cartella
+    locks = {name: FileLock(os.path.join(data_dir, f"{name}.lock")) for name in ("records", "sent", "outbox", "docs")}
+    records_path = os.path.join(data_dir, "records.json")
+    sent_path = os.path.join(data_dir, "sent_emails.json")
+    sent_dir = os.path.join(data_dir, SENT_DIR)
+    if mode == "json":
+        records = JsonRecordFile(records_path)
+        sent = SegmentedListFile(sent_dir, legacy=JsonListFile(sent_path).load if migrate else None, lock=locks["sent"])
+        docs = JsonDocStore(data_dir)
+        outbox = JsonRecordFile(os.path.join(data_dir, "outbox.json"))
+    elif mode == "journal":
+        records = JournaledRecordFile(
+            os.path.join(data_dir, "records.snapshot.json"),
+            os.path.join(data_dir, "records.wal"),
+            legacy_path=records_path if migrate else None,
+            compact_every=compact_every,
+        )
+        sent = SegmentedListFile(sent_dir, legacy=(lambda: _legacy_journal_sent(data_dir)) if migrate else None,
+                                 lock=locks["sent"])
+        docs = JsonDocStore(data_dir)
+        outbox = JournaledRecordFile(
+            os.path.join(data_dir, "outbox.snapshot.json"),
+            os.path.join(data_dir, "outbox.wal"),
+            compact_every=compact_every,
+        )
+    elif mode == "sqlite":
+        from storage_sqlite import SqliteDatabase
+        db = SqliteDatabase(data_dir, import_legacy=migrate)
+        records, sent, docs, outbox = db.records(), db.sent(), db.docs(), db.outbox()
+    else:
+        raise ValueError(f"STORAGE_MODE non valido: {mode!r} (ammessi: {', '.join(STORAGE_MODES)})")
+    keys_path = None if mode == "sqlite" else os.path.join(data_dir, "sent_emails.keys")
+    for persist, name in ((records, "records"), (outbox, "outbox")):
+        if isinstance(persist, _Journaled):
+            persist.lock = locks[name]
+    return Backend(mode, data_dir,
+                   RecordStore(records, normalize=normalize, lock=locks["records"]),
+                   SentLog(sent, keys_path, lock=locks["sent"]),
+                   CachedDocStore(docs, doc_check_every, lock=locks["docs"]),
+                   RecordStore(outbox, lock=locks["outbox"]), locks)
@@ -0,0 +1,428 @@
+# storage_sqlite.py
+"""Backend SQLite (modalità WAL) per record, registro invii e documenti.
+
+Un unico file ``damiano.sqlite3`` nella cartella dati. Ogni tabella ha un
+contatore in ``versions`` aggiornato da trigger: le cache in memoria degli
+altri worker lo confrontano per accorgersi delle modifiche.
+"""
+import os, sqlite3, threading, uuid
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from filelock import FileLock
+from jsoncodec import loads
+from storage import _encode, RETRY_STATES, SUCCESS_STATES, SENT_DIR, ARCHIVE_DIR, _segment_of, _dir_size, append_gz, read_gz
+
+DB_NAME = "damiano.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id TEXT PRIMARY KEY,
+    prossima_ricorrenza TEXT,
+    updated_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_records_prossima ON records(prossima_ricorrenza);
+
+CREATE TABLE IF NOT EXISTS sent_emails (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    record_id TEXT,
+    due_date TEXT,
+    sent_at TEXT,
+    stato TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sent_record_due ON sent_emails(record_id, due_date);
+-- giorno di riferimento (due_date o giorno di sent_at): filtri per data di /emails/sent
+CREATE INDEX IF NOT EXISTS idx_sent_day ON sent_emails(COALESCE(due_date, substr(sent_at, 1, 10)));
+
+-- chiavi anti-duplicati delle righe spostate in archivio (retention)
+CREATE TABLE IF NOT EXISTS sent_archived_keys (
+    record_id TEXT NOT NULL,
+    due_date TEXT NOT NULL,
+    stato TEXT,
+    PRIMARY KEY (record_id, due_date)
+);
+
+CREATE TABLE IF NOT EXISTS outbox (
+    id TEXT PRIMARY KEY,
+    status TEXT,
+    updated_at TEXT,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS docs (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT PRIMARY KEY,
+    n INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO versions(name, n) VALUES ('records', 0), ('sent_emails', 0), ('docs', 0), ('outbox', 0);
+"""
+
+_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS trg_{table}_{ev} AFTER {EV} ON {table}
+BEGIN UPDATE versions SET n = n + 1 WHERE name = '{table}'; END;
+"""
+
+
+def _sql_list(values: tuple) -> str:
+    return "(" + ", ".join("'" + v.replace("'", "''") + "'" for v in values) + ")"
+
+
+class SqliteDatabase:
+    """Connessione condivisa (protetta da lock) e fabbrica delle tre persistenze."""
+
+    def __init__(self, data_dir: str, import_legacy: bool = True):
+        self.path = os.path.join(data_dir, DB_NAME)
+        self.lock = threading.RLock()
+        self._closed = False
+        # creazione e import dei JSON in esclusiva: con più worker all'avvio uno solo
+        # trova il database nuovo, gli altri aspettano e lo trovano già importato
+        init_lock = FileLock(self.path + ".lock")
+        try:
+            with init_lock.exclusive():
+                fresh = not os.path.exists(self.path)
+                self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("PRAGMA synchronous=NORMAL")
+                self.conn.execute("PRAGMA busy_timeout=30000")
+                script = SCHEMA
+                for table in ("records", "sent_emails", "docs", "outbox"):
+                    for ev in ("insert", "update", "delete"):
+                        script += _TRIGGER.format(table=table, ev=ev, EV=ev.upper())
+                self.conn.executescript(script)
+                if fresh and import_legacy:
+                    self._import_legacy_json(data_dir)
+        finally:
+            init_lock.close()
+
+    def _import_legacy_json(self, data_dir: str):
+        """Primo avvio in modalità sqlite: importa i file JSON esistenti nella cartella."""
+        from storage import JsonRecordFile, JsonListFile, JsonDocStore, SegmentedListFile, DOC_NAMES
+        recs = JsonRecordFile(os.path.join(data_dir, "records.json")).load()
+        for r in recs:
+            r["id"] = r.get("id") or uuid.uuid4().hex  # gli altri campi li completa lo store al caricamento
+        sent_dir = os.path.join(data_dir, SENT_DIR)
+        if os.path.isdir(sent_dir):
+            rows = SegmentedListFile(sent_dir, lock=FileLock(os.path.join(data_dir, "sent.lock"))).load()
+        else:
+            rows = JsonListFile(os.path.join(data_dir, "sent_emails.json")).load()
+        json_docs = JsonDocStore(data_dir)
+        if recs:
+            by_id = {r["id"]: r for r in recs}
+            self.records().write(list(by_id), by_id, list(by_id))
+        if rows:
+            self.sent().add(rows)
+        docs = self.docs()
+        for name in DOC_NAMES:
+            if json_docs.exists(name):
+                docs.save(name, json_docs.load(name, None))
+
+    def version(self, name: str) -> int:
+        row = self.conn.execute("SELECT n FROM versions WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def records(self) -> "SqliteRecordFile":
+        return SqliteRecordFile(self)
+
+    def outbox(self) -> "SqliteRecordFile":
+        return SqliteRecordFile(self, table="outbox", column="status")
+
+    def sent(self) -> "SqliteListFile":
+        return SqliteListFile(self)
+
+    def docs(self) -> "SqliteDocStore":
+        return SqliteDocStore(self)
+
+    def close(self):
+        with self.lock:
+            if self._closed:
+                return
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.conn.close()
+            self._closed = True
+
+
+class _Versioned:
+    """Tiene traccia dell'ultima versione vista della tabella."""
+
+    table = ""
+
+    def __init__(self, db: SqliteDatabase):
+        self.db = db
+        self._seen = -1
+
+    def is_stale(self) -> bool:
+        with self.db.lock:
+            return self.db.version(self.table) != self._seen
+
+    def version(self) -> int:
+        """Contatore della tabella (aggiornato dai trigger a ogni scrittura)."""
+        with self.db.lock:
+            return self.db.version(self.table)
+
+    def _write(self, fn):
+        """Esegue fn() in una transazione; se nel frattempo un altro processo ha
+        scritto, la versione vista non avanza e la cache verrà ricaricata."""
+        conn = self.db.conn
+        with self.db.lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = self.db.version(self.table)
+                fn(conn)
+                after = self.db.version(self.table)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            if before == self._seen:
+                self._seen = after
+
+    def close(self):
+        self.db.close()
+
+
+class SqliteRecordFile(_Versioned):
+    """Record: JSON completo in ``data`` più le colonne indicizzate.
+
+    Usata anche per la tabella ``outbox`` (con la colonna ``status``).
+    """
+
+    def __init__(self, db: SqliteDatabase, table: str = "records", column: str = "prossima_ricorrenza"):
+        super().__init__(db)
+        self.table = table
+        self.column = column
+
+    def load(self) -> list[dict]:
+        with self.db.lock:
+            self._seen = self.db.version(self.table)
+            rows = self.db.conn.execute(f"SELECT data FROM {self.table} ORDER BY rowid").fetchall()
+        return [loads(r[0]) for r in rows]
+
+    def write(self, order: list[str], by_id: dict[str, dict], dirty: Iterable[str], deleted: Iterable[str] = ()):
+        puts = [by_id[rid] for rid in dirty if rid in by_id]
+        dels = [(rid,) for rid in deleted]
+
+        t, col = self.table, self.column
+
+        def fn(conn):
+            conn.executemany(
+                f"INSERT INTO {t}(id, {col}, updated_at, data) VALUES (?, ?, ?, ?) "
+                f"ON CONFLICT(id) DO UPDATE SET {col} = excluded.{col}, "
+                "updated_at = excluded.updated_at, data = excluded.data",
+                [(r["id"], r.get(col), r.get("updated_at"), _encode(r)) for r in puts],
+            )
+            if dels:
+                conn.executemany(f"DELETE FROM {t} WHERE id = ?", dels)
+
+        self._write(fn)
+
+
+class SqliteListFile(_Versioned):
+    """Registro invii: una riga per invio, indice su (record_id, due_date)."""
+
+    table = "sent_emails"
+
+    @staticmethod
+    def _params(rows: list) -> list[tuple]:
+        return [(r.get("record_id"), r.get("due_date"), r.get("sent_at"), r.get("stato"), _encode(r)) for r in rows]
+
+    def load(self) -> list:
+        with self.db.lock:
+            self._seen = self.db.version(self.table)
+            rows = self.db.conn.execute("SELECT data FROM sent_emails ORDER BY id").fetchall()
+        return [loads(r[0]) for r in rows]
+
+    def add(self, new_rows: list):
+        self._write(lambda conn: conn.executemany(
+            "INSERT INTO sent_emails(record_id, due_date, sent_at, stato, data) VALUES (?, ?, ?, ?, ?)",
+            self._params(new_rows),
+        ))
+
+    def update_last(self, record_id: str, due_date: str, fields: dict):
+        with self.db.lock:
+            row = self.db.conn.execute(
+                "SELECT id, data FROM sent_emails WHERE record_id = ? AND due_date = ? ORDER BY id DESC LIMIT 1",
+                (record_id, due_date),
+            ).fetchone()
+        if row is None:
+            return None
+        rowid, data = row[0], {**loads(row[1]), **fields}
+        self._write(lambda conn: conn.execute(
+            "UPDATE sent_emails SET stato = ?, sent_at = ?, data = ? WHERE id = ?",
+            (data.get("stato"), data.get("sent_at"), _encode(data), rowid),
+        ))
+        return data
+
+    def query(self, where, day_from=None, day_to=None, cursor=None, limit=None,
+              record_id=None, stati=None) -> tuple[list, Optional[str]]:
+        """Come SegmentedListFile.query, con i filtri tradotti in SQL (indici su record_id/due_date).
+
+        Il cursore è l'id dell'ultima riga restituita.
+        """
+        sql, params = "SELECT id, data FROM sent_emails WHERE 1 = 1", []
+        if cursor:
+            sql += " AND id < ?"
+            params.append(int(cursor))
+        if record_id:
+            sql += " AND record_id = ?"
+            params.append(record_id)
+        if stati:
+            sql += f" AND stato IN ({', '.join('?' * len(stati))})"
+            params.extend(stati)
+        if day_from:
+            sql += " AND COALESCE(due_date, substr(sent_at, 1, 10)) >= ?"
+            params.append(day_from)
+        if day_to:
+            sql += " AND COALESCE(due_date, substr(sent_at, 1, 10)) <= ?"
+            params.append(day_to)
+        sql += " ORDER BY id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+        with self.db.lock:
+            rows = self.db.conn.execute(sql, params).fetchall()
+        out = [loads(data) for _, data in rows]
+        if limit is not None and len(out) > limit:
+            return out[:limit], str(rows[limit - 1][0])
+        return out, None
+
+    # --- archivio (retention) ---
+    @property
+    def archive_dir(self) -> str:
+        return os.path.join(os.path.dirname(self.db.path), SENT_DIR, ARCHIVE_DIR)
+
+    def archive(self, cutoffs: dict[str, str]) -> int:
+        """Sposta nell'archivio gzip le righe oltre la retention; le chiavi restano in ``sent_archived_keys``."""
+        day = "COALESCE(due_date, substr(sent_at, 1, 10), '')"
+        named = [st for st in cutoffs if st != "*"]
+        conds, params = [], []
+        for st in named:
+            conds.append(f"(stato = ? AND {day} < ?)")
+            params += [st, cutoffs[st]]
+        if "*" in cutoffs:
+            others = f"stato NOT IN ({', '.join('?' * len(named))})" if named else "1 = 1"
+            conds.append(f"((stato IS NULL OR {others}) AND {day} < ?)")
+            params += named + [cutoffs["*"]]
+        if not conds:
+            return 0
+        with self.db.lock:
+            rows = self.db.conn.execute(
+                f"SELECT id, data FROM sent_emails WHERE {' OR '.join(conds)} ORDER BY id", params).fetchall()
+            if not rows:
+                return 0
+            by_seg = defaultdict(list)
+            for _, data in rows:
+                r = loads(data)
+                by_seg[_segment_of(r)].append(r)
+            for seg, seg_rows in by_seg.items():
+                append_gz(os.path.join(self.archive_dir, f"{seg}.ndjson.gz"), seg_rows)
+            keys = {}
+            for seg_rows in by_seg.values():
+                for r in seg_rows:
+                    if r.get("record_id") and r.get("due_date"):
+                        k = (r["record_id"], r["due_date"])
+                        if not (keys.get(k) in SUCCESS_STATES and r.get("stato") in RETRY_STATES):
+                            keys[k] = r.get("stato")
+            ids = [(rid,) for rid, _ in rows]
+
+            def fn(conn):
+                conn.executemany(
+                    "INSERT INTO sent_archived_keys(record_id, due_date, stato) VALUES (?, ?, ?) "
+                    "ON CONFLICT(record_id, due_date) DO UPDATE SET stato = excluded.stato "
+                    f"WHERE NOT (sent_archived_keys.stato IN {_sql_list(SUCCESS_STATES)} "
+                    f"AND excluded.stato IN {_sql_list(RETRY_STATES)})",
+                    [(rid, due, st) for (rid, due), st in keys.items()],
+                )
+                conn.executemany("DELETE FROM sent_emails WHERE id = ?", ids)
+
+            self._write(fn)
+            # restituisce lo spazio al filesystem
+            self.db.conn.execute("VACUUM")
+            self.db.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return len(rows)
+
+    def archived_rows(self) -> list:
+        if not os.path.isdir(self.archive_dir):
+            return []
+        out = []
+        for name in sorted(os.listdir(self.archive_dir)):
+            if name.endswith(".ndjson.gz"):
+                out.extend(read_gz(os.path.join(self.archive_dir, name)))
+        return out
+
+    def sizes(self) -> dict:
+        hot = sum(os.path.getsize(p) for p in (self.db.path, self.db.path + "-wal") if os.path.exists(p))
+        arc_n, arc_b = _dir_size(self.archive_dir)
+        return {"hot_bytes": hot, "archive_segments": arc_n, "archive_bytes": arc_b}
+
+    def key_index(self) -> "SqliteSentKeys":
+        return SqliteSentKeys(self.db)
+
+    def replace(self, rows: list):
+        def fn(conn):
+            conn.execute("DELETE FROM sent_emails")
+            conn.executemany(
+                "INSERT INTO sent_emails(record_id, due_date, sent_at, stato, data) VALUES (?, ?, ?, ?, ?)",
+                self._params(rows),
+            )
+
+        self._write(fn)
+
+
+class SqliteSentKeys:
+    """Verifica (record_id, due_date) direttamente sull'indice della tabella."""
+
+    def __init__(self, db: SqliteDatabase):
+        self.db = db
+
+    def state(self, record_id: str, due_date: str):
+        with self.db.lock:
+            # prima le righe già archiviate (retention), poi quelle correnti
+            rows = self.db.conn.execute(
+                "SELECT stato FROM sent_archived_keys WHERE record_id = ? AND due_date = ? "
+                "UNION ALL SELECT stato FROM sent_emails WHERE record_id = ? AND due_date = ?",
+                (record_id, due_date, record_id, due_date),
+            ).fetchall()
+        states = [r[0] for r in rows]
+        ok = [st for st in states if st not in RETRY_STATES]
+        return ok[-1] if ok else (states[-1] if states else None)
+
+    def add(self, rows: list):
+        pass  # le righe inserite sono già indicizzate
+
+    def rewrite(self, rows: list):
+        pass
+
+
+class SqliteDocStore(_Versioned):
+    """Documenti di configurazione nella tabella ``docs`` (nome -> JSON)."""
+
+    table = "docs"
+
+    def exists(self, name: str) -> bool:
+        with self.db.lock:
+            return self.db.conn.execute("SELECT 1 FROM docs WHERE name = ?", (name,)).fetchone() is not None
+
+    def stamp(self, name: str):
+        """Versione della tabella docs (cambia a ogni scrittura, anche da altri processi)."""
+        with self.db.lock:
+            return self.db.version(self.table)
+
+    def load(self, name: str, default):
+        with self.db.lock:
+            row = self.db.conn.execute("SELECT data FROM docs WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            self.save(name, default)
+            return default
+        return loads(row[0])
+
+    def save(self, name: str, data):
+        self._write(lambda conn: conn.execute(
+            "INSERT INTO docs(name, data) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET data = excluded.data",
+            (name, _encode(data)),
+        ))
@@ -0,0 +1,69 @@
+# storage_tool.py
+"""Conversione di una cartella dati tra i backend di storage.
+
+Esempi:
+    python storage_tool.py convert data --from json --to sqlite
+    python storage_tool.py convert data --from sqlite --to json --dest data_export
+"""
+import argparse, os, sys, uuid
+
+from storage import open_backend, STORAGE_MODES, DOC_NAMES
+
+
+def _assign_id(rec: dict) -> bool:
+    if rec.get("id"):
+        return False
+    rec["id"] = uuid.uuid4().hex
+    return True
+
+
+def convert(src_dir: str, src_mode: str, dest_dir: str, dest_mode: str, force: bool = False) -> dict:
+    """Copia record, registro invii e documenti da un backend all'altro."""
+    if os.path.abspath(src_dir) == os.path.abspath(dest_dir) and src_mode == dest_mode:
+        raise ValueError("sorgente e destinazione coincidono")
+    # json e journal nella stessa cartella condividono i segmenti del registro invii
+    shared_sent = (os.path.abspath(src_dir) == os.path.abspath(dest_dir)
+                   and "sqlite" not in (src_mode, dest_mode))
+    src = open_backend(src_mode, src_dir, normalize=_assign_id)
+    dst = open_backend(dest_mode, dest_dir, migrate=False)
+    try:
+        records = src.records.all()
+        rows = src.sent.rows()
+        if not force and (len(dst.records) or (not shared_sent and dst.sent.rows())):
+            raise ValueError("la destinazione contiene già dati (usa --force per sovrascrivere)")
+        dst.records.replace_all(records)
+        if not shared_sent:
+            dst.sent.replace(rows)
+        docs = []
+        for name in DOC_NAMES:
+            if src.docs.exists(name):
+                dst.docs.save(name, src.docs.load(name, None))
+                docs.append(name)
+    finally:
+        src.close()
+        dst.close()
+    return {"records": len(records), "sent": len(rows), "docs": docs}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Strumenti per lo storage di Damiano")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    cv = sub.add_parser("convert", help="converte una cartella dati da un backend all'altro")
+    cv.add_argument("data_dir")
+    cv.add_argument("--from", dest="src_mode", choices=STORAGE_MODES, required=True)
+    cv.add_argument("--to", dest="dest_mode", choices=STORAGE_MODES, required=True)
+    cv.add_argument("--dest", dest="dest_dir", help="cartella di destinazione (default: la stessa)")
+    cv.add_argument("--force", action="store_true", help="sovrascrive i dati già presenti nella destinazione")
+    args = ap.parse_args(argv)
+
+    try:
+        res = convert(args.data_dir, args.src_mode, args.dest_dir or args.data_dir, args.dest_mode, args.force)
+    except ValueError as e:
+        print(f"Errore: {e}", file=sys.stderr)
+        return 1
+    print(f"Convertiti {res['records']} record, {res['sent']} invii, documenti: {', '.join(res['docs']) or '-'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+# template_engine.py
+"""Rendering di oggetto/corpo delle email con template compilati una volta sola.
+
+Ogni testo distinto viene compilato al primo uso e tenuto in una cache LRU:
+- solo placeholder ``{{NOME}}``, ``{{COGNOME}}``, ... -> il testo è spezzato in
+  parti fisse e segnaposti, e il rendering è un unico ``"".join``;
+- blocchi Jinja (``{% ... %}``, ``{# ... #}``) -> template compilato in un
+  ambiente sandbox, con i placeholder disponibili come variabili.
+
+Un ``{{x}}`` sconosciuto senza blocchi Jinja resta nel testo così com'è; in
+modalità Jinja una variabile mancante viene lasciata com'era e registrata nel
+log. Se il rendering Jinja fallisce (variabile mancante usata come oggetto,
+accesso vietato dalla sandbox) si ripiega sui soli placeholder.
+"""
+import os, re, logging
+from functools import lru_cache
+
+from jinja2 import DebugUndefined, TemplateError, TemplateSyntaxError, make_logging_undefined
+from jinja2.sandbox import SandboxedEnvironment
+
+TEMPLATE_CACHE_SIZE = int(os.environ.get("TEMPLATE_CACHE_SIZE", "256"))
+
+# placeholder -> campo del record
+PLACEHOLDERS = {
+    "NOME": "nome",
+    "COGNOME": "cognome",
+    "DEF_NOME": "def_nome",
+    "DEF_COGNOME": "def_cognome",
+    "DATA_DEF": "def_data",
+    "DATA_RIC": "prossima_ricorrenza",
+}
+
+_PLACEHOLDER_RE = re.compile(r"\{\{(" + "|".join(PLACEHOLDERS) + r")\}\}")
+_JINJA_RE = re.compile(r"\{%|\{#")
+
+log = logging.getLogger("template_engine")
+
+# oggetto/corpo arrivano dai record: niente accesso ad attributi interni di Python
+_env = SandboxedEnvironment(keep_trailing_newline=True,
+                            undefined=make_logging_undefined(log, DebugUndefined))
+
+
+class CompiledTemplate:
+    """Template pronto per il rendering: ``render(context)``."""
+
+    __slots__ = ("parts", "jinja")
+
+    def __init__(self, parts: list[str], jinja=None):
+        self.parts = parts    # [testo, NOME, testo, COGNOME, testo, ...]
+        self.jinja = jinja
+
+    def render(self, context: dict) -> str:
+        if self.jinja is not None:
+            try:
+                return self.jinja.render(**context)
+            except TemplateError as e:
+                log.warning("rendering Jinja fallito, uso i soli placeholder: %s", e)
+        parts = self.parts
+        if len(parts) == 1:
+            return parts[0]
+        out = parts[:]
+        out[1::2] = [context[k] for k in parts[1::2]]
+        return "".join(out)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(text: str) -> CompiledTemplate:
+    parts = _PLACEHOLDER_RE.split(text)
+    # il motore completo solo con blocchi {% %} / {# #}: un {{x}} da solo resta testo
+    if any(_JINJA_RE.search(p) for p in parts[::2]):
+        try:
+            return CompiledTemplate(parts, _env.from_string(text))
+        except TemplateSyntaxError as e:
+            # testo libero che somiglia a Jinja: si sostituiscono solo i placeholder
+            log.warning("template non valido, uso i soli placeholder: %s", e)
+    return CompiledTemplate(parts)
+
+
+def record_context(rec: dict) -> dict:
+    """Valori dei placeholder per un record (stringa vuota se mancanti)."""
+    return {name: str(rec.get(field) or "") for name, field in PLACEHOLDERS.items()}
+
+
+def render(text: str, rec: dict) -> str:
+    """Rende ``text`` per il record: placeholder ``{{NOME}}`` e, se presente, sintassi Jinja."""
+    if not text:
+        return ""
+    tpl = compile_template(text)
+    if tpl.jinja is None:
+        return tpl.render(record_context(rec))
+    return tpl.render({**rec, **record_context(rec)})
+
+
+def render_jinja(text: str, context: dict) -> str:
+    """Rendering Jinja puro nella sandbox (template compilato in cache)."""
+    return _jinja_template(text).render(**context)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _jinja_template(text: str):
+    return _env.from_string(text)
@@ -0,0 +1,48 @@
+# i moduli dell'app stanno nella radice del repository (niente package)
+import os, shutil, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    """``main`` importato su una cartella dati temporanea (le path si leggono all'import)."""
+    d = tmp_path_factory.mktemp("data")
+    env = {"DATA_DIR": str(d), "SETTINGS_PATH": str(d / "app_settings.json"), "STORAGE_MODE": "json",
+           "MAIL_DELIVERY": "inline", "SCHEDULER_ENABLED": "0"}
+    saved = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    import main as m
+    yield m
+    m._close_backend()
+    for k, v in saved.items():
+        if v is None:
+            os.environ.pop(k, None)
+        else:
+            os.environ[k] = v
+
+
+@pytest.fixture
+def reset_data(main):
+    """Svuota la cartella dati (tranne le impostazioni) e sceglie il backend: ``reset_data(mode)``."""
+    def run(mode: str):
+        main._close_backend()
+        for name in os.listdir(main.DATA_DIR):
+            path = os.path.join(main.DATA_DIR, name)
+            if name == "app_settings.json":
+                continue
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+        main.STORAGE_MODE = mode
+
+    yield run
+    main._close_backend()
+
+
+@pytest.fixture(params=["json", "journal", "sqlite"])
+def client(request, main, reset_data):
+    """Client HTTP dell'app su una cartella dati vuota, per ciascun backend."""
+    from fastapi.testclient import TestClient
+    reset_data(request.param)
+    return TestClient(main.app)
@@ -0,0 +1,165 @@
+import copy, json, os, random
+from datetime import timedelta
+
+import pytest
+
+
+@pytest.fixture
+def fails(monkeypatch):
+    """Destinatari per cui l'invio fallisce; gli altri vanno a buon fine senza SMTP."""
+    import email_service
+    bad = set()
+
+    def fake_send(to, subject, html, plain_fallback=None):
+        if to in bad:
+            raise RuntimeError("550 casella inesistente")
+
+    monkeypatch.setattr(email_service, "send_email", fake_send)
+    return bad
+
+
+@pytest.fixture(params=["json", "journal", "sqlite"])
+def setup(request, main, reset_data):
+    """Riempie la cartella dati con i record dati e fissa last_run, nel backend richiesto."""
+    import utils_scheduler
+
+    def run(recs: list, last_run):
+        reset_data(request.param)
+        with open(os.path.join(main.DATA_DIR, "records.json"), "w", encoding="utf-8") as f:
+            json.dump(recs, f)
+        utils_scheduler.save_last_run_date(last_run)
+
+    return run
+
+
+def _old_catchup(main, recs: list, last_run, today) -> list:
+    """Il vecchio catch-up: ogni giorno da last_run+1 a oggi, scansione di tutti i record."""
+    recs = copy.deepcopy(recs)
+    out, sent = [], set()
+    day = last_run + timedelta(days=1)
+    while day <= today:
+        for r in recs:
+            if r.get("sospendi_invio") is True or main._send_date(r) != day:
+                continue
+            if (r["id"], day.isoformat()) in sent:
+                continue
+            if not main._parse_recipients(r.get("email")):
+                out.append(("skip", r["id"], day.isoformat()))
+                continue
+            sent.add((r["id"], day.isoformat()))
+            out.append(("ok", r["id"], day.isoformat()))
+            pr = main._parse_yyyy_mm_dd(r["prossima_ricorrenza"])
+            r["prossima_ricorrenza"] = main._add_years_safe(pr, 1).isoformat()
+        day += timedelta(days=1)
+    return out, {r["id"]: r["prossima_ricorrenza"] for r in recs}
+
+
+def _records_by_id(main) -> dict:
+    return {r["id"]: r for r in main.get_records_store().all()}
+
+
+def test_equivalent_to_day_by_day_loop(main, setup, fails):
+    rnd = random.Random(1)
+    today = main._today_rome_date()
+    recs = []
+    for i in range(300):
+        pr = today - timedelta(days=rnd.randint(-30, 900))
+        if i % 50 == 0:
+            pr = pr.replace(month=2, day=28)
+        recs.append({"id": f"r{i}", "nome": f"n{i}", "email": f"a{i}@example.it" if i % 7 else None,
+                     "prossima_ricorrenza": pr.isoformat(), "giorni_prima": rnd.choice([0, 1, 3, "2", None, "x"]),
+                     "sospendi_invio": i % 11 == 0})
+    last_run = today - timedelta(days=800)
+    setup(recs, last_run)
+    expected, expected_pr = _old_catchup(main, recs, last_run, today)
+
+    res = main.send_emails_catchup()
+
+    got = [("ok", p["id"], p["due_date"]) for p in res["processed"]] + \
+          [("skip", p["id"], p["due_date"]) for p in res["skipped"]]
+    assert sorted(got) == sorted(expected)
+    assert res["counts"]["errors"] == 0 and res["complete"] is True
+    assert {rid: r["prossima_ricorrenza"] for rid, r in _records_by_id(main).items()} == expected_pr
+    # un secondo run non rispedisce nulla
+    assert main.send_emails_catchup()["counts"]["processed"] == 0
+
+
+def _rec(rid: str, pr) -> dict:
+    return {"id": rid, "nome": rid, "email": f"{rid}@example.it", "prossima_ricorrenza": pr.isoformat(), "giorni_prima": 0}
+
+
+def test_failed_send_is_held_and_retried(main, setup, fails):
+    import utils_scheduler
+    today = main._today_rome_date()
+    due = today - timedelta(days=1)
+    setup([_rec("a", due), _rec("b", due)], today - timedelta(days=3))
+    fails.add("b@example.it")
+
+    res = main.send_emails_catchup()
+    recs = _records_by_id(main)
+    assert res["counts"] == {"processed": 1, "skipped": 0, "errors": 1}
+    assert recs["a"]["prossima_ricorrenza"] == main._add_years_safe(due, 1).isoformat()
+    assert recs["b"]["prossima_ricorrenza"] == due.isoformat()     # fermo alla ricorrenza non spedita
+    assert utils_scheduler.load_last_run_date() == due - timedelta(days=1)
+    assert main.get_sent_log().state("b", due.isoformat()) == "errore"
+
+    fails.clear()
+    res = main.send_emails_catchup()
+    assert [(p["id"], p["due_date"]) for p in res["processed"]] == [("b", due.isoformat())]
+    assert _records_by_id(main)["b"]["prossima_ricorrenza"] == main._add_years_safe(due, 1).isoformat()
+    assert utils_scheduler.load_last_run_date() == today
+
+
+def test_retry_window_starts_at_first_failure(main, setup, fails):
+    """Dopo un fermo più lungo di CATCHUP_RETRY_DAYS il primo errore non fa rinunciare subito."""
+    import utils_scheduler
+    today = main._today_rome_date()
+    due = today - timedelta(days=main.CATCHUP_RETRY_DAYS + 7)
+    setup([_rec("c", due)], today - timedelta(days=main.CATCHUP_RETRY_DAYS + 20))
+    fails.add("c@example.it")
+
+    main.send_emails_catchup()
+    assert _records_by_id(main)["c"]["prossima_ricorrenza"] == due.isoformat()
+    assert utils_scheduler.load_last_run_date() == due - timedelta(days=1)
+
+
+def test_gives_up_after_retry_days_from_first_failure(main, setup, fails):
+    import utils_scheduler
+    today = main._today_rome_date()
+    due = today - timedelta(days=2)
+    setup([_rec("d", due)], due - timedelta(days=1))
+    first = today - timedelta(days=main.CATCHUP_RETRY_DAYS + 1)
+    main.get_sent_log().append([{"record_id": "d", "to": ["d@example.it"], "scheduled_for": due.isoformat(),
+                                 "due_date": due.isoformat(), "sent_at": None, "stato": "errore",
+                                 "errore": "550", "failed_at": f"{first.isoformat()}T06:00:00+00:00"}])
+    fails.add("d@example.it")
+
+    res = main.send_emails_catchup()
+    assert res["counts"]["errors"] == 1
+    # si rinuncia: la ricorrenza avanza e il watermark arriva a oggi
+    assert _records_by_id(main)["d"]["prossima_ricorrenza"] == main._add_years_safe(due, 1).isoformat()
+    assert utils_scheduler.load_last_run_date() == today
+
+
+def test_logged_but_not_advanced_record_is_realigned(main, setup, fails):
+    """Crash tra la riga del registro e il salvataggio del record: il run successivo avanza la ricorrenza."""
+    import utils_scheduler
+    today = main._today_rome_date()
+    due = today - timedelta(days=1)
+    setup([_rec("a", due)], due - timedelta(days=1))
+    main.get_sent_log().append([{"record_id": "a", "to": ["a@example.it"], "scheduled_for": due.isoformat(),
+                                 "due_date": due.isoformat(), "sent_at": f"{due.isoformat()}T06:00:00+00:00",
+                                 "stato": "ok", "errore": None}])
+
+    res = main.send_emails_catchup()
+    assert res["counts"] == {"processed": 0, "skipped": 0, "errors": 0}     # niente rispedito
+    assert _records_by_id(main)["a"]["prossima_ricorrenza"] == main._add_years_safe(due, 1).isoformat()
+    assert utils_scheduler.load_last_run_date() == today
+    main.send_emails_catchup()
+    assert _records_by_id(main)["a"]["prossima_ricorrenza"] == main._add_years_safe(due, 1).isoformat()
+
+
+def test_send_date_out_of_calendar_is_none(main):
+    for gp in (10 ** 6, -(10 ** 7), 10 ** 30, "x"):
+        assert main._send_date({"prossima_ricorrenza": "2026-05-10", "giorni_prima": gp}) is None
+    assert main._send_date({"prossima_ricorrenza": "2026-05-10", "giorni_prima": "3"}).isoformat() == "2026-05-07"
@@ -0,0 +1,65 @@
+import pytest
+
+from storage import open_backend
+
+
+def _get(client, url: str, etag=None, **params):
+    return client.get(url, params=params, headers={"If-None-Match": etag} if etag else {})
+
+
+def _assert_cached(client, url: str, **params) -> str:
+    """Prima risposta con ETag/Last-Modified, poi 304 senza corpo con lo stesso ETag."""
+    res = _get(client, url, **params)
+    assert res.status_code == 200
+    etag = res.headers["etag"]
+    assert res.headers["last-modified"] and res.headers["cache-control"] == "no-cache"
+    hit = _get(client, url, etag, **params)
+    assert hit.status_code == 304 and hit.content == b""
+    assert hit.headers["etag"] == etag
+    return etag
+
+
+def test_records_etag(client):
+    client.post("/records", json={"nome": "Anna", "email": "anna@example.it"})
+    etag = _assert_cached(client, "/records")
+    assert _get(client, "/records", f'W/{etag}, "altro"').status_code == 304
+    assert _get(client, "/records", "*").status_code == 304
+    assert _assert_cached(client, "/records", limit=5) != etag            # la query fa parte dell'ETag
+
+    client.post("/records", json={"nome": "Bruno", "email": "bruno@example.it"})
+    res = _get(client, "/records", etag)
+    assert res.status_code == 200 and len(res.json()) == 2
+    assert res.headers["etag"] != etag
+
+
+def test_records_etag_sees_writes_of_other_workers(main, client):
+    etag = _assert_cached(client, "/records")
+    other = open_backend(main.STORAGE_MODE, main.DATA_DIR, migrate=False)
+    try:
+        other.records.put({"id": "da-altro-worker", "nome": "Carla"})
+    finally:
+        other.close()
+    res = _get(client, "/records", etag)
+    assert res.status_code == 200 and [r["id"] for r in res.json()] == ["da-altro-worker"]
+
+
+def test_sent_log_etag(main, client):
+    etag = _assert_cached(client, "/emails/sent")
+    main.get_sent_log().append([{"record_id": "a", "to": ["a@example.it"], "due_date": "2026-05-01",
+                                 "sent_at": "2026-05-01T06:00:00+00:00", "stato": "ok", "errore": None}])
+    res = _get(client, "/emails/sent", etag)
+    assert res.status_code == 200 and res.headers["etag"] != etag
+    assert len(res.json()["emails"]) == 1
+
+
+@pytest.mark.parametrize("url, params, write", [
+    ("/api/email/settings", {}, lambda c: c.put("/api/email/settings", json={"subject": "Ciao {{NOME}}"})),
+    ("/api/email/templates", {"type": "body"},
+     lambda c: c.post("/api/email/templates", json={"type": "body", "name": "t", "content": "Testo"})),
+])
+def test_email_docs_etag(client, url, params, write):
+    etag = _assert_cached(client, url, **params)
+    assert write(client).status_code == 200
+    res = _get(client, url, etag, **params)
+    assert res.status_code == 200 and res.headers["etag"] != etag
+    assert _get(client, url, res.headers["etag"], **params).status_code == 304
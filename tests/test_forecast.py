@@ -0,0 +1,80 @@
+import json, os, random
+from collections import Counter
+from datetime import date, timedelta
+
+import pytest
+
+
+def _random_records(rnd: random.Random, today: date, n: int) -> list:
+    leap = [date(y, 2, 29) for y in (2024, 2028, 2032) if abs((date(y, 2, 29) - today).days) < 1200]
+    recs = []
+    for i in range(n):
+        pr = rnd.choice(leap) if leap and rnd.random() < 0.15 else today + timedelta(days=rnd.randint(-900, 900))
+        gp = rnd.choice([rnd.randint(0, 60), str(rnd.randint(0, 60)), rnd.randint(300, 400), None, "x"])
+        recs.append({
+            "id": f"r{i}",
+            "nome": f"N{i}",
+            "email": None if rnd.random() < 0.1 else f"r{i}@example.it",
+            "prossima_ricorrenza": pr.isoformat() if rnd.random() > 0.05 else None,
+            "giorni_prima": gp,
+            "sospendi_invio": rnd.random() < 0.1,
+        })
+    return recs
+
+
+def _brute_force(main, recs: list, last_run: date, today: date, start: date, end: date) -> dict:
+    """Simulazione giorno per giorno, record per record, di ciò che farebbero i catch-up."""
+    per_day, overdue, esclusi = Counter(), Counter(), Counter()
+    lo = max(start, today)
+    for r in recs:
+        if r["sospendi_invio"]:
+            esclusi["sospesi"] += 1
+            continue
+        pr = main._parse_yyyy_mm_dd(r["prossima_ricorrenza"])
+        try:
+            gp = int(r["giorni_prima"])
+        except (TypeError, ValueError):
+            gp = None
+        if pr is None or gp is None:
+            esclusi["senza_data"] += 1
+            continue
+        if not r["email"]:
+            esclusi["senza_email"] += 1
+            continue
+        if pr - timedelta(days=gp) < today:
+            overdue["count"] += 1
+            overdue["recuperabili"] += pr - timedelta(days=gp) > last_run
+        day = last_run + timedelta(days=1)
+        while day <= end:
+            if day == pr - timedelta(days=gp):
+                if day >= lo:
+                    per_day[day.isoformat()] += 1
+                pr = main._add_years_safe(pr, 1)
+            day += timedelta(days=1)
+    return {"per_day": dict(per_day), "overdue": dict(overdue), "esclusi": dict(esclusi)}
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_index_forecast_matches_brute_force(main, reset_data, seed):
+    import utils_scheduler
+    from fastapi.testclient import TestClient
+    rnd = random.Random(seed)
+    today = main._today_rome_date()
+    recs = _random_records(rnd, today, 150)
+    last_run = today - timedelta(days=rnd.choice([1, rnd.randint(2, 30), rnd.randint(300, 1500)]))
+    reset_data("json")
+    with open(os.path.join(main.DATA_DIR, "records.json"), "w", encoding="utf-8") as f:
+        json.dump(recs, f)
+    utils_scheduler.save_last_run_date(last_run)
+
+    start = today + timedelta(days=rnd.randint(0, 30))
+    giorni = rnd.randint(1, 1000)
+    res = TestClient(main.app).get("/emails/forecast", params={"da": start.isoformat(), "giorni": giorni})
+    assert res.status_code == 200
+    body = res.json()
+    expected = _brute_force(main, recs, last_run, today, start, start + timedelta(days=giorni - 1))
+    assert {d["date"]: d["count"] for d in body["per_day"]} == expected["per_day"]
+    assert body["total"] == sum(expected["per_day"].values())
+    assert body["overdue"] == {"count": expected["overdue"].get("count", 0),
+                               "recuperabili": expected["overdue"].get("recuperabili", 0)}
+    assert body["esclusi"] == {k: expected["esclusi"].get(k, 0) for k in ("sospesi", "senza_data", "senza_email")}
@@ -0,0 +1,45 @@
+import time
+from datetime import timedelta
+
+import outbox as ob
+from storage import open_backend
+
+
+def test_requeue_only_claims_older_than_timeout(tmp_path):
+    backend = open_backend("json", str(tmp_path), migrate=False)
+    box = ob.Outbox(backend.outbox)
+    box.enqueue([{"to": f"u{i}@example.it", "subject": "s", "html": "h"} for i in range(2)])
+    stale, live = box.claim(), box.claim()
+    stale["updated_at"] = (ob._now() - timedelta(seconds=ob.OUTBOX_CLAIM_TIMEOUT_SECONDS + 60)).isoformat()
+    backend.outbox.put(stale)
+
+    assert box.requeue_interrupted() == 1
+    assert backend.outbox.get(stale["id"])["status"] == "in_coda"
+    assert backend.outbox.get(live["id"])["status"] == "in_invio"   # di un worker ancora attivo
+    backend.close()
+
+
+def test_running_workers_purge_old_deliveries(tmp_path):
+    """La pulizia dei consegnati gira nella manutenzione periodica, non solo all'avvio."""
+    backend = open_backend("json", str(tmp_path), migrate=False)
+    box = ob.Outbox(backend.outbox)
+    workers = ob.OutboxWorkers(lambda: box, send=lambda *a: None, workers=1)
+    workers.start()
+    try:
+        box.enqueue([{"to": "old@example.it", "subject": "s", "html": "h"}])
+        while box.counts().get("ok") != 1:
+            time.sleep(0.01)
+        old = backend.outbox.all()[0]
+        old["updated_at"] = (ob._now() - timedelta(days=ob.OUTBOX_KEEP_DONE_DAYS + 1)).isoformat()
+        backend.outbox.put(old)
+
+        workers._next_sweep = 0.0
+        with box.wakeup:
+            box.wakeup.notify_all()
+        deadline = time.monotonic() + 5
+        while len(backend.outbox) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(backend.outbox) == 0
+    finally:
+        workers.stop()
+        backend.close()
@@ -0,0 +1,65 @@
+def _bulk(client, body: str, fmt: str):
+    res = client.post("/records/bulk", params={"format": fmt}, content=body.encode("utf-8"))
+    assert res.status_code == 200
+    return res.json()
+
+
+def _all(client) -> list:
+    return client.get("/records").json()
+
+
+def test_ndjson_rows_and_errors(client):
+    body = "\n".join([
+        '{"id": "a", "nome": "Anna", "cognome": "Rossi", "email": "anna@example.it"}',
+        "",                                                                   # righe vuote ignorate
+        '{"nome": "Bruno", "cognome": "Bianchi", "giorni_prima": 3}',
+        '{"nome": "rotto"',
+        '["non", "un", "oggetto"]',
+        '{"nome": "Carla", "email": "non-una-mail"}',
+    ])
+    res = _bulk(client, body, "ndjson")
+    assert res["received"] == 5 and res["inserted"] == 2
+    assert [e["row"] for e in res["errors"]] == [3, 4, 5]
+    assert res["errors"][0]["error"].startswith("JSON non valido")
+    assert "email" in res["errors"][2]["error"]
+    recs = {r["nome"]: r for r in _all(client)}
+    assert recs["Anna"]["id"] == "a" and recs["Bruno"]["giorni_prima"] == 3
+
+
+def test_csv_quoting_bom_and_booleans(client):
+    body = ("﻿nome,cognome,email,corpo,sospendi_invio,colonna_ignota\r\n"
+            'Anna,Rossi,anna@example.it,"riga uno\r\nriga due, con virgola",sì,x\r\n'
+            ",,,,,\r\n"
+            "Bruno,Bianchi,,,no,\r\n")
+    res = _bulk(client, body, "csv")
+    assert (res["received"], res["inserted"], res["errors"]) == (2, 2, [])
+    recs = {r["nome"]: r for r in _all(client)}
+    assert recs["Anna"]["corpo"] == "riga uno\r\nriga due, con virgola"
+    assert recs["Anna"]["sospendi_invio"] is True and recs["Bruno"]["sospendi_invio"] is False
+    assert recs["Bruno"]["email"] is None and "colonna_ignota" not in recs["Anna"]
+
+
+def test_duplicates_within_batch_and_against_store(client):
+    _bulk(client, '{"id": "old", "nome": "Anna", "cognome": "Rossi", "email": "anna@example.it"}', "ndjson")
+    body = "\n".join([
+        '{"nome": "ANNA ", "cognome": "rossi", "email": "anna@example.it"}',  # già presente
+        '{"id": "x", "nome": "Bruno", "cognome": "Bianchi"}',
+        '{"nome": "bruno", "cognome": "BIANCHI"}',                             # stesso contatto della riga 2
+        '{"id": "x", "nome": "Carla", "cognome": "Verdi"}',                    # id ripetuto nel file
+        '{"id": "old", "nome": "Dario", "cognome": "Neri"}',                   # id già esistente
+    ])
+    res = _bulk(client, body, "ndjson")
+    assert res["inserted"] == 1
+    assert res["errors"] == [{"row": 1, "error": "Contatto duplicato"},
+                             {"row": 3, "error": "Contatto duplicato"},
+                             {"row": 4, "error": "id ripetuto nel file"},
+                             {"row": 5, "error": "id già esistente"}]
+    recs = {r["id"]: r["nome"] for r in _all(client)}
+    assert recs["x"] == "Bruno" and len(recs) == 2
+
+
+def test_too_many_rows(client, main, monkeypatch):
+    monkeypatch.setattr(main, "RECORDS_BULK_MAX", 2)
+    res = client.post("/records/bulk", params={"format": "ndjson"}, content=b'{"nome":"a"}\n{"nome":"b"}\n{"nome":"c"}\n')
+    assert res.status_code == 413
+    assert _all(client) == []
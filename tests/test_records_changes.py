@@ -0,0 +1,93 @@
+import storage_tool
+
+
+def _create(client, n: int, start: int = 0) -> list:
+    return [client.post("/records", json={"nome": f"N{i}", "cognome": f"C{i}", "email": f"r{i}@example.it"}).json()["id"]
+            for i in range(start, start + n)]
+
+
+def _drain(client, since=None, limit=2) -> tuple:
+    """Legge il feed pagina per pagina: (id modificati, id eliminati, ultimo cursore)."""
+    items, deleted = [], []
+    while True:
+        res = client.get("/records/changes", params={"limit": limit, **({"since": since} if since else {})})
+        assert res.status_code == 200
+        body = res.json()
+        items += [r["id"] for r in body["items"]]
+        deleted += body["deleted"]
+        since = body["next_cursor"]
+        if not body["has_more"]:
+            return items, deleted, since
+
+
+def test_cursor_resume_without_gaps_or_duplicates(client):
+    ids = _create(client, 5)
+    items, deleted, cursor = _drain(client)
+    assert items == ids and deleted == []
+    assert _drain(client, cursor) == ([], [], cursor)       # nulla di nuovo: stesso cursore
+
+    client.put(f"/records/{ids[1]}", json={"nome": "Nuovo", "cognome": "C1", "email": "r1@example.it"})
+    more = _create(client, 2, start=5)
+    items, _, cursor = _drain(client, cursor, limit=1)
+    assert items == [ids[1]] + more
+
+
+def test_deletions_are_reported_as_tombstones(client):
+    ids = _create(client, 3)
+    _, _, cursor = _drain(client)
+    assert client.delete(f"/records/{ids[0]}").status_code == 200
+    client.put(f"/records/{ids[2]}", json={"nome": "X", "cognome": "C2", "email": "r2@example.it"})
+    items, deleted, _ = _drain(client, cursor)
+    assert (items, deleted) == ([ids[2]], [ids[0]])
+    # una sincronizzazione completa non riporta le eliminazioni
+    assert _drain(client)[:2] == ([ids[1], ids[2]], [])
+
+
+def test_cursor_older_than_pruned_tombstones_is_gone(client, main, monkeypatch):
+    ids = _create(client, 3)
+    _, _, cursor = _drain(client)
+    client.delete(f"/records/{ids[0]}")
+    _, _, after_first = _drain(client, cursor)
+    monkeypatch.setattr(main, "RECORDS_TOMBSTONE_DAYS", -1)    # la prossima eliminazione scarta le precedenti
+    client.delete(f"/records/{ids[1]}")
+
+    assert client.get("/records/changes", params={"since": cursor}).status_code == 410
+    assert _drain(client, after_first)[:2] == ([], [ids[1]])
+    assert client.get("/records/changes", params={"since": "non-un-cursore"}).status_code == 400
+
+
+def test_tombstones_follow_storage_conversion(client, main, tmp_path):
+    ids = _create(client, 2)
+    _, _, cursor = _drain(client)
+    client.delete(f"/records/{ids[0]}")
+    main._close_backend()
+    dest = "sqlite" if main.STORAGE_MODE != "sqlite" else "json"
+    out = storage_tool.convert(main.DATA_DIR, main.STORAGE_MODE, str(tmp_path), dest)
+    assert "record_tombstones" in out["docs"]
+
+    main.STORAGE_MODE = dest
+    main.DATA_DIR = str(tmp_path)
+    try:
+        assert _drain(client, cursor)[:2] == ([], [ids[0]])
+    finally:
+        main._recompute_paths()
+
+
+def test_tombstones_follow_data_dir_move(client, main, tmp_path):
+    ids = _create(client, 2)
+    _, _, cursor = _drain(client)
+    client.delete(f"/records/{ids[0]}")
+    mode = main.STORAGE_MODE
+    res = client.put("/admin/storage", json={"path": str(tmp_path / "moved")}, headers={"x-secret": main.SCHEDULER_SECRET})
+    assert res.status_code == 200
+    try:
+        main._close_backend()       # riaperto nel backend del test (il modo salvato resta quello di default)
+        main.STORAGE_MODE = mode
+        assert _drain(client, cursor)[:2] == ([], [ids[0]])
+    finally:
+        main._close_backend()
+        with main._SETTINGS_DOCS.locked():
+            s = main._load_settings()
+            s.pop("data_dir", None)
+            main._save_settings(s)
+        main._recompute_paths()
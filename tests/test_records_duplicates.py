@@ -0,0 +1,36 @@
+import json, os, random
+
+
+def _contact(**kw) -> dict:
+    return {"nome": "Anna", "cognome": "Rossi", "email": "anna@example.it", "def_nome": "Mario", "def_cognome": "Rossi", **kw}
+
+
+def test_create_and_update_reject_normalized_duplicates(client):
+    a = client.post("/records", json=_contact()).json()
+    dup = client.post("/records", json=_contact(nome="  ANNA", email="Anna@Example.it", cognome="rossi "))
+    assert dup.status_code == 409
+    b = client.post("/records", json=_contact(email="altra@example.it")).json()
+
+    assert client.put(f"/records/{b['id']}", json=_contact()).status_code == 409          # diventerebbe uguale ad a
+    assert client.put(f"/records/{a['id']}", json=_contact(corpo="nuovo")).status_code == 200   # sé stesso: ok
+    client.delete(f"/records/{a['id']}")
+    assert client.put(f"/records/{b['id']}", json=_contact()).status_code == 200          # l'indice segue le eliminazioni
+
+
+def test_duplicate_groups_match_brute_force(main, client):
+    rnd = random.Random(3)
+    recs = [{"id": f"r{i:03d}", "nome": rnd.choice(["Anna", "anna", "Bruno"]), "cognome": rnd.choice(["Rossi", "ROSSI "]),
+             "email": rnd.choice([None, "x@example.it", "y@example.it"]), "telefono_numero": rnd.choice([None, "333"]),
+             "def_nome": rnd.choice(["Mario", "Luigi"]), "def_cognome": "Rossi"} for i in range(80)]
+    with open(os.path.join(main.DATA_DIR, "records.json"), "w", encoding="utf-8") as f:
+        json.dump(recs, f)
+
+    for by, fields in (("identita", main._IDENTITY_FIELDS), ("persona", main._PERSON_FIELDS)):
+        expected = {}
+        for r in recs:
+            expected.setdefault(tuple((r.get(f) or "").strip().lower() for f in fields), []).append(r["id"])
+        body = client.get("/records/duplicates", params={"by": by}).json()
+        got = sorted(sorted(r["id"] for r in g) for g in body["groups"])
+        assert got == sorted(sorted(ids) for ids in expected.values() if len(ids) > 1)
+        assert body["count"] == len(got)
+    assert client.get("/records/duplicates", params={"by": "telefono"}).status_code == 400
@@ -0,0 +1,102 @@
+import json, os, random
+
+import pytest
+
+_NOMI = ["Anna", "anna ", "Bruno", "Carla", "Dario", "Elena", "Éva", "", None]
+_COGNOMI = ["Rossi", "rossini", "Bianchi", "Verdi", "Neri", "bianco", None]
+
+
+@pytest.fixture
+def records(main, client):
+    """Record casuali scritti in records.json prima del primo accesso (importati da ogni backend)."""
+    rnd = random.Random(7)
+    recs = [{
+        "id": f"r{i:03d}",
+        "nome": rnd.choice(_NOMI),
+        "cognome": rnd.choice(_COGNOMI),
+        "email": f"r{i}@example.it",
+        "prossima_ricorrenza": rnd.choice([None, f"2026-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"]),
+        "sospendi_invio": rnd.random() < 0.3,
+        "created_at": f"2026-01-01T00:00:{rnd.randint(0, 59):02d}+00:00",
+    } for i in range(120)]
+    with open(os.path.join(main.DATA_DIR, "records.json"), "w", encoding="utf-8") as f:
+        json.dump(recs, f)
+    return recs
+
+
+def _pages(client, params: dict, limit: int = 7) -> list:
+    """Tutte le pagine seguendo next_cursor; controlla che rileggere un cursore dia la stessa pagina."""
+    out, cursor = [], None
+    while True:
+        q = {**params, "limit": limit, **({"cursor": cursor} if cursor else {})}
+        body = client.get("/records", params=q).json()
+        assert client.get("/records", params=q).json() == body
+        out += body["items"]
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return out
+
+
+def _scan(main, recs: list, sort: str, nome=None, cognome=None, sospendi=None, da=None, a=None) -> list:
+    n = lambda s: (s or "").strip().lower()
+    rows = [r for r in recs
+            if (nome is None or n(r["nome"]).startswith(n(nome)))
+            and (cognome is None or n(r["cognome"]).startswith(n(cognome)))
+            and (sospendi is None or r["sospendi_invio"] is sospendi)
+            and (da is None or (r["prossima_ricorrenza"] or "") >= da and r["prossima_ricorrenza"])
+            and (a is None or r["prossima_ricorrenza"] and r["prossima_ricorrenza"] <= a)]
+    return [r["id"] for r in sorted(rows, key=main._RECORD_SORTS[sort])]
+
+
+@pytest.mark.parametrize("sort", ["created_at", "nome", "cognome", "prossima_ricorrenza"])
+def test_cursor_pages_match_linear_scan(main, client, records, sort):
+    ids = [r["id"] for r in _pages(client, {"sort": sort})]
+    assert ids == _scan(main, records, sort)
+    assert len(ids) == len(set(ids)) == len(records)
+
+
+@pytest.mark.parametrize("filters", [
+    {"nome": "an"},
+    {"cognome": "ROSS"},
+    {"sospendi_invio": True},
+    {"sospendi_invio": False, "sort": "cognome"},
+    {"ricorrenza_da": "2026-03-01", "ricorrenza_a": "2026-06-30"},
+    {"ricorrenza_da": "2026-10-01", "nome": "b", "sort": "created_at"},
+])
+def test_filters_match_linear_scan(main, client, records, filters):
+    sort = filters.get("sort") or ("cognome" if "cognome" in filters else "nome" if "nome" in filters else
+                                   "prossima_ricorrenza" if "ricorrenza_da" in filters else "created_at")
+    expected = _scan(main, records, sort, filters.get("nome"), filters.get("cognome"), filters.get("sospendi_invio"),
+                     filters.get("ricorrenza_da"), filters.get("ricorrenza_a"))
+    # solo sospendi_invio: indice "sospendi", in ordine di creazione come sort_created_at
+    assert [r["id"] for r in _pages(client, filters, limit=5)] == expected
+    unpaged = client.get("/records", params=filters).json()
+    assert sorted(r["id"] for r in unpaged) == sorted(expected)
+
+
+def test_offset_and_fields(client, records):
+    full = _pages(client, {"sort": "nome"}, limit=200)
+    page = client.get("/records", params={"sort": "nome", "offset": 10, "limit": 5, "fields": "nome"}).json()
+    assert page["items"] == [{"id": r["id"], "nome": r["nome"]} for r in full[10:15]]
+
+
+def test_writes_between_pages_cause_no_gaps_or_duplicates(client, records):
+    first = client.get("/records", params={"sort": "cognome", "limit": 30}).json()
+    client.post("/records", json={"nome": "Zeno", "cognome": "Zzz", "email": "z@example.it"})
+    client.post("/records", json={"nome": "Aldo", "cognome": "Aaa", "email": "a@example.it"})   # prima del cursore
+    rest, cursor = [], first["next_cursor"]
+    while cursor:
+        body = client.get("/records", params={"sort": "cognome", "limit": 30, "cursor": cursor}).json()
+        rest += body["items"]
+        cursor = body["next_cursor"]
+    ids = [r["id"] for r in first["items"] + rest]
+    assert len(ids) == len(set(ids)) == len(records) + 1
+    assert rest[-1]["cognome"] == "Zzz"
+
+
+def test_bad_cursor_is_400(client, records):
+    cursor = client.get("/records", params={"sort": "nome", "limit": 5}).json()["next_cursor"]
+    assert client.get("/records", params={"sort": "cognome", "cursor": cursor}).status_code == 400   # altro indice
+    assert client.get("/records", params={"cursor": "???"}).status_code == 400
+    assert client.get("/records", params={"sort": "eta"}).status_code == 400
+    assert client.get("/records", params={"ricorrenza_da": "31-12-2026"}).status_code == 400
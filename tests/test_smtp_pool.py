@@ -0,0 +1,139 @@
+import socket, threading, time
+
+import pytest
+
+controller_mod = pytest.importorskip("aiosmtpd.controller")
+
+import email_service
+from email_service import SmtpPool, TokenBucket
+
+
+class _Inbox:
+    """Handler aiosmtpd che conserva i messaggi ricevuti."""
+
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((envelope.mail_from, list(envelope.rcpt_tos)))
+        return "250 OK"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class _Server:
+    """Server SMTP locale; ``restart`` chiude tutte le sessioni aperte."""
+
+    def __init__(self):
+        self.inbox, self.port = _Inbox(), _free_port()
+        self._start()
+
+    def _start(self):
+        self.ctl = controller_mod.Controller(self.inbox, hostname="127.0.0.1", port=self.port)
+        self.ctl.start()
+
+    def restart(self):
+        self.ctl.stop()
+        self._start()
+
+    def stop(self):
+        self.ctl.stop()
+
+
+@pytest.fixture
+def smtp_server():
+    server = _Server()
+    yield server
+    server.stop()
+
+
+class _CountingPool(SmtpPool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.opened = 0
+
+    def _open(self):
+        self.opened += 1
+        return super()._open()
+
+
+def _pool(port, **kwargs) -> _CountingPool:
+    return _CountingPool("127.0.0.1", port, starttls=False, timeout=5, **kwargs)
+
+
+def test_connection_reused_between_messages(smtp_server):
+    inbox, port = smtp_server.inbox, smtp_server.port
+    pool = _pool(port, size=1, max_messages=100)
+    for i in range(5):
+        pool.sendmail("from@example.it", [f"u{i}@example.it"], "Subject: x\r\n\r\ncorpo")
+    pool.close()
+    assert len(inbox.messages) == 5
+    assert pool.opened == 1
+
+
+def test_connection_rotated_after_max_messages(smtp_server):
+    inbox, port = smtp_server.inbox, smtp_server.port
+    pool = _pool(port, size=1, max_messages=3)
+    for i in range(7):
+        pool.sendmail("from@example.it", [f"u{i}@example.it"], "Subject: x\r\n\r\ncorpo")
+    pool.close()
+    assert len(inbox.messages) == 7
+    assert pool.opened == 3
+
+
+def test_concurrent_sends_respect_pool_size(smtp_server):
+    inbox, port = smtp_server.inbox, smtp_server.port
+    pool = _pool(port, size=2, max_messages=1000)
+    threads = [threading.Thread(target=lambda i=i: pool.sendmail("f@example.it", [f"u{i}@example.it"], "Subject: x\r\n\r\nc"))
+               for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    pool.close()
+    assert sorted(to[0] for _, to in inbox.messages) == sorted(f"u{i}@example.it" for i in range(20))
+    assert pool.opened <= 2
+
+
+def test_retry_on_new_connection_after_server_restart(smtp_server):
+    inbox, port = smtp_server.inbox, smtp_server.port
+    pool = _pool(port, size=1, idle_check=3600)
+    pool.sendmail("f@example.it", ["a@example.it"], "Subject: x\r\n\r\nc")
+    # il server chiude le sessioni: la connessione in pool è morta ma sembra ancora valida
+    smtp_server.restart()
+    pool.sendmail("f@example.it", ["b@example.it"], "Subject: x\r\n\r\nc")
+    pool.close()
+    assert [to for _, to in inbox.messages] == [["a@example.it"], ["b@example.it"]]
+    assert pool.opened == 2
+
+
+def test_send_email_goes_through_pool_and_rate_limit(smtp_server, monkeypatch):
+    inbox, port = smtp_server.inbox, smtp_server.port
+    pool = _pool(port, size=1)
+    taken = []
+    monkeypatch.setattr(email_service, "SMTP_USER", "utente@example.it")
+    monkeypatch.setattr(email_service, "SMTP_PASS", "x")
+    monkeypatch.setattr(email_service, "get_pool", lambda: pool)
+    monkeypatch.setattr(email_service._RATE_LIMIT, "acquire", lambda: taken.append(1))
+    res = email_service.send_bulk_sync([{"to": f"u{i}@example.it", "subject": "s", "html": "<p>h</p>"} for i in range(3)])
+    email_service.send_email("v@example.it", "s", "<p>h</p>")
+    pool.close()
+    assert res["errors"] == [None, None, None]
+    assert len(inbox.messages) == 4
+    assert len(taken) == 4
+
+
+def test_token_bucket_shared_between_threads():
+    bucket = TokenBucket(rate=50, burst=5)
+    t0 = time.monotonic()
+    threads = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(5)]) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 20 gettoni, 5 subito: gli altri 15 a 50/s
+    assert time.monotonic() - t0 >= 0.25
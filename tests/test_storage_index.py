@@ -0,0 +1,94 @@
+import random
+
+import pytest
+
+from storage import HashIndex, RecordStore, SortedIndex
+
+
+class _Memory:
+    """Persistenza in memoria: ``load`` ritorna i record, ``write`` non fa nulla."""
+
+    def __init__(self, recs):
+        self.recs = recs
+
+    def load(self):
+        return [dict(r) for r in self.recs]
+
+    def is_stale(self):
+        return False
+
+    def version(self):
+        return None
+
+    def write(self, order, by_id, dirty, deleted=()):
+        pass
+
+
+def _recs(n=500, seed=1):
+    rnd = random.Random(seed)
+    return [{"id": f"r{i}", "day": f"2026-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}",
+             "group": rnd.choice(["a", "b", None])} for i in range(n)]
+
+
+def test_build_matches_incremental_adds():
+    recs = _recs()
+    for cls in (HashIndex, SortedIndex):
+        built, added = cls(lambda r: r["day"]), cls(lambda r: r["day"])
+        built.build((r["id"], r) for r in recs)
+        for r in recs:
+            added.add(r["id"], r)
+        assert dict(built.items()) == dict(added.items())
+        if cls is SortedIndex:
+            assert built._keys == added._keys == sorted(added._keys)
+
+
+def test_build_skips_none_keys_and_replaces_previous_content():
+    idx = SortedIndex(lambda r: r["group"])
+    idx.add("old", {"group": "z"})
+    recs = _recs(50)
+    idx.build((r["id"], r) for r in recs)
+    assert idx.get("z") == set()
+    assert None not in dict(idx.items())
+    assert idx._keys == sorted({r["group"] for r in recs if r["group"]})
+
+
+def test_store_range_after_reload_and_writes():
+    recs = _recs()
+    store = RecordStore(_Memory(recs))
+    store.add_index("day", SortedIndex(lambda r: r["day"]))
+    expected = sorted((r["day"], r["id"]) for r in recs if "2026-03-01" <= r["day"] <= "2026-05-31")
+    got = sorted((k, r["id"]) for k, r in store.range("day", "2026-03-01", "2026-05-31"))
+    assert got == expected
+
+    store.put({"id": "new", "day": "2027-01-01", "group": None})
+    store.delete_many(["r0"])
+    assert store.last_key("day") == "2027-01-01"
+    assert all(r["id"] != "r0" for _, r in store.range("day"))
+    assert store.key_ids("day", "2027-01-01", "2027-01-01") == [("2027-01-01", ["new"])]
+
+
+def test_add_index_on_loaded_store():
+    recs = _recs(100)
+    store = RecordStore(_Memory(recs))
+    assert len(store) == 100
+    store.add_index("group", HashIndex(lambda r: r["group"]))
+    assert {r["id"] for r in store.lookup("group", "a")} == {r["id"] for r in recs if r["group"] == "a"}
+
+
+def test_put_many_leaves_store_untouched_when_a_key_fails():
+    recs = _recs(20)
+    store = RecordStore(_Memory(recs))
+
+    def day(r):
+        if r["day"] == "boom":
+            raise OverflowError("data fuori calendario")
+        return r["day"]
+
+    store.add_index("day", SortedIndex(day))
+    before = store.key_ids("day")
+    with pytest.raises(OverflowError):
+        store.put_many([{"id": "r0", "day": "2030-01-01", "group": "a"},
+                        {"id": "new", "day": "boom", "group": None}])
+    assert len(store) == 20 and store.get("new") is None
+    assert store.get("r0")["day"] == recs[0]["day"]
+    assert store.key_ids("day") == before
@@ -0,0 +1,207 @@
+import multiprocessing, os, threading, time
+
+import pytest
+
+import storage
+from filelock import FileLock, TryLock
+from storage import open_backend
+
+MODES = ["json", "journal", "sqlite"]
+_fork = multiprocessing.get_context("fork")
+
+
+def _ids(backend) -> list:
+    return sorted(r["id"] for r in backend.records.all())
+
+
+def _writer(data_dir: str, mode: str, n: int, prefix: str):
+    b = open_backend(mode, data_dir, compact_every=7, migrate=False)
+    for i in range(n):
+        b.records.put({"id": f"{prefix}{i}"})
+    b.close()
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_concurrent_writers_in_separate_processes(tmp_path, mode):
+    procs = [_fork.Process(target=_writer, args=(str(tmp_path), mode, 30, f"p{k}-")) for k in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(60)
+        assert p.exitcode == 0
+    b = open_backend(mode, str(tmp_path), migrate=False)
+    assert _ids(b) == sorted(f"p{k}-{i}" for k in range(4) for i in range(30))
+    b.close()
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_writes_of_one_store_visible_to_another(tmp_path, mode):
+    a = open_backend(mode, str(tmp_path), migrate=False)
+    b = open_backend(mode, str(tmp_path), migrate=False)
+    a.records.put({"id": "x"})
+    assert _ids(b) == ["x"]
+    b.records.put({"id": "y"})
+    assert _ids(a) == ["x", "y"]
+    a.close()
+    b.close()
+
+
+def test_reload_during_compaction_keeps_live_log(tmp_path, monkeypatch):
+    """Un altro store che ricarica mentre la compattazione è in corso non deve toccare i log."""
+    gate = threading.Event()
+    write_snapshot = storage._write_snapshot
+
+    def slow_snapshot(*args, **kwargs):
+        if threading.current_thread().name == "journal-compact":
+            gate.wait(10)
+        return write_snapshot(*args, **kwargs)
+
+    monkeypatch.setattr(storage, "_write_snapshot", slow_snapshot)
+    a = open_backend("journal", str(tmp_path), compact_every=5, migrate=False)
+    a.records.put_many([{"id": f"a{i}"} for i in range(5)])   # parte la compattazione
+    assert os.path.exists(tmp_path / "records.wal.old")
+    a.records.put({"id": "a5"})                              # nel log nuovo
+
+    b = open_backend("journal", str(tmp_path), compact_every=5, migrate=False)
+    b.records.put({"id": "b1"})
+    assert os.path.exists(tmp_path / "records.wal.old")
+    assert _ids(b) == ["a0", "a1", "a2", "a3", "a4", "a5", "b1"]
+
+    gate.set()
+    a.records.persist.flush()
+    c = open_backend("journal", str(tmp_path), migrate=False)
+    assert _ids(c) == ["a0", "a1", "a2", "a3", "a4", "a5", "b1"]
+    assert not os.path.exists(tmp_path / "records.wal.old")
+    for x in (a, b, c):
+        x.close()
+
+
+def test_interrupted_compaction_recovered_on_load(tmp_path):
+    a = open_backend("journal", str(tmp_path), migrate=False)
+    a.records.put_many([{"id": f"r{i}"} for i in range(3)])
+    a.close()
+    # crash dopo la rotazione del log, prima dello snapshot
+    os.replace(tmp_path / "records.wal", tmp_path / "records.wal.old")
+
+    b = open_backend("journal", str(tmp_path), migrate=False)
+    assert _ids(b) == ["r0", "r1", "r2"]
+    assert not os.path.exists(tmp_path / "records.wal.old")
+    b.records.put({"id": "r3"})
+    b.close()
+    c = open_backend("journal", str(tmp_path), migrate=False)
+    assert _ids(c) == ["r0", "r1", "r2", "r3"]
+    c.close()
+
+
+def test_background_snapshot_never_replaces_a_newer_one(tmp_path, monkeypatch):
+    gate = threading.Event()
+    write_snapshot = storage._write_snapshot
+
+    def slow_snapshot(*args, **kwargs):
+        if threading.current_thread().name == "journal-compact":
+            gate.wait(10)
+        return write_snapshot(*args, **kwargs)
+
+    monkeypatch.setattr(storage, "_write_snapshot", slow_snapshot)
+    a = open_backend("journal", str(tmp_path), compact_every=3, migrate=False)
+    a.records.put_many([{"id": f"r{i}"} for i in range(3)])
+    snap = str(tmp_path / "records.snapshot.json")
+    write_snapshot(snap, 99, "records", [])
+    gate.set()
+    a.records.persist.flush()
+    assert storage._snapshot_seq(snap) == 99
+    a.close()
+
+
+def _hold_exclusive(path: str, held, release):
+    lock = FileLock(path)
+    with lock.exclusive():
+        held.set()
+        release.wait(10)
+
+
+def test_file_lock_excludes_readers_of_other_processes(tmp_path):
+    path = str(tmp_path / "x.lock")
+    held, release = _fork.Event(), _fork.Event()
+    p = _fork.Process(target=_hold_exclusive, args=(path, held, release))
+    p.start()
+    assert held.wait(10)
+    got = threading.Event()
+
+    def reader():
+        with FileLock(path).shared():
+            got.set()
+
+    t = threading.Thread(target=reader)
+    t.start()
+    assert not got.wait(0.3)
+    release.set()
+    assert got.wait(10)
+    t.join()
+    p.join(10)
+
+
+def _take_and_die(path: str, held):
+    assert TryLock(path).acquire()
+    held.set()
+    time.sleep(0.5)
+    os._exit(1)   # nessun release: lo libera il kernel
+
+
+def test_try_lock_released_when_holder_dies(tmp_path):
+    path = str(tmp_path / "x.compacting")
+    held = _fork.Event()
+    p = _fork.Process(target=_take_and_die, args=(path, held))
+    p.start()
+    assert held.wait(10)
+    mine = TryLock(path)
+    assert mine.busy() and not mine.acquire()
+    p.join(10)
+    assert not mine.busy()
+    assert mine.acquire() and mine.busy()
+    mine.release()
+
+
+def _read_sent(data_dir: str, start):
+    load = storage.JsonListFile.load
+
+    def slow_load(self):
+        time.sleep(0.2)     # tutti i processi arrivano alla migrazione prima che uno la completi
+        return load(self)
+
+    storage.JsonListFile.load = slow_load
+    b = open_backend("json", data_dir)
+    start.wait()
+    assert len(b.sent.rows()) == 40
+    b.close()
+
+
+def test_concurrent_sent_log_migration(tmp_path):
+    rows = [{"record_id": f"r{i}", "due_date": f"2026-0{1 + i % 3}-01", "stato": "ok"} for i in range(40)]
+    (tmp_path / "sent_emails.json").write_text(storage.dumps(rows), encoding="utf-8")
+    start = _fork.Barrier(4)
+    procs = [_fork.Process(target=_read_sent, args=(str(tmp_path), start)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(30)
+        assert p.exitcode == 0
+    b = open_backend("json", str(tmp_path))
+    assert sorted(r["record_id"] for r in b.sent.rows()) == sorted(r["record_id"] for r in rows)
+    assert not os.path.exists(tmp_path / f"{storage.SENT_DIR}.tmp")
+    b.close()
+
+
+@pytest.mark.parametrize("mode", ["json", "journal"])
+def test_json_pretty_indents_records_and_snapshots(tmp_path, monkeypatch, mode):
+    monkeypatch.setattr(storage, "JSON_PRETTY", True)
+    recs = [{"id": f"r{i}", "nome": f"N{i}", "tags": ["a", "b"]} for i in range(3)]
+    b = open_backend(mode, str(tmp_path), compact_every=2, migrate=False)
+    b.records.put_many(recs)
+    b.close()
+
+    text = (tmp_path / ("records.json" if mode == "json" else "records.snapshot.json")).read_text(encoding="utf-8")
+    assert '\n    "nome": "N0"' in text
+    b = open_backend(mode, str(tmp_path), migrate=False)
+    assert b.records.all() == recs
+    b.close()
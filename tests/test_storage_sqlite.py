@@ -0,0 +1,38 @@
+import json, multiprocessing, os, sqlite3, time, types
+
+import storage_sqlite
+from storage_sqlite import DB_NAME, SqliteDatabase
+
+_fork = multiprocessing.get_context("fork")
+
+
+def _slow_connect(*args, **kw):
+    time.sleep(0.2)     # allarga la finestra tra il controllo "database nuovo" e la creazione del file
+    return sqlite3.connect(*args, **kw)
+
+
+def _open(data_dir: str, start):
+    storage_sqlite.sqlite3 = types.SimpleNamespace(connect=_slow_connect)
+    start.wait()
+    SqliteDatabase(data_dir).close()
+
+
+def test_concurrent_first_open_imports_legacy_json_once(tmp_path):
+    rows = [{"record_id": f"r{i}", "due_date": "2026-01-01", "stato": "ok"} for i in range(50)]
+    (tmp_path / "sent_emails.json").write_text(json.dumps(rows), encoding="utf-8")
+    (tmp_path / "records.json").write_text(json.dumps([{"id": "r0", "nome": "Anna"}]), encoding="utf-8")
+    start = _fork.Barrier(4)
+    procs = [_fork.Process(target=_open, args=(str(tmp_path), start)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(30)
+        assert p.exitcode == 0
+
+    assert os.path.exists(tmp_path / DB_NAME)
+    db = SqliteDatabase(str(tmp_path))
+    try:
+        assert len(db.sent().load()) == 50
+        assert [r["id"] for r in db.records().load()] == ["r0"]
+    finally:
+        db.close()
@@ -0,0 +1,22 @@
+from template_engine import render
+
+REC = {"nome": "Mario", "cognome": "Rossi", "importo": "10"}
+
+
+def test_placeholders_and_unknown_braces_stay_literal():
+    assert render("Ciao {{NOME}} {{COGNOME}}", REC) == "Ciao Mario Rossi"
+    assert render("Prezzo {{importo}} per {{NOME}}", REC) == "Prezzo {{importo}} per Mario"
+
+
+def test_jinja_only_with_blocks():
+    assert render("{% if nome %}Ciao {{ nome }}{% endif %}", REC) == "Ciao Mario"
+    assert render("{# nota #}{{ mancante }} {{NOME}}", REC) == "{{ mancante }} Mario"
+
+
+def test_sandbox_blocks_python_internals(tmp_path):
+    marker = tmp_path / "eseguito"
+    payload = "{{ cycler.__init__.__globals__.os.popen('touch %s').read() }}" % marker
+    assert render(payload, REC) == payload      # senza blocchi Jinja resta testo
+    out = render("{% if 1 %}" + payload + "{% endif %} {{NOME}}", REC)
+    assert out.endswith(" Mario")               # errore della sandbox: solo placeholder
+    assert not marker.exists()
@@ -0,0 +1,133 @@
+import json, threading, time
+from datetime import date
+
+import pytest
+
+
+@pytest.fixture
+def us(main):
+    """``utils_scheduler`` importato dopo ``main``: le sue path si leggono all'import da DATA_DIR."""
+    import utils_scheduler
+    return utils_scheduler
+
+
+@pytest.fixture
+def last_run(us, tmp_path, monkeypatch):
+    path = tmp_path / "last_run.json"
+    monkeypatch.setattr(us, "LAST_RUN_PATH", str(path))
+    return path
+
+
+def test_last_run_write_is_atomic(us, last_run, monkeypatch):
+    """Un crash durante la scrittura lascia il watermark precedente."""
+    us.save_last_run_date(date(2026, 3, 1))
+
+    def broken_dump(obj, f, **kw):
+        f.write('{"last_run": "2026-')
+        raise OSError("disco pieno")
+
+    with monkeypatch.context() as m:
+        m.setattr(json, "dump", broken_dump)
+        with pytest.raises(OSError):
+            us.save_last_run_date(date(2026, 3, 2))
+    assert us.load_last_run_date() == date(2026, 3, 1)
+
+
+def _coordinator(us, tmp_path, **kw):
+    """Un coordinatore per "processo": istanze diverse condividono solo i file."""
+    return us.CatchupCoordinator(str(tmp_path / "catchup.lease"), str(tmp_path / "catchup.result.json"), **kw)
+
+
+def _in_thread(fn):
+    out = {}
+
+    def target():
+        try:
+            out["result"] = fn()
+        except BaseException as e:
+            out["error"] = e
+
+    t = threading.Thread(target=target)
+    t.start()
+    return t, out
+
+
+def test_second_caller_attaches_to_running_run(us, tmp_path):
+    coord = _coordinator(us, tmp_path)
+    started, release, calls = threading.Event(), threading.Event(), []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"counts": {"processed": 3}}
+
+    leader, led = _in_thread(lambda: coord.run(fn))
+    started.wait(5)
+    follower, followed = _in_thread(lambda: coord.run(fn))
+    time.sleep(0.2)         # il secondo chiamante si aggancia al run in corso
+    release.set()
+    leader.join(5), follower.join(5)
+    assert led["result"] == {"counts": {"processed": 3}}
+    assert followed["result"] == {"counts": {"processed": 3}, "attached": True}
+    assert calls == [1]
+    assert coord.lease() is None
+
+
+def test_other_process_waits_for_lease_and_reads_result(us, tmp_path):
+    a, b = _coordinator(us, tmp_path, ttl=0.3), _coordinator(us, tmp_path, ttl=0.3)
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)        # più del ttl: il lease resta vivo grazie all'heartbeat
+        return {"run": "a"}
+
+    leader, led = _in_thread(lambda: a.run(slow))
+    started.wait(5)
+    follower, followed = _in_thread(lambda: b.run(lambda: {"run": "b"}))
+    time.sleep(0.8)
+    assert b.lease()["owner"] == a.owner
+    release.set()
+    leader.join(5), follower.join(5)
+    assert led["result"] == {"run": "a"}
+    assert followed["result"] == {"run": "a", "attached": True}
+    assert b.last_result()["result"] == {"run": "a"}
+
+
+def test_expired_lease_is_taken_over(us, tmp_path):
+    coord = _coordinator(us, tmp_path)
+    dead = {"run_id": "vecchio", "owner": "altro-host:1", "started_at": time.time() - 600,
+            "heartbeat_at": time.time() - 300, "expires_at": time.time() - 180}
+    (tmp_path / "catchup.lease").write_text(json.dumps(dead), encoding="utf-8")
+    assert coord.lease() is None
+    assert coord.run(lambda: {"ok": True}) == {"ok": True}
+    assert coord.lease() is None and coord.last_result()["owner"] == coord.owner
+
+
+def test_live_lease_of_another_process_times_out(us, tmp_path):
+    coord = _coordinator(us, tmp_path, ttl=1, wait=0.3)
+    alive = {"run_id": "altro", "owner": "altro-host:1", "started_at": time.time(),
+             "heartbeat_at": time.time(), "expires_at": time.time() + 60}
+    (tmp_path / "catchup.lease").write_text(json.dumps(alive), encoding="utf-8")
+    with pytest.raises(us.CatchupBusy):
+        coord.run(lambda: pytest.fail("eseguito con il lease di un altro processo"))
+
+
+def test_error_reaches_attached_callers(us, tmp_path):
+    coord = _coordinator(us, tmp_path)
+    started, release = threading.Event(), threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("smtp giù")
+
+    leader, led = _in_thread(lambda: coord.run(fn))
+    started.wait(5)
+    follower, followed = _in_thread(lambda: coord.run(fn))
+    time.sleep(0.2)         # il secondo chiamante si aggancia al run in corso
+    release.set()
+    leader.join(5), follower.join(5)
+    assert isinstance(led["error"], RuntimeError) and followed["error"] is led["error"]
+    assert coord.lease() is None and coord.last_result() is None
@@ -1,7 +1,10 @@
-import os, json
-from datetime import datetime, timedelta
+import os, json, time, uuid, socket, threading, logging
+from datetime import datetime, timedelta, time as dt_time
+from typing import Callable, Optional
 from zoneinfo import ZoneInfo
 
+from filelock import FileLock
+
 TZ = ZoneInfo("Europe/Rome")
 DATA_DIR = os.environ.get("DATA_DIR", "data")
 LAST_RUN_PATH = os.path.join(DATA_DIR, "last_run.json")
@@ -19,7 +22,278 @@ def load_last_run_date():
     except:
         return _now_date() - timedelta(days=1)
 
-def save_last_run_now():
-    os.makedirs(DATA_DIR, exist_ok=True)
-    with open(LAST_RUN_PATH, "w", encoding="utf-8") as f:
-        json.dump({"last_run": datetime.now(TZ).isoformat()}, f, ensure_ascii=False)
+def save_last_run_date(d):
+    """Fissa il giorno fino al quale il catch-up è completo (il prossimo riparte da d+1).
+
+    Scrittura atomica: un crash a metà lascia il watermark precedente, non un
+    file troncato che farebbe ripartire il catch-up da ieri.
+    """
+    _write_json(LAST_RUN_PATH, {"last_run": d.isoformat()})
+
+
+# =========================
+#  COORDINAMENTO CATCH-UP
+# =========================
+# Un solo catch-up alla volta, anche con più worker o istanze sulla stessa
+# cartella dati: chi parte prende un lease (file con scadenza rinnovata da un
+# heartbeat); le richieste concorrenti si agganciano al run in corso e ne
+# ricevono il risultato invece di rifare gli stessi giorni.
+
+CATCHUP_LEASE_TTL = float(os.environ.get("CATCHUP_LEASE_TTL", "120"))      # secondi senza heartbeat -> lease scaduto
+CATCHUP_WAIT_SECONDS = float(os.environ.get("CATCHUP_WAIT_SECONDS", "900"))  # attesa massima di chi si aggancia
+LEASE_PATH = os.path.join(DATA_DIR, "catchup.lease")
+RESULT_PATH = os.path.join(DATA_DIR, "catchup.result.json")
+
+log = logging.getLogger("utils_scheduler")
+
+
+class CatchupBusy(Exception):
+    """Un altro processo tiene il lease oltre ``CATCHUP_WAIT_SECONDS``."""
+
+    def __init__(self, lease: dict):
+        super().__init__(f"catch-up in corso su {lease.get('owner')} (run {lease.get('run_id')})")
+        self.lease = lease
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_json(path: str, obj: dict):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class CatchupCoordinator:
+    """Single-flight del catch-up: ``run(fn)`` esegue ``fn`` una volta sola per volta.
+
+    - nello stesso processo, chi arriva durante un run attende e riceve lo
+      stesso risultato (con ``attached``);
+    - tra processi, il lease in ``lease_path`` indica chi sta eseguendo: gli
+      altri attendono il rilascio e leggono il risultato da ``result_path``;
+    - se il proprietario muore, il lease scade dopo ``ttl`` secondi senza
+      heartbeat e il primo che arriva prende il suo posto.
+    """
+
+    def __init__(self, lease_path: str = LEASE_PATH, result_path: str = RESULT_PATH,
+                 ttl: float = CATCHUP_LEASE_TTL, wait: float = CATCHUP_WAIT_SECONDS):
+        self.lease_path = lease_path
+        self.result_path = result_path
+        self.ttl = ttl
+        self.wait = wait
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._file_lock = FileLock(lease_path + ".lock")
+        self._mutex = threading.Lock()
+        self._flight: Optional[_Flight] = None
+
+    def lease(self) -> Optional[dict]:
+        """Lease attivo (None se libero o scaduto)."""
+        with self._file_lock.shared():
+            cur = _read_json(self.lease_path)
+        return cur if cur and cur.get("expires_at", 0) > time.time() else None
+
+    def last_result(self) -> Optional[dict]:
+        return _read_json(self.result_path)
+
+    def run(self, fn: Callable[[], dict]) -> dict:
+        with self._mutex:
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                flight = self._flight = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return {**flight.result, "attached": True}
+        try:
+            flight.result = self._run_leased(fn)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._mutex:
+                self._flight = None
+            flight.done.set()
+
+    def _run_leased(self, fn: Callable[[], dict]) -> dict:
+        deadline = time.monotonic() + self.wait
+        seen = None   # run di un altro processo a cui ci si è agganciati
+        while True:
+            with self._file_lock.exclusive():
+                cur = _read_json(self.lease_path)
+                if cur is None or cur.get("expires_at", 0) <= time.time():
+                    done = _read_json(self.result_path) if seen else None
+                    if done and done.get("run_id") == seen:
+                        return {**done["result"], "attached": True}
+                    if cur is not None:
+                        log.warning("lease catch-up di %s scaduto, subentra %s", cur.get("owner"), self.owner)
+                    run_id = uuid.uuid4().hex
+                    _write_json(self.lease_path, self._lease(run_id, time.time()))
+                    break
+                seen = cur.get("run_id")
+            if time.monotonic() >= deadline:
+                raise CatchupBusy(cur)
+            time.sleep(min(1.0, self.ttl / 10))
+
+        stop = threading.Event()
+        beat = threading.Thread(target=self._heartbeat, args=(run_id, stop), name="catchup-lease", daemon=True)
+        beat.start()
+        result = None
+        try:
+            result = fn()
+            return result
+        finally:
+            stop.set()
+            beat.join()
+            # risultato e rilascio insieme: chi attende trova il lease libero solo a risultato scritto
+            with self._file_lock.exclusive():
+                if result is not None:
+                    _write_json(self.result_path, {"run_id": run_id, "owner": self.owner,
+                                                   "finished_at": datetime.now(TZ).isoformat(), "result": result})
+                cur = _read_json(self.lease_path)
+                if cur and cur.get("run_id") == run_id:
+                    os.remove(self.lease_path)
+
+    def _lease(self, run_id: str, started: float) -> dict:
+        now = time.time()
+        return {"run_id": run_id, "owner": self.owner, "started_at": started,
+                "heartbeat_at": now, "expires_at": now + self.ttl}
+
+    def _heartbeat(self, run_id: str, stop: threading.Event):
+        while not stop.wait(self.ttl / 3):
+            with self._file_lock.exclusive():
+                cur = _read_json(self.lease_path)
+                if not cur or cur.get("run_id") != run_id:
+                    log.error("lease catch-up %s perso (ora: %s)", run_id, cur and cur.get("owner"))
+                    return
+                _write_json(self.lease_path, self._lease(run_id, cur["started_at"]))
+
+
+# =========================
+#  SCHEDULER INTERNO
+# =========================
+# Alternativa al cron esterno su /admin/catchup: un thread nel processo che
+# dorme fino al prossimo giorno con invii dovuti (dall'indice delle date di
+# invio) e all'ora SCHEDULER_TIME (Europe/Rome) lancia il catch-up.
+
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "0").strip().lower() in ("1", "true", "yes")
+SCHEDULER_TIME = os.environ.get("SCHEDULER_TIME", "07:00")                       # HH:MM, ora di Roma
+SCHEDULER_MAX_SLEEP_HOURS = float(os.environ.get("SCHEDULER_MAX_SLEEP_HOURS", "6"))  # ricontrollo dell'indice
+
+
+def parse_hhmm(s: str) -> dt_time:
+    h, _, m = (s or "").strip().partition(":")
+    return dt_time(int(h), int(m or 0))
+
+
+class EmbeddedScheduler:
+    """Esegue ``run()`` all'ora ``at`` dei giorni in cui ci sono invii dovuti.
+
+    ``next_due(day)`` restituisce il primo giorno >= ``day`` con invii (None se
+    nessuno). Il thread non fa polling: dorme fino al run pianificato, al più
+    ``max_sleep_hours`` (i record possono cambiare da altri worker), e
+    ``notify()`` lo sveglia per ripianificare dopo una modifica locale.
+    Un giorno già eseguito non viene ripetuto: gli invii falliti tornano al
+    run del giorno dopo (vedi CATCHUP_RETRY_DAYS).
+    """
+
+    def __init__(self, run: Callable[[], dict], next_due: Callable, at: str = SCHEDULER_TIME,
+                 max_sleep_hours: float = SCHEDULER_MAX_SLEEP_HOURS):
+        self.run = run
+        self.next_due = next_due
+        self.at = parse_hhmm(at)
+        self.max_sleep = max_sleep_hours * 3600
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._ran_on = None
+        self.next_run: Optional[datetime] = None
+        self.last_started: Optional[datetime] = None
+        self.last_duration: Optional[float] = None
+        self.last_counts: Optional[dict] = None
+        self.last_error: Optional[str] = None
+
+    def plan(self, now: Optional[datetime] = None) -> Optional[datetime]:
+        """Prossimo run: ora ``at`` del primo giorno dovuto (subito se in ritardo)."""
+        now = now or datetime.now(TZ)
+        today = now.date()
+        due = self.next_due(load_last_run_date() + timedelta(days=1))
+        if due is None:
+            return None
+        first = today + timedelta(days=1) if self._ran_on == today else today
+        when = datetime.combine(max(due, first), self.at, TZ)
+        return max(when, now)
+
+    def notify(self):
+        self._wake.set()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="catchup-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def status(self) -> dict:
+        return {
+            "running": self._thread is not None,
+            "time": self.at.strftime("%H:%M"),
+            "next_run": self.next_run.isoformat() if self.next_run else None,
+            "last_started": self.last_started.isoformat() if self.last_started else None,
+            "last_duration_s": self.last_duration,
+            "last_counts": self.last_counts,
+            "last_error": self.last_error,
+        }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.next_run = self.plan()
+            except Exception:
+                log.exception("pianificazione catch-up fallita")
+                self.next_run = None
+            now = datetime.now(TZ)
+            delay = self.max_sleep if self.next_run is None else (self.next_run - now).total_seconds()
+            if delay > 0:
+                self._wake.wait(min(delay, self.max_sleep))
+                self._wake.clear()
+                continue
+            self._run_once(now)
+
+    def _run_once(self, now: datetime):
+        self.last_started = now
+        t0 = time.monotonic()
+        try:
+            out = self.run()
+            self.last_counts = out.get("counts")
+            self.last_error = None
+            log.info("catch-up pianificato: %s", self.last_counts)
+        except Exception as e:
+            out = None
+            self.last_error = str(e)
+            log.exception("catch-up pianificato fallito")
+        self.last_duration = round(time.monotonic() - t0, 3)
+        # run fermato a un checkpoint (limite di durata): si riprende subito dal giorno successivo
+        if out is None or out.get("complete", True):
+            self._ran_on = now.date()